@@ -1,7 +1,13 @@
 from fastapi import APIRouter
 
-from app.api.endpoints import files, folders
+from app.api.endpoints import changes, files, folders, jobs, search, stats, uploads, versions
 
 api_router = APIRouter()
+api_router.include_router(changes.router, prefix="/changes", tags=["changes"])
 api_router.include_router(files.router, prefix="/files", tags=["files"])
+api_router.include_router(versions.router, prefix="/files", tags=["versions"])
 api_router.include_router(folders.router, prefix="/folders", tags=["folders"])
+api_router.include_router(jobs.router, prefix="/jobs", tags=["jobs"])
+api_router.include_router(search.router, prefix="/search", tags=["search"])
+api_router.include_router(stats.router, prefix="/stats", tags=["stats"])
+api_router.include_router(uploads.router, prefix="/uploads", tags=["uploads"])
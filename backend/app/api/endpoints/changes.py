@@ -0,0 +1,56 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.db.base import get_db
+from app.services.change_service import ChangeService, CursorExpired
+from app.services.folder_service import FolderService
+from app.schemas.change import ChangeCursor, ChangePage, ManifestRequest, ManifestResult
+
+router = APIRouter()
+
+
+@router.get("/", response_model=ChangePage, response_model_exclude_none=True)
+async def list_changes(
+    since: int = Query(..., ge=0, description="Cursor from the previous read, a manifest or /changes/latest"),
+    limit: int = Query(settings.CHANGES_PAGE_SIZE, ge=1, le=settings.CHANGES_PAGE_SIZE),
+    db: Session = Depends(get_db)
+):
+    """
+    Files and folders changed since a cursor, each once with its current state
+    or as deleted. Responds 410 when the cursor is too old to continue from; the
+    client then compares a manifest again.
+    """
+    try:
+        return await run_in_threadpool(ChangeService.read, db, since, limit)
+    except CursorExpired as e:
+        raise HTTPException(status_code=410, detail=str(e))
+
+
+@router.get("/latest", response_model=ChangeCursor)
+async def get_latest_cursor(db: Session = Depends(get_db)):
+    """
+    The current cursor, to follow changes from without reading the past ones
+    """
+    return ChangeCursor(cursor=await run_in_threadpool(ChangeService.latest, db))
+
+
+@router.post("/manifest", response_model=ManifestResult)
+async def compare_manifest(
+    manifest: ManifestRequest,
+    db: Session = Depends(get_db)
+):
+    """
+    Compare a client's files below a folder with the drive's, returning which to
+    upload and which to download, and the cursor to follow changes from afterwards
+    """
+    folder = await run_in_threadpool(FolderService.get_folder, db, manifest.folder_id)
+    if not folder:
+        raise HTTPException(status_code=404, detail="Folder not found")
+    try:
+        return await run_in_threadpool(
+            ChangeService.compare_manifest, db, manifest.folder_id, [entry.model_dump() for entry in manifest.files]
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
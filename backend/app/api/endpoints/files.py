@@ -1,20 +1,102 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File as FastAPIFile, Query
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File as FastAPIFile, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.datastructures import UploadFile as StarletteUploadFile
+from starlette.exceptions import HTTPException as StarletteHTTPException
 from sqlalchemy.orm import Session
-from typing import List
+from typing import Any, AsyncIterator, Dict, List, Optional
+from functools import partial
+from urllib.parse import quote
+import aiofiles
+import asyncio
+import base64
 import os
-import shutil
-import uuid
+import posixpath
 
-from app.db.base import get_db
+from app.core.config import settings
+from app.api.responses import ReleasingResponse, ZeroCopyFileResponse
+from app.db.base import get_db, run_read
+from app.services.archive_service import ArchiveService
+from app.services.blob_service import BlobService
+from app.services.cache_service import CacheService
+from app.services.compression_service import CompressionService
+from app.services.download_service import DownloadService, RangeNotSatisfiable
 from app.services.file_service import FileService
-from app.schemas.file import File, FileCreate, FileUpdate
-from app.models.folder import Folder
+from app.services.folder_service import FolderService, NameTaken
+from app.services.storage_backend import get_backend
+from app.services.thumbnail_service import SIZES as THUMBNAIL_SIZES, ThumbnailService
+from app.services.upload_service import UploadService
+from app.schemas.file import (
+    ArchiveRequest, BatchUpload, BatchUploadResult, File, FileCreate, FileUpdate, ThumbnailBatch, ThumbnailBatchRequest
+)
 from app.models.file import File as FileModel
 
 router = APIRouter()
 
 
+def _file_response(db_file: FileModel) -> JSONResponse:
+    return JSONResponse(content={
+        "id": db_file.id,
+        "name": db_file.name,
+        "mime_type": db_file.mime_type,
+        "size": db_file.size,
+        "folder_id": db_file.folder_id,
+        "path": db_file.path,
+        "created_at": db_file.created_at.isoformat(),
+        "updated_at": db_file.updated_at.isoformat(),
+        "version": db_file.version,
+        "download_url": db_file.download_url
+    })
+
+
+async def _store_upload(
+    db: Session,
+    folder_id: int,
+    filename: str,
+    mime_type: Optional[str],
+    chunks: AsyncIterator[bytes]
+) -> JSONResponse:
+    """
+    Stream chunks into a new file in the folder and record it, keeping blocking
+    database work off the event loop
+    """
+    folder = await run_in_threadpool(FolderService.get_folder, db, folder_id)
+    if not folder:
+        print(f"Folder with id {folder_id} not found")
+        return JSONResponse(
+            status_code=404,
+            content={"detail": f"Folder with id {folder_id} not found"}
+        )
+    
+    staged_path = BlobService.temp_path()
+    
+    # Stream to disk, hashing and counting bytes as they arrive
+    try:
+        file_size, content_hash = await UploadService.stream_to_disk(chunks, staged_path)
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"detail": e.detail})
+    except Exception as e:
+        print(f"Error saving file: {str(e)}")
+        return JSONResponse(
+            status_code=500,
+            content={"detail": f"Failed to save file: {str(e)}"}
+        )
+    
+    try:
+        db_file = await run_in_threadpool(
+            FileService.add_file,
+            db, folder, filename, mime_type, staged_path, file_size, content_hash
+        )
+    except NameTaken as e:
+        return JSONResponse(status_code=409, content={"detail": str(e)})
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"detail": str(e)})
+    
+    print(f"File saved successfully: {db_file.id}")
+    await run_in_threadpool(ThumbnailService.schedule, db_file)
+    return _file_response(db_file)
+
+
 @router.post("/upload/")
 async def upload_file(
     folder_id: int = Query(..., description="ID of the folder to upload to"),
@@ -25,75 +107,10 @@ async def upload_file(
     Upload a file to a specific folder
     """
     try:
-        # Print debug information
         print(f"Uploading file: {file.filename} to folder_id: {folder_id}")
-        print(f"Content type: {file.content_type}")
-        
-        # Check if folder exists
-        folder = db.query(Folder).filter(Folder.id == folder_id).first()
-        if not folder:
-            print(f"Folder with id {folder_id} not found")
-            return JSONResponse(
-                status_code=404,
-                content={"detail": f"Folder with id {folder_id} not found"}
-            )
-        
-        print(f"Found folder: {folder.name}, path: {folder.path}, storage_path: {folder.storage_path}")
-        
-        # Generate unique filename to avoid collisions
-        file_ext = os.path.splitext(file.filename)[1] if file.filename and "." in file.filename else ""
-        unique_filename = f"{uuid.uuid4()}{file_ext}"
-        
-        # Create storage path
-        storage_path = os.path.join(folder.storage_path, unique_filename)
-        
-        # Ensure directory exists
-        os.makedirs(os.path.dirname(storage_path), exist_ok=True)
-        
-        print(f"Saving file to: {storage_path}")
-        
-        # Save file to disk
-        try:
-            with open(storage_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-        except Exception as e:
-            print(f"Error saving file: {str(e)}")
-            return JSONResponse(
-                status_code=500,
-                content={"detail": f"Failed to save file: {str(e)}"}
-            )
-        
-        # Get file size
-        file_size = os.path.getsize(storage_path)
-        
-        # Create database record
-        db_file = FileModel(
-            name=file.filename,
-            path=os.path.join(folder.path, file.filename),
-            storage_path=storage_path,
-            mime_type=file.content_type,
-            size=file_size,
-            folder_id=folder_id
+        return await _store_upload(
+            db, folder_id, file.filename, file.content_type, UploadService.iter_upload_file(file)
         )
-        
-        db.add(db_file)
-        db.commit()
-        db.refresh(db_file)
-        
-        print(f"File saved successfully: {db_file.id}")
-        
-        # Return response as JSONResponse to avoid validation
-        return JSONResponse(content={
-            "id": db_file.id,
-            "name": db_file.name,
-            "mime_type": db_file.mime_type,
-            "size": db_file.size,
-            "folder_id": db_file.folder_id,
-            "path": db_file.path,
-            "created_at": db_file.created_at.isoformat(),
-            "updated_at": db_file.updated_at.isoformat(),
-            "download_url": f"/files/{db_file.storage_path.split('storage/')[-1]}"
-        })
     except Exception as e:
         print(f"Exception in upload_file: {str(e)}")
         import traceback
@@ -104,6 +121,134 @@ async def upload_file(
         )
 
 
+async def _stage_upload(upload: StarletteUploadFile, semaphore: asyncio.Semaphore) -> Dict[str, Any]:
+    """
+    Copy one file of a batch out of the multipart spool into a staging path
+    """
+    entry = {"name": upload.filename, "mime_type": upload.content_type, "path": BlobService.temp_path()}
+    async with semaphore:
+        try:
+            entry["size"], entry["content_hash"] = await run_in_threadpool(
+                UploadService.copy_to_disk, upload.file, entry["path"]
+            )
+        except HTTPException as e:
+            entry["status"], entry["detail"] = e.status_code, e.detail
+        except Exception as e:
+            entry["status"], entry["detail"] = 500, f"Failed to save file: {str(e)}"
+        finally:
+            await upload.close()
+    return entry
+
+
+@router.post("/upload/batch", response_model=BatchUpload)
+async def upload_files(
+    request: Request,
+    folder_id: int = Query(..., description="ID of the folder to upload to"),
+    db: Session = Depends(get_db)
+):
+    """
+    Upload many files to a folder in one request, sent as repeated multipart
+    'files' parts. Files are written to storage with bounded parallelism and
+    recorded in a single transaction; each file gets its own result, so one bad
+    file does not fail the batch.
+    """
+    folder = await run_in_threadpool(FolderService.get_folder, db, folder_id)
+    if not folder:
+        raise HTTPException(status_code=404, detail=f"Folder with id {folder_id} not found")
+    folder_path = await run_in_threadpool(FolderService.get_path, db, folder_id)
+    
+    # Parsed here rather than declared as a parameter to lift Starlette's default 1000-file cap
+    try:
+        form = await request.form(max_files=settings.UPLOAD_BATCH_MAX_FILES)
+    except StarletteHTTPException as e:
+        raise HTTPException(status_code=413, detail=e.detail)
+    files = [part for part in form.getlist("files") if isinstance(part, StarletteUploadFile)]
+    if not files:
+        raise HTTPException(status_code=400, detail="No files were sent")
+    
+    print(f"Batch upload: {len(files)} files to folder_id: {folder_id}")
+    semaphore = asyncio.Semaphore(settings.UPLOAD_BATCH_CONCURRENCY)
+    staged = await asyncio.gather(*(_stage_upload(upload, semaphore) for upload in files))
+    
+    stored = [entry for entry in staged if "status" not in entry]
+    try:
+        outcomes = await run_in_threadpool(FileService.add_files, db, folder, stored) if stored else []
+    except NameTaken as e:
+        outcomes = [{"error": str(e)} for _ in stored]
+    created = await run_in_threadpool(
+        FileService.get_files, db, [outcome["id"] for outcome in outcomes if "id" in outcome]
+    )
+    created = {db_file.id: db_file for db_file in created}
+    
+    outcomes = iter(outcomes)
+    results = []
+    for entry in staged:
+        if "status" in entry:
+            results.append(BatchUploadResult(name=entry["name"], status=entry["status"], detail=entry["detail"]))
+            continue
+        outcome = next(outcomes)
+        if "error" in outcome:
+            results.append(BatchUploadResult(name=entry["name"], status=409, detail=outcome["error"]))
+            continue
+        db_file = created[outcome["id"]]
+        results.append(BatchUploadResult(name=entry["name"], status=201, file=File(
+            id=db_file.id,
+            name=db_file.name,
+            mime_type=db_file.mime_type,
+            size=db_file.size,
+            folder_id=db_file.folder_id,
+            path=posixpath.join(folder_path, db_file.name),
+            created_at=db_file.created_at,
+            updated_at=db_file.updated_at,
+            download_url=db_file.download_url
+        )))
+    
+    await run_in_threadpool(ThumbnailService.schedule_all, list(created.values()))
+    
+    created_count = sum(1 for result in results if result.status == 201)
+    print(f"Batch upload finished: {created_count} of {len(files)} files stored")
+    return BatchUpload(
+        folder_id=folder_id, created=created_count, failed=len(results) - created_count, results=results
+    )
+
+
+@router.put("/upload/stream")
+async def upload_file_stream(
+    request: Request,
+    folder_id: int = Query(..., description="ID of the folder to upload to"),
+    filename: str = Query(..., description="Name of the uploaded file"),
+    db: Session = Depends(get_db)
+):
+    """
+    Upload a file sent as the raw request body. The body goes straight to storage
+    instead of being spooled by the multipart parser first, so oversized uploads
+    are rejected as soon as they cross MAX_UPLOAD_SIZE.
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > settings.MAX_UPLOAD_SIZE:
+        return JSONResponse(
+            status_code=413,
+            content={"detail": f"File exceeds maximum upload size of {settings.MAX_UPLOAD_SIZE} bytes"}
+        )
+    
+    try:
+        print(f"Streaming upload: {filename} to folder_id: {folder_id}")
+        return await _store_upload(
+            db, folder_id, filename, request.headers.get("content-type"), request.stream()
+        )
+    except Exception as e:
+        print(f"Exception in upload_file_stream: {str(e)}")
+        return JSONResponse(
+            status_code=500,
+            content={"detail": str(e)}
+        )
+
+
+def _file_info(db: Session, file_id: int) -> Optional[File]:
+    db_file = FileService.get_file(db, file_id)
+    return File.from_orm(db_file) if db_file else None
+
+
 @router.get("/info/{file_id}", response_model=File)
 async def get_file(
     file_id: int,
@@ -112,17 +257,195 @@ async def get_file(
     """
     Get file details by ID
     """
-    db_file = FileService.get_file(db, file_id)
+    file_info = await run_read(db, _file_info, file_id)
+    if not file_info:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    return file_info
+
+
+@router.api_route("/{file_id}/content", methods=["GET", "HEAD"])
+async def get_file_content(
+    file_id: int,
+    request: Request,
+    db: Session = Depends(get_db)
+):
+    """
+    Download file contents, with byte ranges and conditional requests
+    """
+    db_file = await run_in_threadpool(FileService.get_file, db, file_id)
+    if not db_file:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    try:
+        # The local cache's copy when there is one, pinned until the response is sent
+        path, stat, release = await run_in_threadpool(CacheService.open, db_file)
+    except (FileNotFoundError, TypeError):
+        raise HTTPException(status_code=404, detail="File contents missing from storage")
+    
+    try:
+        response = _content_response(request, db_file, path, stat)
+    except BaseException:
+        release()
+        raise
+    return ReleasingResponse(response, release)
+
+
+def _content_response(request: Request, db_file: FileModel, path: Optional[str], stat) -> Response:
+    """
+    The response to a download of a file's contents read from path, or from
+    storage when path is None
+    """
+    size = stat.st_size
+    content_type = db_file.mime_type or "application/octet-stream"
+    blob = db_file.blob
+    # A compressed blob read from storage goes out as stored to clients that accept its encoding
+    encoding = None
+    if blob is not None and blob.encoding and path is None and not request.headers.get("range"):
+        if CompressionService.accepted(request.headers.get("accept-encoding"), blob.encoding):
+            encoding = blob.encoding
+    etag = DownloadService.make_etag(db_file.content_hash, stat, encoding)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": DownloadService.http_date(stat.st_mtime),
+        "Cache-Control": "private, no-cache",
+        "Content-Disposition": f"inline; filename*=UTF-8''{quote(db_file.name)}",
+    }
+    if blob is not None and blob.encoding in ("gzip", "zstd"):
+        headers["Vary"] = "Accept-Encoding"
+    
+    status = DownloadService.evaluate_preconditions(request.headers, etag, stat.st_mtime)
+    if status == 304:
+        headers.pop("Content-Disposition")
+        return Response(status_code=304, headers=headers)
+    if status == 412:
+        return Response(status_code=412)
+    
+    ranges = None
+    if DownloadService.range_applies(request.headers, etag, stat.st_mtime):
+        try:
+            ranges = DownloadService.parse_range(request.headers.get("range"), size)
+        except RangeNotSatisfiable:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    
+    if encoding:
+        headers["Content-Encoding"] = encoding
+        headers["Content-Length"] = str(blob.stored_size)
+        if request.method == "HEAD":
+            headers["Content-Type"] = content_type
+            return Response(headers=headers)
+        body = get_backend().iter_range(blob.storage_key, 0, blob.stored_size - 1)
+        return StreamingResponse(body, media_type=content_type, headers=headers)
+    
+    # Blobs in remote storage or compressed, without a cached copy, are streamed from the backend
+    if path:
+        read_range = partial(DownloadService.iter_range, path)
+    else:
+        read_range = partial(CompressionService.iter_range, blob.storage_key, blob.encoding)
+    
+    if not ranges and path:
+        return ZeroCopyFileResponse(
+            path, media_type=content_type, headers=headers, stat_result=stat
+        )
+    if not ranges:
+        headers["Content-Length"] = str(size)
+        if request.method == "HEAD":
+            headers["Content-Type"] = content_type
+            return Response(headers=headers)
+        return StreamingResponse(read_range(0, size - 1) if size else iter(()), media_type=content_type, headers=headers)
+    
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        media_type = content_type
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        body = read_range(start, end)
+    else:
+        boundary, length, body = DownloadService.multipart_ranges(
+            read_range, ranges, size, content_type
+        )
+        media_type = f"multipart/byteranges; boundary={boundary}"
+        headers["Content-Length"] = str(length)
+    
+    if request.method == "HEAD":
+        headers["Content-Type"] = media_type
+        return Response(status_code=206, headers=headers)
+    return StreamingResponse(body, status_code=206, media_type=media_type, headers=headers)
+
+
+@router.get("/{file_id}/thumbnail")
+async def get_file_thumbnail(
+    file_id: int,
+    request: Request,
+    size: str = Query("medium", description="small, medium or large"),
+    db: Session = Depends(get_db)
+):
+    """
+    Get a WebP thumbnail of an image file
+    """
+    if size not in THUMBNAIL_SIZES:
+        raise HTTPException(status_code=400, detail=f"Size must be one of: {', '.join(THUMBNAIL_SIZES)}")
+    if not ThumbnailService.available():
+        raise HTTPException(status_code=501, detail="Thumbnails require Pillow to be installed")
+    
+    db_file = await run_in_threadpool(FileService.get_file, db, file_id)
     if not db_file:
         raise HTTPException(status_code=404, detail="File not found")
+    if not ThumbnailService.supports(db_file):
+        raise HTTPException(status_code=404, detail="No thumbnail available for this file")
+    
+    key = await run_in_threadpool(ThumbnailService.cache_key, db_file)
+    etag = f'"{key}-{size}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=31536000, immutable"}
+    # The thumbnail's mtime tracks its last use in the cache, so only the ETag validates it
+    if DownloadService.evaluate_preconditions(request.headers, etag, None) == 304:
+        return Response(status_code=304, headers=headers)
+    
+    path = await ThumbnailService.get(db_file, size)
+    if not path:
+        raise HTTPException(status_code=404, detail="No thumbnail available for this file")
     
-    # Add download URL to response
-    result = File.from_orm(db_file)
-    result.download_url = f"/files/{db_file.storage_path.split('storage/')[-1]}"
+    return FileResponse(path, media_type="image/webp", headers=headers)
+
+
+@router.post("/thumbnails", response_model=ThumbnailBatch)
+async def get_file_thumbnails(
+    batch: ThumbnailBatchRequest,
+    db: Session = Depends(get_db)
+):
+    """
+    Get thumbnails for many files at once, e.g. a whole folder page, as data URIs
+    """
+    if batch.size not in THUMBNAIL_SIZES:
+        raise HTTPException(status_code=400, detail=f"Size must be one of: {', '.join(THUMBNAIL_SIZES)}")
+    
+    files = await run_in_threadpool(FileService.get_files, db, batch.file_ids)
+    paths = await asyncio.gather(*(ThumbnailService.get(f, batch.size) for f in files))
     
+    result = ThumbnailBatch()
+    for db_file, path in zip(files, paths):
+        if path:
+            async with aiofiles.open(path, "rb") as thumbnail:
+                encoded = base64.b64encode(await thumbnail.read()).decode()
+            result.thumbnails[db_file.id] = f"data:image/webp;base64,{encoded}"
+    result.missing = [file_id for file_id in batch.file_ids if file_id not in result.thumbnails]
     return result
 
 
+@router.post("/archive")
+async def download_archive(selection: ArchiveRequest):
+    """
+    Download a selection of files as one zip archive, streamed as it is built.
+    IDs of files that no longer exist are ignored.
+    """
+    return StreamingResponse(
+        ArchiveService.stream(ArchiveService.selection_entries(selection.file_ids)),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(selection.name + '.zip')}"}
+    )
+
+
 @router.delete("/{file_id}")
 async def delete_file(
     file_id: int,
@@ -131,13 +454,35 @@ async def delete_file(
     """
     Delete a file
     """
-    success = FileService.delete_file(db, file_id)
+    success = await run_in_threadpool(FileService.delete_file, db, file_id)
     if not success:
         raise HTTPException(status_code=404, detail="File not found")
     
     return {"message": "File deleted successfully"}
 
 
+@router.post("/{file_id}/copy", response_model=File)
+async def copy_file(
+    file_id: int,
+    folder_id: int = Query(..., description="ID of the folder to copy into"),
+    name: Optional[str] = Query(None, description="Name of the copy, defaults to the original name"),
+    db: Session = Depends(get_db)
+):
+    """
+    Copy a file into a folder without duplicating its contents
+    """
+    try:
+        db_file = await run_in_threadpool(FileService.copy_file, db, file_id, folder_id, name)
+    except NameTaken as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not db_file:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    return File.from_orm(db_file)
+
+
 @router.patch("/{file_id}", response_model=File)
 async def update_file(
     file_id: int,
@@ -148,18 +493,20 @@ async def update_file(
     Update file details (rename or move)
     """
     try:
-        if file_update.name:
-            db_file = FileService.rename_file(db, file_id, file_update.name)
-            if not db_file:
-                raise HTTPException(status_code=404, detail="File not found")
-            
-            # Add download URL to response
-            result = File.from_orm(db_file)
-            result.download_url = f"/files/{db_file.storage_path.split('storage/')[-1]}"
-            
-            return result
-        else:
+        if not file_update.name and file_update.folder_id is None:
             raise HTTPException(status_code=400, detail="No update parameters provided")
+        
+        db_file = await run_in_threadpool(
+            FileService.update_file, db, file_id, file_update.name or None, file_update.folder_id
+        )
+        if not db_file:
+            raise HTTPException(status_code=404, detail="File not found")
+        
+        return File.from_orm(db_file)
+    except HTTPException:
+        raise
+    except NameTaken as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
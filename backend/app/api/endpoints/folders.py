@@ -1,16 +1,43 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
+from urllib.parse import quote
+import io
+import posixpath
 
-from app.db.base import get_db
-from app.services.folder_service import FolderService
-from app.schemas.folder import Folder, FolderCreate, FolderUpdate, FolderContents
+from app.core.config import settings
+from app.db.base import get_db, run_read
+from app.services.archive_service import ArchiveService
+from app.services.folder_service import FolderService, NameTaken
+from app.services.import_service import ImportService
+from app.services.job_service import JobService
+from app.services.listing_service import ListingService
+from app.services.upload_service import BlockingStreamReader
+from app.schemas.folder import (
+    Folder, FolderCreate, FolderUpdate, FolderContents, FolderTreeNode, FolderStats, ImportSummary
+)
 from app.models.folder import Folder as FolderModel
-from app.models.file import File
 
 router = APIRouter()
 
 
+def _folder_fields(folder: FolderModel, path: str) -> Dict[str, Any]:
+    # Paths are resolved up front, in batches, rather than lazily by the path property per folder
+    return {
+        "id": folder.id,
+        "name": folder.name,
+        "path": path,
+        "parent_id": folder.parent_id,
+        "created_at": folder.created_at,
+        "updated_at": folder.updated_at,
+        "total_size": folder.total_size,
+        "file_count": folder.file_count,
+        "folder_count": folder.folder_count,
+    }
+
+
 @router.post("/", response_model=Folder)
 async def create_folder(
     folder: FolderCreate,
@@ -20,14 +47,62 @@ async def create_folder(
     Create a new folder
     """
     try:
-        db_folder = FolderService.create_folder(db, folder.name, folder.parent_id)
+        db_folder = await run_in_threadpool(FolderService.create_folder, db, folder.name, folder.parent_id)
         return db_folder
+    except NameTaken as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _root_folders(db: Session) -> List[Dict[str, Any]]:
+    folders = FolderService.get_root_folders(db)
+    paths = FolderModel.paths_of(db, [folder.id for folder in folders])
+    return [_folder_fields(folder, paths[folder.id]) for folder in folders]
+
+
+def _folder(db: Session, folder_id: int) -> Optional[Dict[str, Any]]:
+    folder = FolderService.get_folder(db, folder_id)
+    return _folder_fields(folder, FolderModel.path_of(db, folder_id)) if folder else None
+
+
+def _tree(db: Session, folder_id: int, max_depth: Optional[int]) -> List[Dict[str, Any]]:
+    subtree = FolderService.get_subtree(db, folder_id, max_depth)
+    paths = FolderModel.paths_of(db, [folder.id for folder, _ in subtree])
+    return [{**_folder_fields(folder, paths[folder.id]), "depth": depth} for folder, depth in subtree]
+
+
+def _stats(db: Session, folder_id: int) -> Optional[Dict[str, int]]:
+    if not FolderService.get_folder(db, folder_id):
+        return None
+    return FolderService.get_subtree_stats(db, folder_id)
+
+
+def _breadcrumbs(db: Session, folder_id: int) -> List[Dict[str, Any]]:
+    # Each crumb's path extends the previous one, so no further queries are needed
+    crumbs = []
+    path = "/"
+    for depth, folder in enumerate(FolderService.get_ancestors(db, folder_id)):
+        if depth > 0:
+            path = posixpath.join(path, folder.name)
+        crumbs.append(_folder_fields(folder, path))
+    return crumbs
+
+
+def _contents(db: Session, folder_id: int, options: Dict[str, Any]) -> Dict[str, Any]:
+    folder = FolderService.get_folder(db, folder_id)
+    if not folder:
+        print(f"Folder with id {folder_id} not found in database")
+        raise LookupError(f"Folder with id {folder_id} not found")
+    
+    # Paths are derived, so resolve the folder's once and build children's from it
+    folder_path = FolderModel.path_of(db, folder_id)
+    page = ListingService.list_contents(db, folder_id, folder_path, **options)
+    return {**_folder_fields(folder, folder_path), **page}
+
+
 @router.get("/", response_model=List[Folder])
 async def get_root_folders(
     db: Session = Depends(get_db)
@@ -35,7 +110,7 @@ async def get_root_folders(
     """
     Get all root folders
     """
-    return FolderService.get_root_folders(db)
+    return await run_read(db, _root_folders)
 
 
 @router.get("/{folder_id}", response_model=Folder)
@@ -46,81 +121,81 @@ async def get_folder(
     """
     Get folder details by ID
     """
-    db_folder = FolderService.get_folder(db, folder_id)
-    if not db_folder:
+    folder = await run_read(db, _folder, folder_id)
+    if not folder:
+        raise HTTPException(status_code=404, detail="Folder not found")
+    return folder
+
+
+@router.get("/{folder_id}/tree", response_model=List[FolderTreeNode])
+async def get_folder_tree(
+    folder_id: int,
+    max_depth: Optional[int] = Query(None, ge=0, description="Deepest level to include below the folder"),
+    db: Session = Depends(get_db)
+):
+    """
+    Get a folder and every folder below it
+    """
+    tree = await run_read(db, _tree, folder_id, max_depth)
+    if not tree:
+        raise HTTPException(status_code=404, detail="Folder not found")
+    return tree
+
+
+@router.get("/{folder_id}/stats", response_model=FolderStats)
+async def get_folder_stats(
+    folder_id: int,
+    db: Session = Depends(get_db)
+):
+    """
+    Get the number of folders and files below a folder and their total size
+    """
+    stats = await run_read(db, _stats, folder_id)
+    if stats is None:
+        raise HTTPException(status_code=404, detail="Folder not found")
+    return FolderStats(folder_id=folder_id, **stats)
+
+
+@router.get("/{folder_id}/breadcrumbs", response_model=List[Folder])
+async def get_folder_breadcrumbs(
+    folder_id: int,
+    db: Session = Depends(get_db)
+):
+    """
+    Get the folders from the root down to a folder
+    """
+    crumbs = await run_read(db, _breadcrumbs, folder_id)
+    if not crumbs:
         raise HTTPException(status_code=404, detail="Folder not found")
-    return db_folder
+    return crumbs
 
 
 @router.get("/{folder_id}/contents")
 async def get_folder_contents(
     folder_id: int,
+    limit: Optional[int] = Query(None, ge=1, le=1000, description="Page size; omit to list everything"),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    sort: str = Query("name", description="name, size, created_at or updated_at"),
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+    fields: Optional[str] = Query(None, description="Comma-separated fields to include for each entry"),
     db: Session = Depends(get_db)
 ):
     """
-    Get all contents of a folder (files and subfolders)
+    Get the contents of a folder (subfolders first, then files), a page at a time
     """
     try:
         print(f"Getting contents for folder_id: {folder_id}")
-        
-        # Check if folder exists
-        folder = db.query(FolderModel).filter(FolderModel.id == folder_id).first()
-        if not folder:
-            print(f"Folder with id {folder_id} not found in database")
-            raise ValueError(f"Folder with id {folder_id} not found")
-            
-        print(f"Found folder: {folder.name}, path: {folder.path}")
-        
-        # Get subfolders
-        subfolders = db.query(FolderModel).filter(FolderModel.parent_id == folder_id).all()
-        print(f"Found {len(subfolders)} subfolders")
-        
-        # Get files
-        files = db.query(File).filter(File.folder_id == folder_id).all()
-        print(f"Found {len(files)} files")
-        
-        # Create response manually
-        result = {
-            "id": folder.id,
-            "name": folder.name,
-            "path": folder.path,
-            "parent_id": folder.parent_id,
-            "created_at": folder.created_at,
-            "updated_at": folder.updated_at,
-            "files": [],
-            "subfolders": []
-        }
-        
-        # Add subfolders
-        for subfolder in subfolders:
-            result["subfolders"].append({
-                "id": subfolder.id,
-                "name": subfolder.name,
-                "path": subfolder.path,
-                "parent_id": subfolder.parent_id,
-                "created_at": subfolder.created_at,
-                "updated_at": subfolder.updated_at
-            })
-        
-        # Add files with download URLs
-        for file in files:
-            file_dict = {
-                "id": file.id,
-                "name": file.name,
-                "mime_type": file.mime_type,
-                "size": file.size,
-                "folder_id": file.folder_id,
-                "path": file.path,
-                "created_at": file.created_at,
-                "updated_at": file.updated_at,
-                "download_url": f"/files/{file.storage_path.split('storage/')[-1]}"
-            }
-            result["files"].append(file_dict)
-        
-        return result
-    except ValueError as e:
-        print(f"ValueError in get_folder_contents: {str(e)}")
+        return await run_read(db, _contents, folder_id, {
+            "sort": sort,
+            "descending": order == "desc",
+            "limit": limit,
+            "cursor": cursor,
+            "fields": ListingService.parse_fields(fields),
+        })
+    except LookupError as e:
         raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         import traceback
         print(f"Error in get_folder_contents: {str(e)}")
@@ -128,24 +203,64 @@ async def get_folder_contents(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.get("/{folder_id}/archive")
+async def download_folder_archive(
+    folder_id: int,
+    db: Session = Depends(get_db)
+):
+    """
+    Download a folder and everything under it as a zip archive, streamed as it is built
+    """
+    folder = await run_in_threadpool(FolderService.get_folder, db, folder_id)
+    if not folder:
+        raise HTTPException(status_code=404, detail="Folder not found")
+    
+    return StreamingResponse(
+        ArchiveService.stream(ArchiveService.folder_entries(folder_id)),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(folder.name + '.zip')}"}
+    )
 
-@router.delete("/{folder_id}")
+
+@router.put("/{folder_id}/import", response_model=ImportSummary)
+async def import_archive(
+    folder_id: int,
+    request: Request,
+    db: Session = Depends(get_db)
+):
+    """
+    Extract a zip or tar archive (optionally gzip, bzip2 or xz compressed), sent as
+    the raw request body, into a folder, recreating its directory tree. The archive
+    is unpacked as it arrives and is never stored whole. Files whose names are
+    taken are skipped and listed in the summary.
+    """
+    folder = await run_in_threadpool(FolderService.get_folder, db, folder_id)
+    if not folder:
+        raise HTTPException(status_code=404, detail="Folder not found")
+    
+    stream = io.BufferedReader(BlockingStreamReader(request.stream()), settings.UPLOAD_CHUNK_SIZE)
+    summary = await run_in_threadpool(ImportService.import_archive, db, folder_id, stream)
+    if summary["error"] and not (summary["files_created"] or summary["folders_created"] or summary["skipped"]):
+        raise HTTPException(status_code=400, detail=summary["error"])
+    print(f"Imported {summary['files_created']} files and {summary['folders_created']} folders into folder {folder_id}")
+    return summary
+
+
+@router.delete("/{folder_id}", status_code=202)
 async def delete_folder(
     folder_id: int,
     db: Session = Depends(get_db)
 ):
     """
-    Delete a folder and all its contents
+    Delete a folder and all its contents. Runs as a background job; follow it
+    at /api/jobs/{job_id}.
     """
-    try:
-        success = FolderService.delete_folder(db, folder_id)
-        if not success:
-            raise HTTPException(status_code=404, detail="Folder not found")
-        return {"message": "Folder deleted successfully"}
-    except ValueError as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    folder = await run_in_threadpool(FolderService.get_folder, db, folder_id)
+    if not folder:
+        raise HTTPException(status_code=404, detail="Folder not found")
+    
+    job = await run_in_threadpool(JobService.submit, db, "delete_folder", {"folder_id": folder_id})
+    return {"message": "Folder deletion started", "job_id": job.id}
 
 
 @router.patch("/{folder_id}", response_model=Folder)
@@ -155,16 +270,23 @@ async def update_folder(
     db: Session = Depends(get_db)
 ):
     """
-    Update folder details (rename)
+    Update folder details (rename or move)
     """
     try:
-        if folder_update.name:
-            db_folder = FolderService.rename_folder(db, folder_id, folder_update.name)
-            if not db_folder:
-                raise HTTPException(status_code=404, detail="Folder not found")
-            return db_folder
-        else:
+        if not folder_update.name and folder_update.parent_id is None:
             raise HTTPException(status_code=400, detail="No update parameters provided")
+        
+        db_folder = await run_in_threadpool(
+            FolderService.update_folder, db, folder_id, folder_update.name or None, folder_update.parent_id
+        )
+        if not db_folder:
+            raise HTTPException(status_code=404, detail="Folder not found")
+        
+        return db_folder
+    except HTTPException:
+        raise
+    except NameTaken as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -0,0 +1,100 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse
+from sqlalchemy.orm import Session
+from typing import List, Optional
+import os
+
+from app.db.base import get_db
+from app.services.job_service import JobService
+from app.schemas.job import Job, JobCreate
+
+router = APIRouter()
+
+
+@router.post("/", response_model=Job, status_code=202)
+async def create_job(
+    job: JobCreate,
+    db: Session = Depends(get_db)
+):
+    """
+    Start a background job
+    """
+    try:
+        return await run_in_threadpool(JobService.submit, db, job.kind, job.params)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/", response_model=List[Job])
+async def list_jobs(
+    status: Optional[str] = Query(None, description="queued, running, succeeded, failed or cancelled"),
+    limit: int = Query(50, ge=1, le=500),
+    db: Session = Depends(get_db)
+):
+    """
+    List recent jobs, newest first
+    """
+    return await run_in_threadpool(JobService.list_jobs, db, status, limit)
+
+
+@router.get("/{job_id}", response_model=Job)
+async def get_job(
+    job_id: str,
+    db: Session = Depends(get_db)
+):
+    """
+    Get a job's status and progress
+    """
+    job = await run_in_threadpool(JobService.get_job, db, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.post("/{job_id}/cancel", response_model=Job)
+async def cancel_job(
+    job_id: str,
+    db: Session = Depends(get_db)
+):
+    """
+    Cancel a queued or running job. A running job stops at its next step.
+    """
+    job = await run_in_threadpool(JobService.cancel, db, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.get("/{job_id}/result")
+async def get_job_result(
+    job_id: str,
+    db: Session = Depends(get_db)
+):
+    """
+    Download the file a finished job produced, such as a folder archive
+    """
+    job = await run_in_threadpool(JobService.get_job, db, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    path = JobService.result_path(job_id)
+    if job.status != "succeeded" or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="This job has no file to download")
+    
+    return FileResponse(path, filename=(job.result or {}).get("filename"))
+
+
+@router.delete("/{job_id}")
+async def delete_job(
+    job_id: str,
+    db: Session = Depends(get_db)
+):
+    """
+    Forget a finished job and delete any file it produced
+    """
+    try:
+        if not await run_in_threadpool(JobService.delete_job, db, job_id):
+            raise HTTPException(status_code=404, detail="Job not found")
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"message": "Job deleted successfully"}
@@ -0,0 +1,28 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+from typing import Optional
+
+from app.db.base import get_db
+from app.services.search_service import SearchService
+from app.schemas.search import SearchResults
+
+router = APIRouter()
+
+
+@router.get("", response_model=SearchResults)
+async def search(
+    q: str = Query(..., min_length=1, max_length=256, description="Terms matched anywhere in names or contents"),
+    type: str = Query("all", pattern="^(all|file|folder)$"),
+    folder_id: Optional[int] = Query(None, description="Only search below this folder"),
+    limit: int = Query(50, ge=1, le=200),
+    offset: int = Query(0, ge=0),
+    db: Session = Depends(get_db)
+):
+    """
+    Search files and folders by name, and files by their text contents
+    """
+    try:
+        return await run_in_threadpool(SearchService.search, db, q, type, folder_id, limit, offset)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
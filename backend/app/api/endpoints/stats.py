@@ -0,0 +1,37 @@
+from fastapi import APIRouter, Depends, Query
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+
+from app.db.base import get_db
+from app.services.cache_service import CacheService
+from app.services.stats_service import StatsService
+from app.schemas.stats import StorageReport
+
+router = APIRouter()
+
+
+@router.get("/db")
+async def get_database_stats():
+    """
+    Get connection pool and lock wait metrics
+    """
+    return StatsService.database()
+
+
+@router.get("/cache")
+async def get_cache_stats():
+    """
+    Get hit and miss counts of the local read cache and what it holds
+    """
+    return await run_in_threadpool(CacheService.stats)
+
+
+@router.get("/storage", response_model=StorageReport)
+async def get_storage_report(
+    limit: int = Query(20, ge=1, le=100, description="Entries in the folder, largest file and duplicate lists"),
+    db: Session = Depends(get_db)
+):
+    """
+    Get what is using storage space, by type, folder and month, with the largest files and duplicates
+    """
+    return await run_in_threadpool(StatsService.storage, db, limit)
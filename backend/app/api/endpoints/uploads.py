@@ -0,0 +1,130 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+from typing import Optional
+import re
+
+from app.db.base import get_db
+from app.services.folder_service import NameTaken
+from app.services.thumbnail_service import ThumbnailService
+from app.services.upload_service import UploadService
+from app.schemas.file import File
+from app.schemas.upload import UploadSession, UploadSessionCreate
+
+router = APIRouter()
+
+CONTENT_RANGE_RE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+
+@router.post("/", response_model=UploadSession, status_code=201)
+async def create_upload_session(
+    upload: UploadSessionCreate,
+    db: Session = Depends(get_db)
+):
+    """
+    Start a resumable upload
+    """
+    try:
+        return await run_in_threadpool(
+            UploadService.create_session,
+            db, upload.folder_id, upload.filename, upload.mime_type, upload.total_size
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@router.get("/{session_id}", response_model=UploadSession)
+async def get_upload_session(
+    session_id: str,
+    response: Response,
+    db: Session = Depends(get_db)
+):
+    """
+    Get the committed offset of an upload session
+    """
+    upload = await run_in_threadpool(UploadService.get_session, db, session_id)
+    if not upload:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+
+    response.headers["Upload-Offset"] = str(upload.offset)
+    return upload
+
+
+@router.head("/{session_id}")
+async def head_upload_session(
+    session_id: str,
+    db: Session = Depends(get_db)
+):
+    """
+    Get the committed offset of an upload session as an Upload-Offset header
+    """
+    upload = await run_in_threadpool(UploadService.get_session, db, session_id)
+    if not upload:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+
+    headers = {"Upload-Offset": str(upload.offset)}
+    if upload.total_size is not None:
+        headers["Upload-Length"] = str(upload.total_size)
+    return Response(status_code=200, headers=headers)
+
+
+@router.put("/{session_id}", response_model=UploadSession)
+async def upload_chunk(
+    session_id: str,
+    request: Request,
+    response: Response,
+    offset: Optional[int] = Query(None, description="Byte offset of the body; defaults to the Content-Range start"),
+    db: Session = Depends(get_db)
+):
+    """
+    Write the request body at an offset of an upload session
+    """
+    if offset is None:
+        match = CONTENT_RANGE_RE.fullmatch(request.headers.get("content-range", ""))
+        if not match:
+            raise HTTPException(status_code=400, detail="An offset or Content-Range header is required")
+        offset = int(match.group(1))
+
+    try:
+        upload = await UploadService.write_chunk(db, session_id, offset, request.stream())
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    response.headers["Upload-Offset"] = str(upload.offset)
+    return upload
+
+
+@router.post("/{session_id}/complete", response_model=File)
+async def complete_upload(
+    session_id: str,
+    db: Session = Depends(get_db)
+):
+    """
+    Finalize an upload session into a file
+    """
+    try:
+        db_file = await UploadService.complete_session(db, session_id)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except NameTaken as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    await run_in_threadpool(ThumbnailService.schedule, db_file)
+
+    return File.from_orm(db_file)
+
+
+@router.delete("/{session_id}")
+async def abort_upload(
+    session_id: str,
+    db: Session = Depends(get_db)
+):
+    """
+    Cancel an upload session
+    """
+    success = await run_in_threadpool(UploadService.abort_session, db, session_id)
+    if not success:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+
+    return {"message": "Upload cancelled"}
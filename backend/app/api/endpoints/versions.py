@@ -0,0 +1,186 @@
+from fastapi import APIRouter, Depends, Form, HTTPException, UploadFile, File as FastAPIFile, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from sqlalchemy.orm import Session
+from typing import List
+from urllib.parse import quote
+import io
+import os
+
+from app.core.config import settings
+from app.db.base import get_db
+from app.services.blob_service import BlobService
+from app.services.chunk_service import ChunkService
+from app.services.compression_service import CompressionService
+from app.services.file_service import FileService
+from app.services.thumbnail_service import ThumbnailService
+from app.services.upload_service import UploadService
+from app.services.version_service import VersionService
+from app.schemas.file import File
+from app.schemas.version import DeltaManifest, FileVersion, VersionChunks
+from app.models.file import File as FileModel
+
+router = APIRouter()
+
+
+def _get_file(db: Session, file_id: int) -> FileModel:
+    db_file = FileService.get_file(db, file_id)
+    if not db_file:
+        raise HTTPException(status_code=404, detail="File not found")
+    return db_file
+
+
+@router.get("/{file_id}/versions", response_model=List[FileVersion])
+async def list_versions(
+    file_id: int,
+    db: Session = Depends(get_db)
+):
+    """
+    List a file's versions, the current one first
+    """
+    db_file = await run_in_threadpool(_get_file, db, file_id)
+    return await run_in_threadpool(VersionService.list_versions, db, db_file)
+
+
+@router.put("/{file_id}/versions", response_model=File)
+async def upload_version(
+    file_id: int,
+    request: Request,
+    db: Session = Depends(get_db)
+):
+    """
+    Replace a file's contents with the raw request body, keeping the previous
+    contents as a version
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > settings.MAX_UPLOAD_SIZE:
+        raise HTTPException(
+            status_code=413, detail=f"File exceeds maximum upload size of {settings.MAX_UPLOAD_SIZE} bytes"
+        )
+    db_file = await run_in_threadpool(_get_file, db, file_id)
+
+    staged_path = BlobService.temp_path()
+    file_size, content_hash = await UploadService.stream_to_disk(request.stream(), staged_path)
+    db_file = await run_in_threadpool(
+        VersionService.add_version, db, db_file, staged_path, file_size, content_hash
+    )
+    print(f"Stored version {db_file.version} of file {db_file.id}")
+    await run_in_threadpool(ThumbnailService.schedule, db_file)
+    return File.from_orm(db_file)
+
+
+@router.post("/{file_id}/versions/delta", response_model=File)
+async def upload_version_delta(
+    file_id: int,
+    manifest: str = Form(..., description="DeltaManifest as JSON"),
+    data: UploadFile = FastAPIFile(None, description="The chunks not in the base version, in manifest order"),
+    db: Session = Depends(get_db)
+):
+    """
+    Replace a file's contents with a new version sent as a delta: the chunk list
+    of the new contents, and the data of only those chunks the base version does
+    not have. Clients cut their copy with the limits from the chunks endpoint.
+    """
+    try:
+        delta = DeltaManifest.model_validate_json(manifest)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False))
+    db_file = await run_in_threadpool(_get_file, db, file_id)
+
+    staged_path = BlobService.temp_path()
+    os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+    try:
+        file_size, content_hash = await run_in_threadpool(
+            VersionService.stage_delta,
+            db, db_file, delta.base_version, [(chunk.sha256, chunk.size) for chunk in delta.chunks],
+            data.file if data else io.BytesIO(), staged_path
+        )
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if delta.sha256 and delta.sha256.lower() != content_hash:
+        os.remove(staged_path)
+        raise HTTPException(status_code=400, detail="Assembled contents do not match the manifest's SHA-256")
+
+    db_file = await run_in_threadpool(
+        VersionService.add_version, db, db_file, staged_path, file_size, content_hash
+    )
+    print(f"Stored version {db_file.version} of file {db_file.id} from a delta")
+    await run_in_threadpool(ThumbnailService.schedule, db_file)
+    return File.from_orm(db_file)
+
+
+@router.get("/{file_id}/versions/{number}/chunks", response_model=VersionChunks)
+async def get_version_chunks(
+    file_id: int,
+    number: int,
+    db: Session = Depends(get_db)
+):
+    """
+    Content-defined chunks of a version, for clients working out which chunks
+    of their copy need sending
+    """
+    db_file = await run_in_threadpool(_get_file, db, file_id)
+    blob = await run_in_threadpool(VersionService.get_blob, db, db_file, number)
+    if blob is None:
+        raise HTTPException(status_code=404, detail="Version not found")
+    try:
+        chunks = await run_in_threadpool(ChunkService.manifest, db, blob)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Version contents missing from storage")
+    await run_in_threadpool(db.commit)
+
+    min_size, average_size, max_size = ChunkService.limits()
+    return VersionChunks(
+        number=number, size=blob.size, content_hash=blob.sha256,
+        min_size=min_size, average_size=average_size, max_size=max_size, chunks=chunks
+    )
+
+
+@router.get("/{file_id}/versions/{number}/content")
+async def get_version_content(
+    file_id: int,
+    number: int,
+    db: Session = Depends(get_db)
+):
+    """
+    Download the contents of a version
+    """
+    db_file = await run_in_threadpool(_get_file, db, file_id)
+    blob = await run_in_threadpool(VersionService.get_blob, db, db_file, number)
+    if blob is None:
+        raise HTTPException(status_code=404, detail="Version not found")
+    await run_in_threadpool(db.commit)
+
+    body = CompressionService.iter_range(blob.storage_key, blob.encoding, 0, blob.size - 1) if blob.size else iter(())
+    return StreamingResponse(
+        body,
+        media_type=db_file.mime_type or "application/octet-stream",
+        headers={
+            "Content-Length": str(blob.size),
+            "ETag": f'"{blob.sha256}"',
+            "Content-Disposition": f"inline; filename*=UTF-8''{quote(db_file.name)}",
+        }
+    )
+
+
+@router.post("/{file_id}/versions/{number}/restore", response_model=File)
+async def restore_version(
+    file_id: int,
+    number: int,
+    db: Session = Depends(get_db)
+):
+    """
+    Make an earlier version current again, as a new version
+    """
+    db_file = await run_in_threadpool(_get_file, db, file_id)
+    try:
+        restored = await run_in_threadpool(VersionService.restore, db, db_file, number)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Version contents missing from storage")
+    if not restored:
+        raise HTTPException(status_code=404, detail="Version not found")
+    await run_in_threadpool(ThumbnailService.schedule, restored)
+    return File.from_orm(restored)
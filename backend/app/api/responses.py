@@ -0,0 +1,50 @@
+from typing import Callable
+
+from starlette.responses import FileResponse, Response
+from starlette.types import Receive, Scope, Send
+
+
+class ZeroCopyFileResponse(FileResponse):
+    """
+    FileResponse that hands the path to the server through the ASGI
+    http.response.pathsend extension when available, so the server can use
+    sendfile instead of copying the file through Python
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        extensions = scope.get("extensions") or {}
+        if "http.response.pathsend" not in extensions or scope.get("method") == "HEAD":
+            await super().__call__(scope, receive, send)
+            return
+
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+        await send({"type": "http.response.pathsend", "path": str(self.path)})
+        if self.background is not None:
+            await self.background()
+
+
+class ReleasingResponse(Response):
+    """
+    Sends another response, then calls release whether or not sending
+    succeeded, e.g. to unpin a cached file once a download is done with it or
+    the client has gone away
+    """
+
+    def __init__(self, response: Response, release: Callable[[], None]) -> None:
+        self.response = response
+        self.release = release
+        self.status_code = response.status_code
+        self.raw_headers = response.raw_headers
+        self.background = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await self.response(scope, receive, send)
+        finally:
+            self.release()
+        if self.background is not None:
+            await self.background()
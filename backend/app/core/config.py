@@ -1,6 +1,7 @@
 import os
 from pathlib import Path
 from pydantic_settings import BaseSettings
+from typing import Optional
 
 # Get the project root directory
 ROOT_DIR = Path(__file__).resolve().parent.parent.parent.parent
@@ -18,9 +19,93 @@ class Settings(BaseSettings):
     STORAGE_DIR: str = "/Volumes/Personal Use/personal_drive_storage"
     
     MAX_UPLOAD_SIZE: int = 1024 * 1024 * 1024  # 1GB max file size
+    UPLOAD_CHUNK_SIZE: int = 1024 * 1024  # Read/write size when streaming uploads to disk
+    UPLOAD_SESSION_TTL: int = 24 * 60 * 60  # Seconds an idle resumable upload is kept
+    UPLOAD_BATCH_MAX_FILES: int = 5000  # Files accepted by one batch upload request
+    UPLOAD_BATCH_CONCURRENCY: int = 8  # Files of a batch written to storage at once
+    IMPORT_BATCH_SIZE: int = 500  # Archive entries recorded per transaction during an import
+    
+    # Thumbnails
+    THUMBNAIL_WORKERS: int = 2  # Processes rendering thumbnails
+    THUMBNAIL_CACHE_MAX_BYTES: int = 2 * 1024 * 1024 * 1024  # LRU-evicted beyond this
+    
+    # Where blob contents are kept: "local" (inside STORAGE_DIR), "sharded" (over several disks) or "s3"
+    STORAGE_BACKEND: str = "local"
+    STORAGE_SHARD_DIRS: list[str] = []  # Blob directories for "sharded", one per disk; list the current one to keep its blobs
+    STORAGE_SHARD_MIN_FREE: int = 1024 * 1024 * 1024  # Bytes left free on each disk
+    STORAGE_PLACEMENT: str = "hash"  # Disk for a new blob under "sharded": "hash", "free_space" or "round_robin"
+    STORAGE_PINNED_FOLDERS: dict[str, str] = {}  # Top-level folder name -> one of STORAGE_SHARD_DIRS its blobs stay on
+    STORAGE_REBALANCE_TOLERANCE: float = 0.05  # Spread of disk fullness the rebalance job leaves alone
+    S3_ENDPOINT_URL: str = "http://localhost:9000"  # Any S3-compatible server, e.g. MinIO
+    S3_BUCKET: str = "personal-drive"
+    S3_PREFIX: str = "blobs/"
+    S3_REGION: str = "us-east-1"
+    S3_ACCESS_KEY: str = ""
+    S3_SECRET_KEY: str = ""
+    S3_MAX_CONNECTIONS: int = 16  # Kept-alive connections shared by all requests
+    S3_TIMEOUT: float = 60.0
+    S3_MULTIPART_THRESHOLD: int = 64 * 1024 * 1024  # Larger blobs are uploaded in parts
+    S3_PART_SIZE: int = 16 * 1024 * 1024  # At least 5 MB, the S3 minimum
+    S3_UPLOAD_CONCURRENCY: int = 4  # Parts of one blob uploaded at once
+
+    # Blobs of compressible types, such as logs, CSVs and JSON, stored compressed; unset to store everything as is
+    COMPRESSION_ENCODING: Optional[str] = None  # "zstd" (needs the zstandard package, else gzip is used) or "gzip"
+    COMPRESSION_LEVEL: Optional[int] = None  # None for the encoding's default: 3 for zstd, 6 for gzip
+    COMPRESSION_MIN_SIZE: int = 4096  # Smaller files are stored as they are
+    COMPRESSION_SAMPLE_SIZE: int = 256 * 1024  # Bytes compressed up front to judge whether a file is worth it
+    COMPRESSION_MAX_RATIO: float = 0.8  # Kept compressed only when it shrinks to this fraction of the size or less
+
+    # File versions
+    VERSION_MAX_KEPT: int = 50  # Earlier versions kept per file; the oldest are dropped beyond this
+    VERSION_CHUNK_MIN_SIZE: int = 32 * 1024 * 1024  # Versioned files this large are stored as chunks shared between versions
+    VERSION_CHUNK_SIZE: int = 1024 * 1024  # Average content-defined chunk; chunks are a quarter to four times this
+
+    # Change journal read by sync clients
+    CHANGES_RETENTION: int = 90 * 24 * 60 * 60  # Seconds entries are kept; clients with an older cursor start over from a manifest
+    CHANGES_PAGE_SIZE: int = 1000  # Journal entries read per request, at most
+
+    # Read cache on fast local disk in front of STORAGE_DIR, e.g. os.path.join(ROOT_DIR, "cache"); unset to disable
+    CACHE_DIR: Optional[str] = None  # Thumbnails are kept here too when set; with "s3" they need it
+    CACHE_MAX_BYTES: int = 20 * 1024 * 1024 * 1024  # Least recently used contents are evicted beyond this
+    CACHE_MAX_FILE_SIZE: int = 512 * 1024 * 1024  # Larger files are always read from the drive
+    CACHE_ADMIT_READS: int = 2  # Downloads of a file before it is copied into the cache
+    CACHE_WORKERS: int = 1  # Files copied into the cache at once
+    
+    # Search
+    SEARCH_MAX_TEXT_BYTES: int = 1024 * 1024  # Indexed text per file
+    SEARCH_MAX_PDF_PAGES: int = 50  # Pages of a PDF whose text is indexed
+    
+    # Background jobs
+    JOB_WORKERS: int = 2  # Jobs running at once
+    JOB_PROGRESS_INTERVAL: float = 1.0  # Seconds between progress writes of a running job
+    JOB_BATCH_SIZE: int = 500  # Files handled per transaction by jobs that work in steps
+    
+    # Reconciliation of the catalog with the storage directory
+    RECONCILE_WORKERS: int = 8  # Directories listed at once; most of the time is spent waiting on the drive
+    RECONCILE_GRACE_PERIOD: int = 60 * 60  # Seconds before an unrecorded file counts as orphaned, so writes in flight are left alone
+    
+    # Watching STORAGE_DIR for files copied onto the drive outside the app
+    WATCH_ENABLED: bool = False  # Add such files to the catalog in place, and follow their moves and deletions
+    WATCH_DEBOUNCE: float = 2.0  # Seconds without events, and without a file changing, before changes are applied
+    WATCH_MAX_DELAY: float = 30.0  # Longest changes wait while events keep coming
+    WATCH_POLL_INTERVAL: float = 30.0  # Seconds between scans when watchdog (inotify/FSEvents) is not available
+    WATCH_BATCH_SIZE: int = 500  # Changes applied per transaction
+    
+    # Archives
+    ARCHIVE_BATCH_SIZE: int = 1000  # Files looked up per query while a zip download streams
+    
+    # Internal data (staged uploads etc.) is kept in this directory inside STORAGE_DIR
+    DATA_DIR_NAME: str = ".personal_drive"
     
     # Database
     DATABASE_URL: str = f"sqlite:///{ROOT_DIR}/personal_drive.db"
+    DB_READ_POOL_SIZE: int = 8  # Reader connections kept open; writes share a single connection
+    DB_READ_MAX_OVERFLOW: int = -1  # WAL readers never block each other, so extra readers are not capped
+    DB_POOL_TIMEOUT: int = 30  # Seconds to wait for a free connection, e.g. behind other writers
+    DB_ASYNC_READS: bool = False  # Serve folder reads from an aiosqlite session rather than the reader pool in the threadpool; slower on a single core
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    SQLITE_CACHE_SIZE_KB: int = 64 * 1024  # Page cache per connection
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024
     
     # CORS
     BACKEND_CORS_ORIGINS: list[str] = ["*"]
@@ -31,5 +116,13 @@ class Settings(BaseSettings):
 
 settings = Settings()
 
+
+def data_path(*parts: str) -> str:
+    """
+    Path of an internal data location inside STORAGE_DIR
+    """
+    return os.path.join(settings.STORAGE_DIR, settings.DATA_DIR_NAME, *parts)
+
+
 # Ensure storage directory exists
 os.makedirs(settings.STORAGE_DIR, exist_ok=True)
@@ -1,13 +1,117 @@
-from sqlalchemy import create_engine
+import re
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.sql.elements import TextClause
+from typing import Callable, Optional, TypeVar
 
 from app.core.config import settings
+from app.db.pool import TimedAsyncQueuePool, TimedQueuePool
 
-engine = create_engine(
-    settings.DATABASE_URL, connect_args={"check_same_thread": False}
+T = TypeVar("T")
+
+# Raw SQL statements that must run on the writer connection
+WRITE_SQL = re.compile(r"\s*(INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER)\b", re.IGNORECASE)
+
+
+def _instrument(db_engine: Engine, query_only: bool) -> None:
+    @event.listens_for(db_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # WAL lets readers run alongside the writer instead of failing with "database is locked"
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={settings.SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA cache_size=-{settings.SQLITE_CACHE_SIZE_KB}")
+        cursor.execute(f"PRAGMA mmap_size={settings.SQLITE_MMAP_SIZE}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        if query_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+
+    @event.listens_for(db_engine, "handle_error")
+    def count_busy_errors(context):
+        if "database is locked" in str(context.original_exception):
+            db_engine.pool.stats.record_busy()
+
+
+def _create_engine(pool_size: int, max_overflow: int, query_only: bool) -> Engine:
+    db_engine = create_engine(
+        settings.DATABASE_URL,
+        connect_args={"check_same_thread": False},
+        poolclass=TimedQueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=settings.DB_POOL_TIMEOUT
+    )
+    _instrument(db_engine, query_only)
+    return db_engine
+
+
+# Every write goes through one connection, so writers queue in the pool rather
+# than contend for SQLite's lock; readers get a pool of their own.
+engine = _create_engine(pool_size=1, max_overflow=0, query_only=False)
+read_engine = _create_engine(
+    pool_size=settings.DB_READ_POOL_SIZE, max_overflow=settings.DB_READ_MAX_OVERFLOW, query_only=True
 )
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def is_write(clause) -> bool:
+    if clause is None:
+        return False
+    if getattr(clause, "is_dml", False):
+        return True
+    return isinstance(clause, TextClause) and WRITE_SQL.match(clause.text) is not None
+
+
+class RoutingSession(Session):
+    """
+    Session that sends reads to the reader pool and writes to the writer connection.
+    Once a transaction has written, the rest of it stays on the writer so it sees
+    its own uncommitted changes.
+    """
+
+    _writing = False
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self._writing or self._flushing or is_write(clause):
+            self._writing = True
+            return engine
+        return read_engine
+
+
+@event.listens_for(RoutingSession, "after_transaction_end")
+def release_writer(session, transaction):
+    if transaction.parent is None:
+        session._writing = False
+
+
+SessionLocal = sessionmaker(class_=RoutingSession, autocommit=False, autoflush=False)
+
+# Optional read-only async path (DB_ASYNC_READS): aiosqlite runs each connection's
+# queries on a thread of its own. Created on first use, so aiosqlite is only needed
+# when the setting is on.
+async_engine: Optional[AsyncEngine] = None
+_async_sessions: Optional[async_sessionmaker] = None
+
+
+def _async_session() -> AsyncSession:
+    global async_engine, _async_sessions
+    if _async_sessions is None:
+        async_engine = create_async_engine(
+            make_url(settings.DATABASE_URL).set(drivername="sqlite+aiosqlite"),
+            poolclass=TimedAsyncQueuePool,
+            pool_size=settings.DB_READ_POOL_SIZE,
+            max_overflow=settings.DB_READ_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT
+        )
+        _instrument(async_engine.sync_engine, query_only=True)
+        _async_sessions = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+    return _async_sessions()
+
 
 Base = declarative_base()
 
@@ -18,3 +122,15 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def run_read(db: Session, fn: Callable[..., T], *args) -> T:
+    """
+    Run a read-only function of a session off the event loop: on the request's
+    session in the threadpool, or with DB_ASYNC_READS on an aiosqlite session
+    through its sync facade. The result must not need the session afterwards.
+    """
+    if not settings.DB_ASYNC_READS:
+        return await run_in_threadpool(fn, db, *args)
+    async with _async_session() as session:
+        return await session.run_sync(fn, *args)
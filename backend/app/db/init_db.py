@@ -1,25 +1,129 @@
+from sqlalchemy import inspect, text
 from sqlalchemy.orm import Session
 from app.db.base import Base, engine
+from app.models.blob import Blob  # noqa: F401 - registers the blobs table
+from app.models.blob_chunk import BlobChunk  # noqa: F401 - registers the blob_chunks table
+from app.models.change import Change  # noqa: F401 - registers the changes table
+from app.models.file import File  # noqa: F401 - registers the files table
+from app.models.file_version import FileVersion  # noqa: F401 - registers the file_versions table
 from app.models.folder import Folder
+from app.models.folder_closure import FolderClosure
+from app.models.job import Job  # noqa: F401 - registers the jobs table
+from app.models.scan_checkpoint import ScanCheckpoint  # noqa: F401 - registers the scan_checkpoints table
+from app.models.upload_session import UploadSession  # noqa: F401 - registers the upload_sessions table
 from app.core.config import settings
+from app.services.change_service import ChangeService
+from app.services.folder_service import FolderService
+from app.services.search_service import SearchService
 import os
+from typing import List
+
+
+def sync_schema() -> List[str]:
+    """
+    Add columns and indexes introduced after a database was first created, and
+    rebuild indexes made unique since. create_all only creates missing tables,
+    so older databases are patched here.
+    Returns the added columns as "table.column".
+    """
+    added = []
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=engine.dialect)}"
+                if column.server_default is not None:
+                    ddl += f" DEFAULT {column.server_default.arg}"
+                conn.execute(text(ddl))
+                added.append(f"{table.name}.{column.name}")
+
+            # Looked up by name, since reflection skips expression indexes
+            indexes = set(conn.execute(
+                text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table"),
+                {"table": table.name}
+            ).scalars())
+            unique = {row.name for row in conn.execute(text(f"PRAGMA index_list({table.name})")) if row.unique}
+            for index in table.indexes:
+                if index.name in indexes and index.unique and index.name not in unique:
+                    scope = next(column.name for column in index.columns if column.name != "name")
+                    _rename_duplicates(conn, table.name, scope)
+                    index.drop(conn)
+                    indexes.discard(index.name)
+                if index.name not in indexes:
+                    index.create(conn)
+
+        SearchService.create_index(conn)
+    return added
+
+
+def _rename_duplicates(conn, table: str, scope: str) -> int:
+    """
+    Give rows that share a name within their folder names of their own, "name (2)",
+    "name (3)"..., so a unique index can be built over them. The oldest row keeps
+    the name. Returns the number of rows renamed.
+    """
+    duplicates = conn.execute(text(
+        f"SELECT id, {scope} AS scope, name FROM {table} AS t WHERE EXISTS ("
+        f"SELECT 1 FROM {table} AS o WHERE o.{scope} = t.{scope} AND o.name = t.name AND o.id < t.id"
+        ") ORDER BY id"
+    )).all()
+    indexed = conn.execute(
+        text("SELECT 1 FROM sqlite_master WHERE name = :fts"), {"fts": f"{table}_fts"}
+    ).first() is not None
+    for row in duplicates:
+        # Files keep their extension; a dot in a folder name is part of the name
+        stem, extension = os.path.splitext(row.name) if table == "files" else (row.name, "")
+        number = 1
+        while True:
+            number += 1
+            candidate = f"{stem} ({number}){extension}"
+            if not conn.execute(
+                text(f"SELECT 1 FROM {table} WHERE {scope} = :scope AND name = :name"),
+                {"scope": row.scope, "name": candidate}
+            ).first():
+                break
+        conn.execute(text(f"UPDATE {table} SET name = :name WHERE id = :id"), {"name": candidate, "id": row.id})
+        if indexed:
+            conn.execute(text(f"UPDATE {table}_fts SET name = :name WHERE rowid = :id"), {"name": candidate, "id": row.id})
+        ChangeService.record(conn, table[:-1], [row.id])
+        print(f"Renamed {table} {row.id} from {row.name} to {candidate}: the name was taken in its folder")
+    return len(duplicates)
+
 
 def init_db(db: Session) -> None:
     # Create tables
     Base.metadata.create_all(bind=engine)
-    
+    added = sync_schema()
+
     # Check if root folder exists
     root_folder = db.query(Folder).filter(Folder.parent_id == None).first()
     if not root_folder:
         # Create root folder
         root_folder = Folder(
             name="Root",
-            path="/",
             storage_path=settings.STORAGE_DIR,
             parent_id=None
         )
         db.add(root_folder)
         db.commit()
-        
+
         # Create storage directory if it doesn't exist
         os.makedirs(settings.STORAGE_DIR, exist_ok=True)
+
+    # Index folders created before the closure table existed
+    linked = db.query(FolderClosure).filter(FolderClosure.depth == 0).count()
+    if linked != db.query(Folder).count():
+        FolderService.rebuild_closure(db)
+        FolderService.recompute_totals(db)
+    elif "folders.total_size" in added:
+        # Roll up folder totals for a catalog from before they were kept
+        FolderService.recompute_totals(db)
+
+    # Index names of files and folders created before the search index existed
+    SearchService.backfill(db)
@@ -1,12 +1,17 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-import os
 
 from app.api.api import api_router
 from app.core.config import settings
 from app.db.base import SessionLocal
 from app.db.init_db import init_db
+from app.services import storage_jobs  # noqa: F401 - registers the storage job handlers
+from app.services.cache_service import CacheService
+from app.services.change_service import ChangeService
+from app.services.job_service import JobService
+from app.services.thumbnail_service import ThumbnailService
+from app.services.upload_service import UploadService
+from app.services.watch_service import WatchService
 
 app = FastAPI(title=settings.PROJECT_NAME)
 
@@ -22,15 +27,24 @@ app.add_middleware(
 # Include API router
 app.include_router(api_router, prefix=settings.API_V1_STR)
 
-# Mount static files for file downloads
-if os.path.exists(settings.STORAGE_DIR):
-    app.mount("/files", StaticFiles(directory=settings.STORAGE_DIR), name="files")
-
 # Initialize database
 @app.on_event("startup")
 def startup_event():
     db = SessionLocal()
     try:
         init_db(db)
+        UploadService.cleanup_stale_sessions(db)
+        ChangeService.prune(db)
+        JobService.start(db)
     finally:
         db.close()
+    if settings.WATCH_ENABLED:
+        WatchService.start()
+
+
+@app.on_event("shutdown")
+def shutdown_event():
+    WatchService.shutdown()
+    JobService.shutdown()
+    ThumbnailService.shutdown()
+    CacheService.shutdown()
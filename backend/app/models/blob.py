@@ -0,0 +1,40 @@
+from sqlalchemy import Column, Integer, String, DateTime, BigInteger
+from sqlalchemy.orm import relationship
+from datetime import datetime
+from typing import Optional
+
+from app.db.base import Base
+from app.services.storage_backend import get_backend
+
+
+class Blob(Base):
+    __tablename__ = "blobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    sha256 = Column(String(64), unique=True, index=True, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    storage_key = Column(String, index=True, nullable=False)  # Location relative to the blob root
+    # "gzip" or "zstd" when the contents are stored compressed, "chunked" when they
+    # are stored as chunks, see BlobChunk, with nothing under the storage key
+    encoding = Column(String, nullable=True)
+    stored_size = Column(BigInteger, nullable=True)  # Bytes in storage when encoded, 0 for chunked
+    ref_count = Column(Integer, nullable=False, default=0, server_default="0", index=True)  # Files, versions and chunked blobs pointing here
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    # Relationship
+    files = relationship("File", back_populates="blob")
+
+    @property
+    def storage_path(self) -> Optional[str]:
+        """
+        Path of the stored object on a local disk, compressed if the contents are;
+        None when the storage backend is remote
+        """
+        return get_backend().local_path(self.storage_key)
+
+    @property
+    def stored_bytes(self) -> int:
+        return self.stored_size if self.encoding else self.size
+
+    def __repr__(self):
+        return f"<Blob {self.sha256}>"
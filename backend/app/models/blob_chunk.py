@@ -0,0 +1,21 @@
+from sqlalchemy import Column, Integer, ForeignKey, BigInteger
+
+from app.db.base import Base
+
+
+class BlobChunk(Base):
+    """
+    One row per chunk of a blob stored in content-defined chunks (encoding
+    "chunked"), in order. Each chunk is a blob of its own, so chunks shared by
+    versions of a file, or by different files, are stored once.
+    """
+    __tablename__ = "blob_chunks"
+
+    blob_id = Column(Integer, ForeignKey("blobs.id"), primary_key=True)
+    position = Column(Integer, primary_key=True)
+    offset = Column(BigInteger, nullable=False)  # Where the chunk starts in the blob's contents
+    size = Column(BigInteger, nullable=False)
+    chunk_id = Column(Integer, ForeignKey("blobs.id"), index=True, nullable=False)
+
+    def __repr__(self):
+        return f"<BlobChunk {self.blob_id}:{self.position}>"
@@ -0,0 +1,25 @@
+from sqlalchemy import Column, Integer, String, DateTime
+from datetime import datetime
+
+from app.db.base import Base
+
+
+class Change(Base):
+    """
+    An entry of the change journal: a file or folder was created, changed or
+    deleted. Entries only name the item; its state is read from the catalog
+    when the journal is read, so many changes to one item collapse into one.
+    The ID is the sync cursor and only ever grows.
+    """
+    __tablename__ = "changes"
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)  # "file" or "folder"
+    item_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+    # AUTOINCREMENT keeps IDs of pruned entries from being handed out again
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    def __repr__(self):
+        return f"<Change {self.id} {self.kind} {self.item_id}>"
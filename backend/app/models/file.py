@@ -1,7 +1,10 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, BigInteger
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, BigInteger, Index, func, literal_column
 from sqlalchemy.orm import relationship
 from datetime import datetime
+import posixpath
+from typing import Optional
 
+from app.core.config import settings
 from app.db.base import Base
 
 
@@ -10,16 +13,57 @@ class File(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, index=True)
-    path = Column(String, unique=True, index=True)
-    storage_path = Column(String, unique=True)  # Actual path on disk
+    storage_path = Column(String, unique=True, nullable=True)  # Path on disk for files not in the blob store
     mime_type = Column(String)
     size = Column(BigInteger)  # File size in bytes
-    folder_id = Column(Integer, ForeignKey("folders.id"))
+    content_hash = Column(String(64), index=True, nullable=True)  # SHA-256 of the contents
+    folder_id = Column(Integer, ForeignKey("folders.id"), index=True)
+    blob_id = Column(Integer, ForeignKey("blobs.id"), index=True, nullable=True)
+    version = Column(Integer, nullable=False, default=1, server_default="1")  # Number of the current version
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
-    # Relationship
+    # Composite indexes serve sorted, keyset-paginated folder listings
+    __table_args__ = (
+        Index("ix_files_folder_name", "folder_id", "name", unique=True),
+        Index("ix_files_folder_size", "folder_id", "size"),
+        Index("ix_files_folder_created", "folder_id", "created_at"),
+        Index("ix_files_folder_updated", "folder_id", "updated_at"),
+        # Covering indexes for the storage report's aggregates and largest files
+        Index("ix_files_size", "size"),
+        Index("ix_files_mime_size", "mime_type", "size"),
+    )
+
+    # Relationships
     folder = relationship("Folder", back_populates="files")
+    blob = relationship("Blob", back_populates="files")
+
+    @property
+    def path(self) -> str:
+        """
+        Virtual path, derived from the containing folder
+        """
+        return posixpath.join(self.folder.path, self.name)
+
+    @property
+    def content_path(self) -> Optional[str]:
+        """
+        Where the file's bytes live on disk; None for a blob in remote storage or
+        stored compressed, which is read through CompressionService
+        """
+        if self.blob is not None:
+            return self.blob.storage_path if not self.blob.encoding else None
+        return self.storage_path
+
+    @property
+    def download_url(self) -> str:
+        return f"{settings.API_V1_STR}/files/{self.id}/content"
 
     def __repr__(self):
         return f"<File {self.name}>"
+
+
+# "YYYY-MM" a file was added in. The arguments are literal rather than bound so
+# queries using this expression match its index.
+created_month = func.substr(File.created_at, literal_column("1"), literal_column("7"))
+Index("ix_files_created_month_size", created_month, File.size)
@@ -0,0 +1,27 @@
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, BigInteger, UniqueConstraint
+from datetime import datetime
+
+from app.db.base import Base
+
+
+class FileVersion(Base):
+    """
+    An earlier version of a file's contents. The current version lives on the
+    file itself; each version holds a reference to its blob.
+    """
+    __tablename__ = "file_versions"
+
+    id = Column(Integer, primary_key=True, index=True)
+    file_id = Column(Integer, ForeignKey("files.id"), nullable=False)
+    number = Column(Integer, nullable=False)  # 1 for the first upload, counting up
+    blob_id = Column(Integer, ForeignKey("blobs.id"), index=True, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    content_hash = Column(String(64), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)  # When this version was uploaded
+
+    __table_args__ = (
+        UniqueConstraint("file_id", "number"),
+    )
+
+    def __repr__(self):
+        return f"<FileVersion {self.file_id}@{self.number}>"
@@ -1,8 +1,11 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, BigInteger, Index, func, select, update
+from sqlalchemy.orm import relationship, object_session, Session
 from datetime import datetime
+from typing import Dict, List
 
 from app.db.base import Base
+from app.models.file import File
+from app.models.folder_closure import FolderClosure
 
 
 class Folder(Base):
@@ -10,11 +13,22 @@ class Folder(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, index=True)
-    path = Column(String, unique=True, index=True)  # Virtual path for API
-    storage_path = Column(String, unique=True)  # Actual path on disk
-    parent_id = Column(Integer, ForeignKey("folders.id"), nullable=True)
+    storage_path = Column(String, unique=True, nullable=True)  # Directory of folders from before the blob store
+    parent_id = Column(Integer, ForeignKey("folders.id"), nullable=True, index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Rolled up over the whole subtree and kept current by every change below it
+    total_size = Column(BigInteger, nullable=False, default=0, server_default="0")  # Bytes of all files
+    file_count = Column(Integer, nullable=False, default=0, server_default="0")
+    folder_count = Column(Integer, nullable=False, default=0, server_default="0")  # Not counting itself
+
+    # Composite indexes serve sorted, keyset-paginated folder listings
+    __table_args__ = (
+        Index("ix_folders_parent_name", "parent_id", "name", unique=True),
+        Index("ix_folders_parent_size", "parent_id", "total_size"),
+        Index("ix_folders_parent_created", "parent_id", "created_at"),
+        Index("ix_folders_parent_updated", "parent_id", "updated_at"),
+    )
 
     # Relationships
     files = relationship("File", back_populates="folder", cascade="all, delete-orphan")
@@ -22,5 +36,77 @@ class Folder(Base):
                         back_populates="parent",
                         cascade="all, delete-orphan")
     parent = relationship("Folder", back_populates="children", remote_side=[id])
+
+    @staticmethod
+    def path_of(db: Session, folder_id: int) -> str:
+        """
+        Virtual path of a folder, built from its ancestors' names in one query.
+        Paths are not stored, so renaming or moving a folder never touches its descendants.
+        """
+        names = db.execute(
+            select(Folder.name)
+            .join(FolderClosure, FolderClosure.ancestor_id == Folder.id)
+            .where(FolderClosure.descendant_id == folder_id)
+            .order_by(FolderClosure.depth.desc())
+        ).scalars().all()
+        # The top-level folder is the root "/" and does not appear in paths
+        return "/" + "/".join(names[1:])
+
+    @staticmethod
+    def paths_of(db: Session, folder_ids: List[int]) -> Dict[int, str]:
+        """
+        Virtual paths of several folders in one query
+        """
+        names: Dict[int, List[str]] = {folder_id: [] for folder_id in folder_ids}
+        if not names:
+            return {}
+        rows = db.execute(
+            select(FolderClosure.descendant_id, Folder.name)
+            .join(FolderClosure, FolderClosure.ancestor_id == Folder.id)
+            .where(FolderClosure.descendant_id.in_(names))
+            .order_by(FolderClosure.descendant_id, FolderClosure.depth.desc())
+        ).all()
+        for folder_id, name in rows:
+            names[folder_id].append(name)
+        return {folder_id: "/" + "/".join(parts[1:]) for folder_id, parts in names.items()}
+
+    @staticmethod
+    def adjust_totals(db: Session, folder_id: int, size: int = 0, files: int = 0, folders: int = 0) -> None:
+        """
+        Add to the rolled-up totals of a folder and each of its ancestors: one
+        UPDATE over depth + 1 rows. The caller commits.
+        """
+        if not (size or files or folders):
+            return
+        db.execute(
+            update(Folder)
+            .where(Folder.id.in_(select(FolderClosure.ancestor_id).where(FolderClosure.descendant_id == folder_id)))
+            .values(
+                total_size=Folder.total_size + size,
+                file_count=Folder.file_count + files,
+                folder_count=Folder.folder_count + folders
+            )
+            .execution_options(synchronize_session=False)
+        )
+
+    @staticmethod
+    def adjust_totals_for_files(db: Session, criteria, sign: int) -> None:
+        """
+        Add (sign 1) or remove (sign -1) the files matching the criteria to or from
+        the totals of their folders' ancestor chains, one UPDATE per folder involved.
+        Run it while the files exist: after inserting them, before deleting them.
+        """
+        rows = db.execute(
+            select(File.folder_id, func.count(File.id), func.coalesce(func.sum(File.size), 0))
+            .where(criteria)
+            .group_by(File.folder_id)
+        ).all()
+        for folder_id, count, size in rows:
+            Folder.adjust_totals(db, folder_id, size=sign * size, files=sign * count)
+
+    @property
+    def path(self) -> str:
+        return Folder.path_of(object_session(self), self.id)
+
     def __repr__(self):
         return f"<Folder {self.name}>"
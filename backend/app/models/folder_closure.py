@@ -0,0 +1,23 @@
+from sqlalchemy import Column, Integer, ForeignKey, Index
+
+from app.db.base import Base
+
+
+class FolderClosure(Base):
+    """
+    One row per (ancestor, descendant) pair of the folder tree, including each
+    folder paired with itself at depth 0, so subtree and ancestor queries are a
+    single indexed lookup instead of a walk over parent_id
+    """
+    __tablename__ = "folder_closure"
+
+    ancestor_id = Column(Integer, ForeignKey("folders.id"), primary_key=True)
+    descendant_id = Column(Integer, ForeignKey("folders.id"), primary_key=True)
+    depth = Column(Integer, nullable=False)  # Number of levels between the two folders
+
+    __table_args__ = (
+        Index("ix_folder_closure_descendant_depth", "descendant_id", "depth"),
+    )
+
+    def __repr__(self):
+        return f"<FolderClosure {self.ancestor_id}->{self.descendant_id}>"
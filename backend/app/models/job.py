@@ -0,0 +1,29 @@
+from sqlalchemy import Column, String, DateTime, BigInteger, Text, JSON
+from datetime import datetime
+
+from app.db.base import Base
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = Column(String(36), primary_key=True)  # uuid4, handed to the client
+    kind = Column(String, nullable=False)  # Name of the registered handler
+    status = Column(String, nullable=False, default="queued", index=True)  # queued, running, succeeded, failed, cancelled
+    params = Column(JSON, nullable=False, default=dict)
+    progress_done = Column(BigInteger, nullable=False, default=0)
+    progress_total = Column(BigInteger, nullable=True)  # Unknown until the job has looked at its work
+    message = Column(String, nullable=True)  # What the job is doing right now
+    result = Column(JSON, nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("succeeded", "failed", "cancelled")
+
+    def __repr__(self):
+        return f"<Job {self.kind} {self.id}>"
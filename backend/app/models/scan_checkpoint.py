@@ -0,0 +1,21 @@
+from sqlalchemy import Column, Integer, String, DateTime, BigInteger
+from datetime import datetime
+
+from app.db.base import Base
+
+
+class ScanCheckpoint(Base):
+    """
+    A storage directory as the last reconciliation found it consistent. While its
+    mtime and the number of catalog entries kept in it stay the same, the next
+    incremental scan skips listing it.
+    """
+    __tablename__ = "scan_checkpoints"
+
+    path = Column(String, primary_key=True)
+    mtime_ns = Column(BigInteger, nullable=False)
+    entry_count = Column(Integer, nullable=False)  # Blobs or files the catalog places in the directory
+    scanned_at = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<ScanCheckpoint {self.path}>"
@@ -0,0 +1,21 @@
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, BigInteger
+from datetime import datetime
+
+from app.db.base import Base
+
+
+class UploadSession(Base):
+    __tablename__ = "upload_sessions"
+
+    id = Column(String(36), primary_key=True)  # uuid4, handed to the client
+    folder_id = Column(Integer, ForeignKey("folders.id"), nullable=False)
+    filename = Column(String, nullable=False)
+    mime_type = Column(String)
+    total_size = Column(BigInteger, nullable=True)  # Declared size, if known up front
+    offset = Column(BigInteger, default=0)  # Bytes committed to the staging file
+    staging_path = Column(String, nullable=False)  # Partial file under STORAGE_DIR
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f"<UploadSession {self.id}>"
@@ -0,0 +1,62 @@
+from pydantic import BaseModel, Field
+from datetime import datetime
+from typing import List, Optional
+
+
+class Change(BaseModel):
+    type: str  # "file" or "folder"
+    id: int
+    deleted: Optional[bool] = None  # A deleted folder's files and subfolders are listed as deleted too
+    path: Optional[str] = None
+    folder_id: Optional[int] = None  # Files
+    parent_id: Optional[int] = None  # Folders
+    mime_type: Optional[str] = None
+    size: Optional[int] = None
+    content_hash: Optional[str] = None
+    version: Optional[int] = None
+    updated_at: Optional[datetime] = None
+
+
+class ChangePage(BaseModel):
+    cursor: int  # Pass as since to read on from here
+    has_more: bool  # More changes are waiting; read again at once
+    changes: List[Change]
+
+
+class ChangeCursor(BaseModel):
+    cursor: int
+
+
+class ManifestEntry(BaseModel):
+    path: str  # Relative to the folder compared with
+    size: int = Field(..., ge=0)
+    sha256: Optional[str] = None
+    base_sha256: Optional[str] = None  # The hash when last synced, so changes on either side are told apart
+
+
+class ManifestRequest(BaseModel):
+    folder_id: int
+    files: List[ManifestEntry]
+
+
+class ManifestUpload(BaseModel):
+    path: str
+    size: int
+    sha256: Optional[str] = None
+    id: Optional[int] = None  # The server's file, to replace with a new version
+
+
+class ManifestDownload(BaseModel):
+    path: str
+    id: int
+    size: int
+    content_hash: Optional[str] = None
+    download_url: str
+
+
+class ManifestResult(BaseModel):
+    cursor: int  # Follow changes from here once the transfers are done
+    upload: List[ManifestUpload]
+    download: List[ManifestDownload]
+    conflicts: List[ManifestDownload]  # Changed on both sides
+    unchanged_count: int
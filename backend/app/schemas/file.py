@@ -1,6 +1,6 @@
 from pydantic import BaseModel, Field
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 
 
 class FileBase(BaseModel):
@@ -38,6 +38,7 @@ class File(BaseModel):
     path: str
     created_at: datetime
     updated_at: datetime
+    version: int = 1
     download_url: str
     
     class Config:
@@ -46,3 +47,32 @@ class File(BaseModel):
     @classmethod
     def from_orm(cls, obj):
         return cls.model_validate(obj)
+
+
+class BatchUploadResult(BaseModel):
+    name: str
+    status: int  # HTTP status the file would have had as a single upload
+    file: Optional[File] = None
+    detail: Optional[str] = None
+
+
+class BatchUpload(BaseModel):
+    folder_id: int
+    created: int
+    failed: int
+    results: List[BatchUploadResult]
+
+
+class ArchiveRequest(BaseModel):
+    file_ids: List[int] = Field(..., min_length=1)
+    name: str = "download"  # Archive file name, without .zip
+
+
+class ThumbnailBatchRequest(BaseModel):
+    file_ids: List[int] = Field(..., max_length=500)
+    size: str = "small"
+
+
+class ThumbnailBatch(BaseModel):
+    thumbnails: Dict[int, str] = {}  # File id -> data: URI
+    missing: List[int] = []
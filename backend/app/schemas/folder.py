@@ -22,6 +22,9 @@ class FolderInDB(FolderBase):
     path: str
     created_at: datetime
     updated_at: datetime
+    total_size: int = 0  # Everything below the folder, not just its own files
+    file_count: int = 0
+    folder_count: int = 0
 
     class Config:
         from_attributes = True
@@ -31,6 +34,31 @@ class Folder(FolderInDB):
     pass
 
 
+class FolderTreeNode(Folder):
+    depth: int
+
+
+class FolderStats(BaseModel):
+    folder_id: int
+    folder_count: int
+    file_count: int
+    total_size: int
+
+
+class ImportFailure(BaseModel):
+    path: str
+    detail: str
+
+
+class ImportSummary(BaseModel):
+    folder_id: int
+    folders_created: int
+    files_created: int
+    skipped: int
+    errors: List[ImportFailure] = []  # First failures only; skipped has the full count
+    error: Optional[str] = None  # Set if the archive was unreadable past some point
+
+
 class FolderContents(Folder):
     files: List["File"] = []
     subfolders: List["Folder"] = []
@@ -0,0 +1,26 @@
+from pydantic import BaseModel
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+
+class JobCreate(BaseModel):
+    kind: str  # delete_folder, move_folder, archive_folder, rehash, reconcile, rebalance or migrate_storage
+    params: Dict[str, Any] = {}
+
+
+class Job(BaseModel):
+    id: str
+    kind: str
+    status: str
+    params: Dict[str, Any] = {}
+    progress_done: int = 0
+    progress_total: Optional[int] = None
+    message: Optional[str] = None
+    result: Optional[Any] = None
+    error: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
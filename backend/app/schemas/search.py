@@ -0,0 +1,22 @@
+from pydantic import BaseModel
+from datetime import datetime
+from typing import Optional, List
+
+
+class SearchResult(BaseModel):
+    kind: str  # "file" or "folder"
+    id: int
+    name: str
+    path: str
+    parent_id: Optional[int] = None
+    mime_type: Optional[str] = None
+    size: Optional[int] = None
+    updated_at: datetime
+    download_url: Optional[str] = None
+    snippet: Optional[str] = None  # Matching excerpt of a file's contents
+    rank: float
+
+
+class SearchResults(BaseModel):
+    results: List[SearchResult] = []
+    next_offset: Optional[int] = None
@@ -0,0 +1,63 @@
+from pydantic import BaseModel
+from typing import Optional, List
+
+
+class VolumeUsage(BaseModel):
+    path: str
+    total: int
+    used: int
+    free: int
+
+
+class CatalogTotals(BaseModel):
+    file_count: int
+    folder_count: int
+    logical_size: int  # Sum of file sizes, counting every copy
+    stored_size: int  # Bytes actually on disk after deduplication and compression
+    compression_saved_size: int  # Bytes compression keeps off the disk
+
+
+class SizeGroup(BaseModel):
+    key: Optional[str] = None  # Mime type or "YYYY-MM"; None for files without a type
+    file_count: int
+    total_size: int
+
+
+class FolderUsage(BaseModel):
+    id: Optional[int] = None  # None for the files directly in the root folder
+    name: str
+    path: str
+    file_count: int
+    total_size: int
+
+
+class LargeFile(BaseModel):
+    id: int
+    name: str
+    path: str
+    mime_type: Optional[str] = None
+    size: int
+
+
+class DuplicateCluster(BaseModel):
+    content_hash: str
+    size: int  # Of one copy
+    copies: int
+    reclaimable_size: int  # Logical size of all copies but one
+    paths: List[str] = []  # Some of the copies
+
+
+class DuplicateSummary(BaseModel):
+    cluster_count: int
+    reclaimable_size: int
+    largest: List[DuplicateCluster] = []
+
+
+class StorageReport(BaseModel):
+    volume: VolumeUsage
+    totals: CatalogTotals
+    by_type: List[SizeGroup] = []
+    by_month: List[SizeGroup] = []
+    by_folder: List[FolderUsage] = []
+    largest_files: List[LargeFile] = []
+    duplicates: DuplicateSummary
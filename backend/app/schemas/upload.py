@@ -0,0 +1,24 @@
+from pydantic import BaseModel
+from datetime import datetime
+from typing import Optional
+
+
+class UploadSessionCreate(BaseModel):
+    folder_id: int
+    filename: str
+    mime_type: Optional[str] = None
+    total_size: Optional[int] = None
+
+
+class UploadSession(BaseModel):
+    id: str
+    folder_id: int
+    filename: str
+    mime_type: Optional[str] = None
+    total_size: Optional[int] = None
+    offset: int = 0
+    created_at: datetime
+    updated_at: datetime
+
+    class Config:
+        from_attributes = True
@@ -0,0 +1,38 @@
+from pydantic import BaseModel, Field
+from datetime import datetime
+from typing import List, Optional
+
+
+class FileVersion(BaseModel):
+    number: int
+    size: int = 0
+    content_hash: Optional[str] = None
+    created_at: datetime
+    current: bool = False  # The file's contents as they are now
+
+
+class Chunk(BaseModel):
+    offset: int
+    size: int
+    sha256: str
+
+
+class VersionChunks(BaseModel):
+    number: int
+    size: int
+    content_hash: Optional[str] = None
+    min_size: int  # Chunk size limits, for clients cutting their copy the same way
+    average_size: int
+    max_size: int
+    chunks: List[Chunk]
+
+
+class DeltaChunk(BaseModel):
+    sha256: str
+    size: int = Field(..., gt=0)
+
+
+class DeltaManifest(BaseModel):
+    base_version: int  # Version whose chunks are reused; the others are sent as data, in order
+    sha256: Optional[str] = None  # Of the whole new contents, checked when given
+    chunks: List[DeltaChunk]
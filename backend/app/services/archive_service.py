@@ -0,0 +1,209 @@
+import io
+import mimetypes
+import os
+import posixpath
+import zipfile
+from collections import Counter
+from datetime import datetime
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+from typing import Iterable, Iterator, List, NamedTuple, Optional
+
+from app.core.config import settings
+from app.db.base import SessionLocal
+from app.models.file import File
+from app.models.folder import Folder
+from app.models.folder_closure import FolderClosure
+from app.services.compression_service import CompressionService
+
+# Formats that are compressed already; deflating them again costs CPU for nothing
+COMPRESSED_MIME_PREFIXES = (
+    "image/", "video/", "audio/",
+    "application/vnd.openxmlformats-officedocument.", "application/vnd.oasis.opendocument.",
+)
+COMPRESSED_MIME_TYPES = {
+    "application/zip", "application/gzip", "application/x-gzip", "application/x-bzip2",
+    "application/x-xz", "application/zstd", "application/x-7z-compressed", "application/vnd.rar",
+    "application/x-rar-compressed", "application/java-archive", "application/epub+zip", "application/pdf",
+}
+# Media types under the prefixes above that are stored raw and do compress
+UNCOMPRESSED_MEDIA_TYPES = {"image/svg+xml", "image/bmp", "image/x-ms-bmp", "image/tiff", "audio/wav", "audio/x-wav"}
+
+EARLIEST_ZIP_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+class ArchiveEntry(NamedTuple):
+    name: str  # Path inside the archive; directories end in "/"
+    path: Optional[str]  # Contents on disk, None for directories
+    mime_type: Optional[str]
+    modified: Optional[datetime]
+    storage_key: Optional[str] = None  # Blob in remote storage or compressed, read through the backend instead of path
+    encoding: Optional[str] = None  # The blob's compression
+    size: Optional[int] = None  # The blob's original size
+
+
+class _ChunkSink(io.RawIOBase):
+    """
+    Write-only stream that collects what zipfile writes until it is taken.
+    It cannot seek, so zipfile writes each entry's sizes after its data.
+    """
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ArchiveService:
+    @staticmethod
+    def compress_type(name: str, mime_type: Optional[str]) -> int:
+        """
+        Store already compressed formats as they are and deflate everything else.
+        Files without a specific type recorded are judged by their extension.
+        """
+        if not mime_type or mime_type == "application/octet-stream":
+            mime_type = mimetypes.guess_type(name)[0]
+        mime_type = (mime_type or "").lower()
+        if mime_type in UNCOMPRESSED_MEDIA_TYPES:
+            return zipfile.ZIP_DEFLATED
+        if mime_type in COMPRESSED_MIME_TYPES or mime_type.startswith(COMPRESSED_MIME_PREFIXES):
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    @staticmethod
+    def _zip_time(modified: Optional[datetime]):
+        if modified is None:
+            return EARLIEST_ZIP_TIME
+        return max(modified.timetuple()[:6], EARLIEST_ZIP_TIME)
+
+    @staticmethod
+    def _file_batches(criteria) -> Iterator[List[File]]:
+        """
+        Files matching the criteria in ID order, a batch per short-lived session, so
+        a long download never holds a read transaction open
+        """
+        last_id = 0
+        while True:
+            db = SessionLocal()
+            try:
+                files = db.scalars(
+                    select(File)
+                    .options(selectinload(File.blob))
+                    .where(criteria, File.id > last_id)
+                    .order_by(File.id)
+                    .limit(settings.ARCHIVE_BATCH_SIZE)
+                ).all()
+            finally:
+                db.close()
+            if not files:
+                return
+            yield files
+            last_id = files[-1].id
+
+    @staticmethod
+    def _entry(name: str, db_file: File) -> ArchiveEntry:
+        if db_file.blob is not None and db_file.content_path is None:
+            blob = db_file.blob
+            return ArchiveEntry(
+                name, None, db_file.mime_type, db_file.updated_at, blob.storage_key, blob.encoding, blob.size
+            )
+        return ArchiveEntry(name, db_file.content_path, db_file.mime_type, db_file.updated_at)
+
+    @staticmethod
+    def folder_entries(folder_id: int) -> Iterator[ArchiveEntry]:
+        """
+        Entries for a folder's whole subtree, under a directory named after the
+        folder. Empty subfolders are kept.
+        """
+        db = SessionLocal()
+        try:
+            rows = db.execute(
+                select(Folder.id, Folder.parent_id, Folder.name, Folder.updated_at)
+                .join(FolderClosure, FolderClosure.descendant_id == Folder.id)
+                .where(FolderClosure.ancestor_id == folder_id)
+                .order_by(FolderClosure.depth, Folder.name)
+            ).all()
+        finally:
+            db.close()
+
+        # Parents come before children, so each path extends one already built
+        paths = {}
+        for row in rows:
+            paths[row.id] = posixpath.join(paths.get(row.parent_id, ""), row.name) if row.id != folder_id else row.name
+            yield ArchiveEntry(paths[row.id] + "/", None, None, row.updated_at)
+
+        for files in ArchiveService._file_batches(File.folder_id.in_(
+            select(FolderClosure.descendant_id).where(FolderClosure.ancestor_id == folder_id)
+        )):
+            for db_file in files:
+                if db_file.folder_id not in paths:
+                    continue  # Its folder was created after the download started
+                yield ArchiveService._entry(posixpath.join(paths[db_file.folder_id], db_file.name), db_file)
+
+    @staticmethod
+    def selection_entries(file_ids: List[int]) -> Iterator[ArchiveEntry]:
+        """
+        Entries for a set of files, side by side at the top of the archive. Files
+        from different folders that share a name are numbered: "a.txt", "a (2).txt".
+        """
+        seen = Counter()
+        for files in ArchiveService._file_batches(File.id.in_(set(file_ids))):
+            for db_file in files:
+                name = db_file.name
+                seen[name] += 1
+                if seen[name] > 1:
+                    stem, extension = posixpath.splitext(name)
+                    name = f"{stem} ({seen[name]}){extension}"
+                yield ArchiveService._entry(name, db_file)
+
+    @staticmethod
+    def stream(entries: Iterable[ArchiveEntry]) -> Iterator[bytes]:
+        """
+        Build a zip archive on the fly, yielding it in chunks of about
+        UPLOAD_CHUNK_SIZE. Only one chunk of file data is held at a time and nothing
+        is written to disk. Zip64 records are used where sizes, offsets or the
+        number of entries call for them, so archives have no size limit.
+        Files whose contents are missing from storage are left out.
+        """
+        sink = _ChunkSink()
+        with zipfile.ZipFile(sink, "w", allowZip64=True) as archive:
+            for entry in entries:
+                info = zipfile.ZipInfo(entry.name, ArchiveService._zip_time(entry.modified))
+                if entry.path is None and entry.storage_key is None:
+                    archive.writestr(info, b"")
+                else:
+                    try:
+                        if entry.path is not None:
+                            source = open(entry.path, "rb")
+                            size = os.fstat(source.fileno()).st_size
+                        else:
+                            size = entry.size
+                            source = CompressionService.open(entry.storage_key, entry.encoding)
+                    except OSError as e:
+                        print(f"Leaving {entry.name} out of archive: {str(e)}")
+                        continue
+                    with source:
+                        info.compress_type = ArchiveService.compress_type(entry.name, entry.mime_type)
+                        info.external_attr = 0o644 << 16
+                        # The size decides up front whether the entry needs zip64 headers
+                        info.file_size = size
+                        with archive.open(info, "w") as target:
+                            while chunk := source.read(settings.UPLOAD_CHUNK_SIZE):
+                                target.write(chunk)
+                                data = sink.take()
+                                if data:
+                                    yield data
+                data = sink.take()
+                if data:
+                    yield data
+        yield sink.take()  # Central directory
@@ -0,0 +1,314 @@
+import hashlib
+import os
+import threading
+import uuid
+from collections import Counter
+from sqlalchemy import delete, event, func, select, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from typing import Dict, List, Optional, Set, Tuple
+
+from app.models.blob import Blob
+from app.models.blob_chunk import BlobChunk
+from app.models.file import File
+from app.models.folder import Folder
+from app.core.config import settings, data_path
+from app.db.base import RoutingSession
+from app.services.compression_service import CompressionService, DecompressionError
+from app.services.storage_backend import get_backend
+from app.services.upload_service import UploadService
+
+# Storage keys put by transactions that have not ended yet, by number of transactions
+_in_flight = Counter()
+_in_flight_lock = threading.Lock()
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _keep_new_objects(session):
+    _end_puts(session, rolled_back=False)
+
+
+@event.listens_for(RoutingSession, "after_transaction_end")
+def _remove_new_objects(session, transaction):
+    if transaction.parent is None:
+        _end_puts(session, rolled_back=True)
+
+
+def _end_puts(session, rolled_back: bool) -> None:
+    """
+    Once a transaction that put objects ends without committing, remove those
+    whose rows it inserted, unless another transaction has put the same key
+    meanwhile and may still record it. A commit runs first and leaves nothing.
+    """
+    keys = session.info.pop("blob_puts", None)
+    created = session.info.pop("blob_inserts", set())
+    if not keys:
+        return
+    with _in_flight_lock:
+        for key in keys:
+            _in_flight[key] -= 1
+            if _in_flight[key] <= 0:
+                del _in_flight[key]
+        if rolled_back:
+            for key in created:
+                if key not in _in_flight:
+                    get_backend().delete(key)
+
+
+class BlobService:
+    @staticmethod
+    def temp_path() -> str:
+        """
+        Scratch location for an incoming file. It sits next to the blob store so
+        promoting it into a blob is a rename rather than a copy.
+        """
+        path = data_path("tmp", uuid.uuid4().hex)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    @staticmethod
+    def storage_key(sha256: str) -> str:
+        return f"{sha256[:2]}/{sha256[2:4]}/{sha256}"
+
+    @staticmethod
+    def get_by_hash(db: Session, sha256: str) -> Optional[Blob]:
+        """
+        Get blob by content hash
+        """
+        return db.query(Blob).filter(Blob.sha256 == sha256).first()
+
+    @staticmethod
+    def placement_folder(db: Session, folder_id: Optional[int]) -> Optional[str]:
+        """
+        Name of the top-level folder a file is stored under, for storage that pins
+        folders to a disk
+        """
+        if folder_id is None or not settings.STORAGE_PINNED_FOLDERS:
+            return None
+        return Folder.path_of(db, folder_id).split("/")[1] or None
+
+    @staticmethod
+    def _compress(blob: Blob, staged_path: str, mime_type: Optional[str]) -> None:
+        """
+        Compress a new blob's staged contents if they are worth it, recording how
+        """
+        blob.encoding = CompressionService.compress(staged_path, blob.size, mime_type)
+        if blob.encoding:
+            blob.stored_size = os.path.getsize(staged_path)
+
+    @staticmethod
+    def store(
+        db: Session,
+        staged_path: str,
+        size: int,
+        sha256: str,
+        folder_id: Optional[int] = None,
+        mime_type: Optional[str] = None
+    ) -> Blob:
+        """
+        Take ownership of a staged file and return the blob holding its contents
+        with one more reference. If the content is already stored the staged copy is
+        discarded, so a duplicate costs no extra space; new contents of a
+        compressible type are compressed first. The caller commits.
+        """
+        blob = BlobService.get_by_hash(db, sha256)
+        if blob:
+            os.remove(staged_path)
+            blob.ref_count = Blob.ref_count + 1
+            db.flush()
+            db.refresh(blob)
+            return blob
+
+        blob = Blob(sha256=sha256, size=size, storage_key=BlobService.storage_key(sha256), ref_count=1)
+        BlobService._compress(blob, staged_path, mime_type)
+        BlobService._put(db, blob.storage_key, staged_path, BlobService.placement_folder(db, folder_id))
+
+        stored, inserted = BlobService.insert(db, [blob])
+        if inserted:
+            db.info.setdefault("blob_inserts", set()).add(blob.storage_key)
+        return stored[sha256]
+
+    @staticmethod
+    def _put(db: Session, key: str, staged_path: str, folder: Optional[str]) -> None:
+        """
+        Put a new blob's contents in storage. If the transaction then rolls back,
+        the object is removed again when the row recording it was inserted here.
+        """
+        with _in_flight_lock:
+            _in_flight[key] += 1
+        db.info.setdefault("blob_puts", []).append(key)
+        get_backend().put(key, staged_path, folder)
+
+    @staticmethod
+    def insert(db: Session, blobs: List[Blob]) -> Tuple[Dict[str, Blob], Set[str]]:
+        """
+        Record new blobs in one statement. The check for stored contents reads an
+        earlier snapshot than the insert, so an upload of the same bytes may have
+        recorded them meanwhile; its row then takes these references instead.
+        Returns the row for each SHA-256 and the SHA-256s inserted here. The
+        caller commits.
+        """
+        rows = [
+            {
+                "sha256": blob.sha256, "size": blob.size, "storage_key": blob.storage_key,
+                "ref_count": blob.ref_count, "encoding": blob.encoding, "stored_size": blob.stored_size,
+            }
+            for blob in blobs
+        ]
+        inserted = set(db.execute(
+            insert(Blob).on_conflict_do_nothing(index_elements=[Blob.sha256]).returning(Blob.sha256), rows
+        ).scalars())
+        for blob in blobs:
+            if blob.sha256 not in inserted:
+                db.execute(
+                    update(Blob).where(Blob.sha256 == blob.sha256).values(ref_count=Blob.ref_count + blob.ref_count)
+                )
+
+        stored = {
+            row.sha256: row
+            for row in db.query(Blob).filter(Blob.sha256.in_([blob.sha256 for blob in blobs])).populate_existing()
+        }
+        for blob in blobs:
+            if blob.sha256 not in inserted and blob.encoding != "chunked":
+                BlobService._settle(stored[blob.sha256], blob)
+        return stored, inserted
+
+    @staticmethod
+    def _settle(stored: Blob, lost: Blob) -> None:
+        """
+        Both uploads put their copy under the same key, and the later one is what
+        is there. Copies encoded alike are the same bytes; otherwise the row is
+        made to describe the copy in storage.
+        """
+        if stored.encoding == lost.encoding or stored.encoding == "chunked":
+            return
+        digest = hashlib.sha256()
+        try:
+            with CompressionService.open(stored.storage_key, stored.encoding) as source:
+                while chunk := source.read(settings.UPLOAD_CHUNK_SIZE):
+                    digest.update(chunk)
+        except (DecompressionError, OSError):
+            pass
+        if digest.hexdigest() != stored.sha256:
+            stored.encoding = lost.encoding
+            stored.stored_size = lost.stored_size
+
+    @staticmethod
+    def store_many(
+        db: Session, staged: List[Tuple[str, int, str, Optional[str]]], folder_id: Optional[int] = None
+    ) -> List[Blob]:
+        """
+        Batch counterpart of store for (staged path, size, sha256, mime type) entries. Already
+        stored contents are looked up in one query and new blobs are inserted
+        together. Returns the blob for each entry, in order. The caller commits.
+        """
+        references = Counter(sha256 for _, _, sha256, _ in staged)
+        blobs = {
+            blob.sha256: blob
+            for blob in db.query(Blob).filter(Blob.sha256.in_(list(references)))
+        }
+        for blob in blobs.values():
+            blob.ref_count = Blob.ref_count + references[blob.sha256]
+        folder = BlobService.placement_folder(db, folder_id)
+        
+        new = {}
+        for staged_path, size, sha256, mime_type in staged:
+            if sha256 in blobs or sha256 in new:
+                os.remove(staged_path)
+                continue
+            blob = Blob(
+                sha256=sha256, size=size, storage_key=BlobService.storage_key(sha256), ref_count=references[sha256]
+            )
+            BlobService._compress(blob, staged_path, mime_type)
+            BlobService._put(db, blob.storage_key, staged_path, folder)
+            new[sha256] = blob
+        
+        db.flush()
+        if new:
+            stored, inserted = BlobService.insert(db, list(new.values()))
+            blobs.update(stored)
+            db.info.setdefault("blob_inserts", set()).update(new[sha256].storage_key for sha256 in inserted)
+        return [blobs[sha256] for _, _, sha256, _ in staged]
+    
+    @staticmethod
+    def acquire(db: Session, blob_id: int) -> None:
+        """
+        Add a reference to a blob. The caller commits.
+        """
+        db.query(Blob).filter(Blob.id == blob_id).update(
+            {Blob.ref_count: Blob.ref_count + 1}, synchronize_session=False
+        )
+
+    @staticmethod
+    def release(db: Session, blob_id: int) -> List[str]:
+        """
+        Drop a reference to a blob, deleting its row once nothing points at it.
+        Returns the storage keys to remove after the caller commits.
+        """
+        db.query(Blob).filter(Blob.id == blob_id).update(
+            {Blob.ref_count: Blob.ref_count - 1}, synchronize_session=False
+        )
+        return BlobService.forget_unreferenced(db)
+
+    @staticmethod
+    def forget_unreferenced(db: Session) -> List[str]:
+        """
+        Delete the rows of blobs nothing points at any more. A chunked blob drops
+        its references to its chunks, which may free them in turn. Returns the
+        storage keys to remove after the caller commits.
+        """
+        released = []
+        while True:
+            unused = db.query(Blob.id, Blob.storage_key, Blob.encoding).filter(Blob.ref_count <= 0).all()
+            if not unused:
+                return released
+            chunked = [row.id for row in unused if row.encoding == "chunked"]
+            if chunked:
+                # A chunk used twice by a blob is referenced twice
+                db.execute(
+                    update(Blob)
+                    .where(Blob.id.in_(select(BlobChunk.chunk_id).where(BlobChunk.blob_id.in_(chunked))))
+                    .values(ref_count=Blob.ref_count - (
+                        select(func.count())
+                        .where(BlobChunk.chunk_id == Blob.id, BlobChunk.blob_id.in_(chunked))
+                        .scalar_subquery()
+                    ))
+                )
+                db.execute(delete(BlobChunk).where(BlobChunk.blob_id.in_(chunked)))
+            released.extend(row.storage_key for row in unused if row.encoding != "chunked")
+            db.execute(delete(Blob).where(Blob.id.in_([row.id for row in unused])))
+
+    @staticmethod
+    def adopt(db: Session, file: File) -> Blob:
+        """
+        Move a file stored outside the blob store into it. The caller commits.
+        """
+        if file.blob is not None:
+            return file.blob
+
+        size, sha256 = UploadService.hash_file(file.storage_path)
+        staged_path = BlobService.temp_path()
+        os.replace(file.storage_path, staged_path)
+        blob = BlobService.store(db, staged_path, size, sha256, file.folder_id, file.mime_type)
+
+        file.blob = blob
+        file.storage_path = None
+        file.content_hash = sha256
+        if size != file.size:
+            Folder.adjust_totals(db, file.folder_id, size=size - (file.size or 0))
+            file.size = size
+        return blob
+
+    @staticmethod
+    def remove_files(released: List[Optional[str]]) -> None:
+        """
+        Remove released contents once the transaction that released them committed:
+        blobs by storage key, files from before the blob store by absolute path
+        """
+        for location in released:
+            if not location:
+                continue
+            if not os.path.isabs(location):
+                get_backend().delete(location)
+            elif os.path.exists(location):
+                os.remove(location)
@@ -0,0 +1,319 @@
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone
+from functools import partial
+from typing import Any, BinaryIO, Callable, Dict, Optional, Tuple
+
+from app.core.config import settings
+from app.models.file import File
+from app.services.compression_service import CompressionService
+from app.services.storage_backend import ObjectInfo, get_backend
+
+# Uncached contents whose reads are counted for admission; beyond this the
+# counts are halved, so popularity fades when files stop being read
+FREQUENCY_SAMPLE = 10_000
+
+_entries: "OrderedDict[str, int]" = OrderedDict()  # Key -> size, least recently used first
+_cached_bytes: Optional[int] = None  # None until the cache directory has been scanned
+_frequency = Counter()  # Reads of uncached contents, by key
+_copying = set()  # Keys being copied in
+_pinned = Counter()  # Cached keys being served, by number of downloads; eviction passes over them
+_metrics = Counter()
+_lock = threading.Lock()
+_pool: Optional[ThreadPoolExecutor] = None
+
+
+def _release_nothing() -> None:
+    pass
+
+
+class CacheService:
+    """
+    Read cache on fast local disk, such as the internal SSD, in front of
+    STORAGE_DIR on the external drive. Contents are copied in on their
+    CACHE_ADMIT_READS-th read, so one-off downloads do not push out files that
+    are read again and again, and the least recently used are evicted past
+    CACHE_MAX_BYTES. Writes go to the drive only (write-through): the cache never
+    holds the only copy, and losing it loses nothing.
+
+    Blobs are cached by content hash, so a cached copy can never be stale; with
+    remote storage (STORAGE_BACKEND "s3") the cache is what makes them local.
+    Compressed blobs are cached decompressed, ready to serve with sendfile.
+    Files from before the blob store are cached by ID, size and mtime, so a file
+    changed in place is simply missed and copied again.
+    """
+
+    @staticmethod
+    def enabled() -> bool:
+        return bool(settings.CACHE_DIR) and settings.CACHE_MAX_BYTES > 0
+
+    @staticmethod
+    def root() -> str:
+        return os.path.join(settings.CACHE_DIR, "files")
+
+    @staticmethod
+    def _path(key: str) -> str:
+        return os.path.join(CacheService.root(), key[:2], key)
+
+    @staticmethod
+    def _key(file: File, stat: Optional[os.stat_result] = None) -> Optional[str]:
+        if file.blob is not None:
+            return file.blob.sha256
+        if stat is None:
+            return None
+        return f"file{file.id}-{stat.st_size:x}-{stat.st_mtime_ns:x}"
+
+    @staticmethod
+    def _load() -> None:
+        """
+        Index what an earlier run left in the cache, least recently used first.
+        Called with the lock held.
+        """
+        global _cached_bytes
+        found = []
+        if os.path.isdir(CacheService.root()):
+            for shard in os.scandir(CacheService.root()):
+                if not shard.is_dir():
+                    continue
+                for entry in os.scandir(shard.path):
+                    if entry.name.endswith(".part"):
+                        os.remove(entry.path)  # Copy interrupted by a shutdown
+                        continue
+                    stat = entry.stat()
+                    found.append((stat.st_atime_ns, entry.name, stat.st_size))
+        _entries.clear()
+        _entries.update((key, size) for _, key, size in sorted(found))
+        _cached_bytes = sum(_entries.values())
+
+    @staticmethod
+    def _lookup(key: str, pin: bool = False) -> Optional[str]:
+        """
+        Path of a cached copy, marking it recently used, and optionally pinning it
+        against eviction until _unpin
+        """
+        with _lock:
+            if _cached_bytes is None:
+                CacheService._load()
+            if key not in _entries:
+                return None
+            _entries.move_to_end(key)
+            if pin:
+                _pinned[key] += 1
+        return CacheService._path(key)
+
+    @staticmethod
+    def _unpin(key: str) -> None:
+        with _lock:
+            _pinned[key] -= 1
+            if _pinned[key] <= 0:
+                del _pinned[key]
+
+    @staticmethod
+    def _source(file: File) -> Tuple[Optional[str], Any]:
+        """
+        The stored copy's local path, None for a blob kept in remote storage or
+        compressed, and its stat, which gives a compressed blob's original size
+        """
+        if file.blob is not None and file.blob.encoding == "chunked":
+            # Nothing is stored under a chunked blob's key; its chunks are read in turn
+            created = file.blob.created_at.replace(tzinfo=timezone.utc).timestamp()
+            return None, ObjectInfo(file.blob.size, int(created * 1_000_000_000))
+        if file.blob is not None:
+            stat = get_backend().stat(file.blob.storage_key)
+            if file.blob.encoding:
+                stat = ObjectInfo(file.blob.size, stat.st_mtime_ns)
+            return file.content_path, stat
+        return file.storage_path, os.stat(file.storage_path)
+
+    @staticmethod
+    def _reader(file: File) -> Callable[[], BinaryIO]:
+        if file.blob is not None:
+            return partial(CompressionService.open, file.blob.storage_key, file.blob.encoding)
+        return partial(open, file.storage_path, "rb")
+
+    @staticmethod
+    def open(file: File) -> Tuple[Optional[str], Any, Callable[[], None]]:
+        """
+        Where to read a file's contents from, with its stat, for a download: the
+        cached copy when there is one, the stored copy otherwise, or None for a
+        blob to stream from remote storage or to decompress. Counts the read toward copying the
+        contents into the cache. Raises FileNotFoundError when the contents are
+        missing.
+
+        A cached copy is pinned so eviction cannot remove it while it is served;
+        the returned function releases it and must be called once the response
+        is done with the path.
+        """
+        if not CacheService.enabled():
+            return (*CacheService._source(file), _release_nothing)
+
+        # Blobs are found without touching storage; other files need their stat for the key
+        stat = None if file.blob is not None else os.stat(file.storage_path)
+        key = CacheService._key(file, stat)
+        path = CacheService._lookup(key, pin=True)
+        if path is not None:
+            try:
+                cached = os.stat(path)
+                # atime orders the cache by recency across restarts; mtime stays the original's
+                os.utime(path, ns=(time.time_ns(), cached.st_mtime_ns))
+                with _lock:
+                    _metrics["hits"] += 1
+                return path, cached, partial(CacheService._unpin, key)
+            except FileNotFoundError:
+                CacheService._unpin(key)
+                CacheService._forget(key)
+
+        path, stat = CacheService._source(file) if stat is None else (file.storage_path, stat)
+        with _lock:
+            _metrics["misses"] += 1
+        CacheService._admit(key, CacheService._reader(file), stat)
+        return path, stat, _release_nothing
+
+    @staticmethod
+    def local_path(file: File) -> Optional[str]:
+        """
+        A local path to read a file's contents from without counting toward
+        admission, e.g. to render thumbnails: the cached copy of a blob if there is
+        one, else the stored copy. A blob in remote storage or stored compressed
+        is fetched into the cache first, and has no local path without one.
+        """
+        if file.blob is None:
+            return file.storage_path
+        key = CacheService._key(file)
+        path = CacheService._lookup(key) if CacheService.enabled() else None
+        if path is not None:
+            return path
+        path = file.content_path
+        if path is not None or not CacheService.enabled():
+            return path
+        try:
+            _, stat = CacheService._source(file)
+        except FileNotFoundError:
+            return None
+        CacheService._copy_in(key, CacheService._reader(file), stat)
+        return CacheService._lookup(key)
+
+    @staticmethod
+    def _admit(key: str, read: Callable[[], BinaryIO], stat) -> None:
+        global _pool
+        with _lock:
+            if stat.st_size > settings.CACHE_MAX_FILE_SIZE or stat.st_size > settings.CACHE_MAX_BYTES:
+                _metrics["too_large"] += 1
+                return
+            if key in _copying:
+                return
+            _frequency[key] += 1
+            if _frequency[key] < settings.CACHE_ADMIT_READS:
+                if len(_frequency) > FREQUENCY_SAMPLE:
+                    for counted, reads in list(_frequency.items()):
+                        if reads > 1:
+                            _frequency[counted] = reads // 2
+                        else:
+                            del _frequency[counted]
+                return
+            del _frequency[key]
+            _copying.add(key)
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=settings.CACHE_WORKERS, thread_name_prefix="cache")
+            _pool.submit(CacheService._copy_in, key, read, stat)
+
+    @staticmethod
+    def _copy_in(key: str, read: Callable[[], BinaryIO], stat) -> None:
+        """
+        Copy contents from storage into the cache, making room first
+        """
+        global _cached_bytes
+        size = stat.st_size
+        path = CacheService._path(key)
+        partial_path = f"{path}.{threading.get_ident()}.part"
+        try:
+            with _lock:
+                # Least recently used first, passing over entries being served
+                for evicted in list(_entries):
+                    if _cached_bytes + size <= settings.CACHE_MAX_BYTES:
+                        break
+                    if evicted in _pinned:
+                        continue
+                    evicted_size = _entries.pop(evicted)
+                    _cached_bytes -= evicted_size
+                    _metrics["evictions"] += 1
+                    _metrics["evicted_bytes"] += evicted_size
+                    try:
+                        os.remove(CacheService._path(evicted))
+                    except FileNotFoundError:
+                        pass
+                if _cached_bytes + size > settings.CACHE_MAX_BYTES:
+                    return  # No room until the downloads pinning the rest finish
+                _cached_bytes += size  # Reserved while copying
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            copied = 0
+            with read() as src, open(partial_path, "wb") as dst:
+                while chunk := src.read(settings.UPLOAD_CHUNK_SIZE):
+                    dst.write(chunk)
+                    copied += len(chunk)
+            if copied != size:
+                raise ValueError("contents changed since they were read")
+            # Keep the original's mtime, which downloads report as Last-Modified
+            os.utime(partial_path, ns=(time.time_ns(), stat.st_mtime_ns))
+            os.replace(partial_path, path)
+            with _lock:
+                _entries[key] = size
+                _metrics["admissions"] += 1
+                _metrics["admitted_bytes"] += size
+        except Exception as e:
+            with _lock:
+                _cached_bytes -= size
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            print(f"Error caching {key}: {str(e)}")
+        finally:
+            with _lock:
+                _copying.discard(key)
+
+    @staticmethod
+    def _forget(key: str) -> None:
+        global _cached_bytes
+        with _lock:
+            size = _entries.pop(key, None)
+            if size is not None:
+                _cached_bytes -= size
+
+    @staticmethod
+    def shutdown() -> None:
+        """
+        Stop copying; copies in progress are abandoned and their partial files removed on the next start
+        """
+        global _pool
+        with _lock:
+            pool, _pool = _pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def stats() -> Dict[str, Any]:
+        """
+        Hit and miss counts of downloads since the server started, and what the cache holds
+        """
+        with _lock:
+            if CacheService.enabled() and _cached_bytes is None:
+                CacheService._load()
+            reads = _metrics["hits"] + _metrics["misses"]
+            return {
+                "enabled": CacheService.enabled(),
+                "directory": settings.CACHE_DIR,
+                "max_bytes": settings.CACHE_MAX_BYTES,
+                "cached_bytes": _cached_bytes or 0,
+                "entries": len(_entries),
+                "copying": len(_copying),
+                "hit_ratio": _metrics["hits"] / reads if reads else None,
+                **{
+                    name: _metrics[name]
+                    for name in (
+                        "hits", "misses", "admissions", "admitted_bytes", "evictions", "evicted_bytes", "too_large"
+                    )
+                },
+            }
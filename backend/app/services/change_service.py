@@ -0,0 +1,204 @@
+import posixpath
+from datetime import datetime, timedelta
+from sqlalchemy import Select, delete, func, insert, literal, select, text
+from sqlalchemy.orm import Session
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+from app.core.config import settings
+from app.models.change import Change
+from app.models.file import File
+from app.models.folder import Folder
+from app.models.folder_closure import FolderClosure
+
+
+class CursorExpired(Exception):
+    """
+    Raised for a cursor the journal cannot continue from: its entries have been
+    pruned, or it was handed out by another database
+    """
+
+
+class ChangeService:
+    """
+    The change journal sync clients follow. Every change to a file or folder
+    appends an entry in the transaction that makes it, so a client holding a
+    cursor reads only what changed since, however large the tree. Entries are
+    written through the single writer connection, so they commit in cursor
+    order and a reader never skips one committed late.
+    """
+
+    @staticmethod
+    def record(db: Session, kind: str, item_ids: Union[Iterable[int], Select]) -> None:
+        """
+        Journal changes to files or folders, given by ID or by a select of IDs.
+        Run it while deleted items still exist. The caller commits.
+        """
+        if isinstance(item_ids, Select):
+            db.execute(insert(Change).from_select(
+                ["kind", "item_id", "created_at"],
+                select(literal(kind), item_ids.subquery().c[0], literal(datetime.utcnow()))
+            ))
+            return
+        rows = [{"kind": kind, "item_id": item_id} for item_id in item_ids]
+        if rows:
+            db.execute(insert(Change), rows)
+
+    @staticmethod
+    def latest(db: Session) -> int:
+        """
+        Cursor of the newest entry, 0 before the first. Read from the
+        AUTOINCREMENT counter, which outlives pruned entries.
+        """
+        return db.execute(text("SELECT seq FROM sqlite_sequence WHERE name = 'changes'")).scalar() or 0
+
+    @staticmethod
+    def read(db: Session, since: int, limit: Optional[int] = None) -> Dict[str, Any]:
+        """
+        What changed after a cursor: the current state of each file and folder
+        changed, or that it was deleted, with the cursor to continue from. Items
+        changed several times appear once. Raises CursorExpired when the entries
+        after the cursor are no longer all kept.
+        """
+        limit = min(limit or settings.CHANGES_PAGE_SIZE, settings.CHANGES_PAGE_SIZE)
+        latest = ChangeService.latest(db)
+        oldest = db.scalar(select(func.min(Change.id)))
+        if since > latest or since < (oldest if oldest is not None else latest + 1) - 1:
+            raise CursorExpired(f"Changes after {since} are no longer kept; compare a manifest again")
+
+        rows = db.execute(
+            select(Change.id, Change.kind, Change.item_id).where(Change.id > since).order_by(Change.id).limit(limit + 1)
+        ).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        # Latest change per item, in the order of those changes
+        items: Dict[tuple, int] = {}
+        for row in rows:
+            items.pop((row.kind, row.item_id), None)
+            items[(row.kind, row.item_id)] = row.id
+        file_ids = [item_id for kind, item_id in items if kind == "file"]
+        folder_ids = [item_id for kind, item_id in items if kind == "folder"]
+        files = {file.id: file for file in db.query(File).filter(File.id.in_(file_ids))}
+        folders = {folder.id: folder for folder in db.query(Folder).filter(Folder.id.in_(folder_ids))}
+        paths = Folder.paths_of(db, list(set(folders) | {file.folder_id for file in files.values()}))
+
+        changes = []
+        for kind, item_id in items:
+            if kind == "file" and item_id in files:
+                file = files[item_id]
+                changes.append({
+                    "type": "file",
+                    "id": file.id,
+                    "path": posixpath.join(paths[file.folder_id], file.name),
+                    "folder_id": file.folder_id,
+                    "mime_type": file.mime_type,
+                    "size": file.size or 0,
+                    "content_hash": file.content_hash,
+                    "version": file.version,
+                    "updated_at": file.updated_at,
+                })
+            elif kind == "folder" and item_id in folders:
+                folder = folders[item_id]
+                changes.append({
+                    "type": "folder",
+                    "id": folder.id,
+                    "path": paths[folder.id],
+                    "parent_id": folder.parent_id,
+                    "updated_at": folder.updated_at,
+                })
+            else:
+                changes.append({"type": kind, "id": item_id, "deleted": True})
+
+        return {"cursor": rows[-1].id if rows else since, "has_more": has_more, "changes": changes}
+
+    @staticmethod
+    def prune(db: Session) -> int:
+        """
+        Drop entries older than CHANGES_RETENTION. Returns the number dropped.
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=settings.CHANGES_RETENTION)
+        pruned = db.execute(delete(Change).where(Change.created_at < cutoff)).rowcount
+        db.commit()
+        return pruned
+
+    @staticmethod
+    def _relative(path: str) -> str:
+        """
+        A client path in the form paths are compared in: relative, with forward slashes
+        """
+        parts = [part for part in path.replace("\\", "/").split("/") if part not in ("", ".")]
+        if not parts or ".." in parts:
+            raise ValueError(f"Manifest path {path!r} must name a file below the folder")
+        return "/".join(parts)
+
+    @staticmethod
+    def compare_manifest(db: Session, folder_id: int, entries: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Compare a client's list of files below a folder, as relative path, size and
+        optionally SHA-256, with the folder's subtree. Returns the files to upload
+        and to download, those changed on both sides, and the cursor to follow
+        changes from afterwards. A client sending the hash each file had when last
+        synced (base_sha256) gets changed files sorted by which side changed them;
+        without it they count as conflicts. Raises ValueError for an unknown folder.
+        """
+        folder = db.query(Folder).filter(Folder.id == folder_id).first()
+        if not folder:
+            raise ValueError("Folder not found")
+        # Read in the same snapshot as the listing, so changes made meanwhile are after it
+        cursor = ChangeService.latest(db)
+
+        subtree = select(FolderClosure.descendant_id).where(FolderClosure.ancestor_id == folder_id)
+        rows = db.execute(
+            select(File.id, File.folder_id, File.name, File.size, File.content_hash)
+            .where(File.folder_id.in_(subtree))
+        ).all()
+        paths = Folder.paths_of(db, list({row.folder_id for row in rows} | {folder_id}))
+        server = {
+            posixpath.relpath(posixpath.join(paths[row.folder_id], row.name), paths[folder_id]): row for row in rows
+        }
+
+        upload, download, conflicts = [], [], []
+        unchanged = 0
+        seen = set()
+        for entry in entries:
+            path = ChangeService._relative(entry["path"])
+            if path in seen:
+                raise ValueError(f"{path} is listed more than once")
+            seen.add(path)
+            sha256 = (entry.get("sha256") or "").lower() or None
+            base = (entry.get("base_sha256") or "").lower() or None
+            row = server.get(path)
+            if row is None:
+                upload.append({"path": path, "size": entry["size"], "sha256": sha256})
+                continue
+            if sha256 and row.content_hash:
+                same = sha256 == row.content_hash
+            else:
+                same = entry["size"] == (row.size or 0)
+            if same:
+                unchanged += 1
+            elif base and row.content_hash == base:
+                upload.append({"path": path, "size": entry["size"], "sha256": sha256, "id": row.id})
+            elif base and sha256 == base:
+                download.append(ChangeService._server_file(path, row))
+            else:
+                conflicts.append(ChangeService._server_file(path, row))
+
+        download.extend(ChangeService._server_file(path, row) for path, row in server.items() if path not in seen)
+        return {
+            "cursor": cursor,
+            "upload": upload,
+            "download": download,
+            "conflicts": conflicts,
+            "unchanged_count": unchanged,
+        }
+
+    @staticmethod
+    def _server_file(path: str, row) -> Dict[str, Any]:
+        return {
+            "path": path,
+            "id": row.id,
+            "size": row.size or 0,
+            "content_hash": row.content_hash,
+            "download_url": f"{settings.API_V1_STR}/files/{row.id}/content",
+        }
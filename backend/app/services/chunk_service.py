@@ -0,0 +1,300 @@
+import bisect
+import hashlib
+import io
+import os
+import zlib
+from collections import Counter
+from sqlalchemy import insert, select, update
+from sqlalchemy.orm import Session, aliased
+from typing import Any, BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from app.core.config import settings
+from app.db.base import SessionLocal
+from app.models.blob import Blob
+from app.models.blob_chunk import BlobChunk
+from app.services.blob_service import BlobService
+from app.services.compression_service import CompressionService
+
+# Content-defined chunking. Each byte value is marked or not by a fixed table;
+# a run of ANCHOR_RUN marked bytes is a candidate cut, found with bytes.find
+# rather than a Python loop per byte, and a candidate is taken when the CRC-32
+# of the CHUNK_WINDOW bytes before it has its low bits clear. Cuts depend only
+# on the bytes around them, so an edit changes the chunks it touches and the
+# rest line up with the previous version's again.
+ANCHOR_RUN = 8
+CHUNK_WINDOW = 64
+# Marked when the first byte of the value's SHA-256 is odd; never 0x00 or 0xff,
+# which fill padding and sparse regions
+MARKS = bytes(
+    1 if value not in (0x00, 0xff) and hashlib.sha256(bytes([value])).digest()[0] & 1 else 0
+    for value in range(256)
+)
+ANCHOR = b"\x01" * ANCHOR_RUN
+
+
+class ChunkPart(NamedTuple):
+    offset: int
+    size: int
+    storage_key: str
+    encoding: Optional[str]
+
+
+class _Chunked(io.RawIOBase):
+    """
+    Read stream of a chunked blob's contents, opening one chunk at a time
+    """
+
+    def __init__(self, parts: List[ChunkPart]):
+        self._parts = iter(parts)
+        self._current: Optional[BinaryIO] = None
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        while True:
+            if self._current is None:
+                part = next(self._parts, None)
+                if part is None:
+                    return b""
+                self._current = CompressionService.open(part.storage_key, part.encoding)
+            data = self._current.read(size)
+            if data:
+                return data
+            self._current.close()
+            self._current = None
+
+    def close(self) -> None:
+        if not self.closed and self._current is not None:
+            self._current.close()
+        super().close()
+
+
+class ChunkService:
+    """
+    Blobs stored as content-defined chunks (encoding "chunked"). Versions of a
+    large file are mostly the same bytes, so storing each as a list of chunk
+    blobs keeps one copy of what they share and a new version only adds the
+    chunks that changed. Nothing is stored under a chunked blob's own key; its
+    chunks are blobs of their own, compressed where worth it, and are read in
+    order through BlobChunk.
+    """
+
+    @staticmethod
+    def limits() -> Tuple[int, int, int]:
+        """
+        Smallest, average and largest chunk size
+        """
+        average = settings.VERSION_CHUNK_SIZE
+        return average // 4, average, average * 4
+
+    @staticmethod
+    def _cut(buffer: bytearray) -> int:
+        """
+        Length of the chunk at the start of the buffer, which holds at least the
+        largest chunk size unless the contents end sooner
+        """
+        minimum, average, maximum = ChunkService.limits()
+        if len(buffer) <= minimum:
+            return len(buffer)
+        # Candidates come about every 2 ** ANCHOR_RUN bytes; the CRC picks one in this many
+        mask = (1 << max(((average - minimum) >> ANCHOR_RUN).bit_length() - 1, 0)) - 1
+        marks = buffer[:maximum].translate(MARKS)
+        position = max(minimum - ANCHOR_RUN, CHUNK_WINDOW - ANCHOR_RUN)
+        while True:
+            found = marks.find(ANCHOR, position)
+            if found < 0:
+                return min(len(buffer), maximum)
+            end = found + ANCHOR_RUN
+            if not zlib.crc32(buffer[end - CHUNK_WINDOW:end]) & mask:
+                return end
+            position = found + 1
+
+    @staticmethod
+    def split(source: BinaryIO) -> Iterator[bytes]:
+        """
+        Cut a stream into content-defined chunks
+        """
+        _, _, maximum = ChunkService.limits()
+        buffer = bytearray()
+        ended = False
+        while True:
+            while not ended and len(buffer) < maximum:
+                data = source.read(maximum - len(buffer))
+                if data:
+                    buffer += data
+                else:
+                    ended = True
+            if not buffer:
+                return
+            cut = ChunkService._cut(buffer)
+            yield bytes(buffer[:cut])
+            del buffer[:cut]
+
+    @staticmethod
+    def chunkable(size: int) -> bool:
+        """
+        Whether contents are large enough to store as chunks. Always more than
+        the largest chunk, so a chunk is never itself a chunked blob.
+        """
+        return size >= max(settings.VERSION_CHUNK_MIN_SIZE, ChunkService.limits()[2] + 1)
+
+    @staticmethod
+    def _store_chunks(
+        db: Session, source: BinaryIO, folder_id: Optional[int], mime_type: Optional[str]
+    ) -> List[Tuple[int, int]]:
+        """
+        Store the chunks of a stream that are not stored already, and take a
+        reference to each. Returns (blob ID, size) per chunk, in order.
+        """
+        chunks = []
+        for data in ChunkService.split(source):
+            sha256 = hashlib.sha256(data).hexdigest()
+            blob = BlobService.get_by_hash(db, sha256)
+            if blob is not None:
+                BlobService.acquire(db, blob.id)
+            else:
+                staged_path = BlobService.temp_path()
+                with open(staged_path, "wb") as staged:
+                    staged.write(data)
+                blob = BlobService.store(db, staged_path, len(data), sha256, folder_id, mime_type)
+            chunks.append((blob.id, len(data)))
+        return chunks
+
+    @staticmethod
+    def _link(db: Session, blob: Blob, chunks: List[Tuple[int, int]]) -> None:
+        rows = []
+        offset = 0
+        for position, (chunk_id, size) in enumerate(chunks):
+            rows.append({"blob_id": blob.id, "position": position, "offset": offset, "size": size, "chunk_id": chunk_id})
+            offset += size
+        if rows:
+            db.execute(insert(BlobChunk), rows)
+
+    @staticmethod
+    def store(
+        db: Session,
+        staged_path: str,
+        size: int,
+        sha256: str,
+        folder_id: Optional[int] = None,
+        mime_type: Optional[str] = None
+    ) -> Blob:
+        """
+        Counterpart of BlobService.store that keeps new contents as chunks,
+        sharing those already stored. Takes ownership of the staged file. The
+        caller commits.
+        """
+        if BlobService.get_by_hash(db, sha256) is not None or not ChunkService.chunkable(size):
+            return BlobService.store(db, staged_path, size, sha256, folder_id, mime_type)
+
+        with open(staged_path, "rb") as source:
+            chunks = ChunkService._store_chunks(db, source, folder_id, mime_type)
+        os.remove(staged_path)
+
+        blob = Blob(
+            sha256=sha256, size=size, storage_key=BlobService.storage_key(sha256), ref_count=1,
+            encoding="chunked", stored_size=0
+        )
+        stored, inserted = BlobService.insert(db, [blob])
+        if sha256 not in inserted:
+            # The same contents were stored meanwhile and that blob holds them, so the
+            # chunk references go back. Only chunks new in this transaction can drop
+            # to none, and nothing else has seen them.
+            for chunk_id, count in Counter(chunk_id for chunk_id, _ in chunks).items():
+                db.execute(update(Blob).where(Blob.id == chunk_id).values(ref_count=Blob.ref_count - count))
+            BlobService.remove_files(BlobService.forget_unreferenced(db))
+            return stored[sha256]
+        ChunkService._link(db, stored[sha256], chunks)
+        return stored[sha256]
+
+    @staticmethod
+    def convert(db: Session, blob: Blob, folder_id: Optional[int] = None, mime_type: Optional[str] = None) -> List[str]:
+        """
+        Keep a blob stored whole as chunks from now on, so later versions can
+        share them. Returns the storage key of the whole copy, to remove once
+        the caller commits; until then readers still find it.
+        """
+        if blob.encoding == "chunked" or not ChunkService.chunkable(blob.size):
+            return []
+        with CompressionService.open(blob.storage_key, blob.encoding) as source:
+            chunks = ChunkService._store_chunks(db, source, folder_id, mime_type)
+        ChunkService._link(db, blob, chunks)
+        blob.encoding = "chunked"
+        blob.stored_size = 0
+        return [blob.storage_key]
+
+    @staticmethod
+    def parts(key: str) -> List[ChunkPart]:
+        """
+        Where the chunks of a chunked blob are, in order, on a session of its own
+        """
+        parent = aliased(Blob)
+        chunk = aliased(Blob)
+        db = SessionLocal()
+        try:
+            rows = db.execute(
+                select(BlobChunk.offset, BlobChunk.size, chunk.storage_key, chunk.encoding)
+                .join(parent, parent.id == BlobChunk.blob_id)
+                .join(chunk, chunk.id == BlobChunk.chunk_id)
+                .where(parent.storage_key == key)
+                .order_by(BlobChunk.position)
+            ).all()
+        finally:
+            db.close()
+        if not rows:
+            raise FileNotFoundError(f"No chunks recorded for {key}")
+        return [ChunkPart(*row) for row in rows]
+
+    @staticmethod
+    def open(key: str) -> BinaryIO:
+        return _Chunked(ChunkService.parts(key))
+
+    @staticmethod
+    def iter_range(key: str, start: int, end: int) -> Iterator[bytes]:
+        """
+        Read an inclusive byte range, starting at the chunk that holds its first byte
+        """
+        parts = ChunkService.parts(key)
+        index = bisect.bisect_right([part.offset for part in parts], start) - 1
+        for part in parts[max(index, 0):]:
+            if part.offset > end:
+                return
+            yield from CompressionService.iter_range(
+                part.storage_key, part.encoding,
+                max(start - part.offset, 0), min(end, part.offset + part.size - 1) - part.offset
+            )
+
+    @staticmethod
+    def manifest(db: Session, blob: Blob) -> List[Dict[str, Any]]:
+        """
+        Offset, size and SHA-256 of each chunk of a blob's contents. Contents
+        stored whole are read and cut the same way, so clients can compare
+        against any version.
+        """
+        if blob.encoding == "chunked":
+            rows = db.execute(
+                select(BlobChunk.offset, BlobChunk.size, Blob.sha256)
+                .join(Blob, Blob.id == BlobChunk.chunk_id)
+                .where(BlobChunk.blob_id == blob.id)
+                .order_by(BlobChunk.position)
+            )
+            return [{"offset": row.offset, "size": row.size, "sha256": row.sha256} for row in rows]
+
+        with CompressionService.open(blob.storage_key, blob.encoding) as source:
+            return ChunkService.cut(source)
+
+    @staticmethod
+    def cut(source: BinaryIO, copy: Optional[BinaryIO] = None) -> List[Dict[str, Any]]:
+        """
+        Offset, size and SHA-256 of each content-defined chunk of a stream,
+        optionally writing the stream to a copy as it is read
+        """
+        chunks = []
+        offset = 0
+        for data in ChunkService.split(source):
+            chunks.append({"offset": offset, "size": len(data), "sha256": hashlib.sha256(data).hexdigest()})
+            offset += len(data)
+            if copy is not None:
+                copy.write(data)
+        return chunks
@@ -0,0 +1,225 @@
+import gzip
+import io
+import os
+import zlib
+from typing import BinaryIO, Iterator, Optional
+
+from app.core.config import settings
+from app.services.storage_backend import get_backend
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional; without it blobs are compressed with gzip
+    zstandard = None
+
+# Types worth trying to compress; anything else is assumed to be compressed
+# already (images, video, archives, office documents) and is stored as is
+COMPRESSIBLE_MIME_PREFIXES = ("text/",)
+COMPRESSIBLE_MIME_TYPES = {
+    "application/json", "application/x-ndjson", "application/ld+json", "application/xml", "application/xhtml+xml",
+    "application/javascript", "application/x-javascript", "application/sql", "application/x-sql",
+    "application/x-yaml", "application/yaml", "application/toml", "application/x-sh", "application/x-tex",
+    "application/rtf", "application/msword", "application/vnd.ms-excel", "application/x-tar", "image/svg+xml",
+    "image/bmp", "image/x-ms-bmp", "image/tiff", "audio/wav", "audio/x-wav",
+    # Unknown types are left to the sample
+    "application/octet-stream", "",
+}
+
+# Levels used when COMPRESSION_LEVEL is unset; both favour speed, as uploads wait for them
+DEFAULT_LEVELS = {"zstd": 3, "gzip": 6}
+
+
+class DecompressionError(Exception):
+    """
+    Raised when stored contents do not decode with their recorded encoding
+    """
+
+
+class _Decompressed(io.RawIOBase):
+    """
+    Read stream of a compressed object's original contents, closing the object with it
+    """
+
+    def __init__(self, source: BinaryIO, encoding: str):
+        self._source = source
+        self._encoding = encoding
+        if encoding == "gzip":
+            self._reader = gzip.GzipFile(fileobj=source, mode="rb")
+        elif encoding == "zstd" and zstandard is not None:
+            self._reader = zstandard.ZstdDecompressor().stream_reader(source, closefd=False)
+        else:
+            source.close()
+            raise DecompressionError(f"Cannot decode {encoding} contents")
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        try:
+            return self._reader.read(size)
+        except (OSError, EOFError, zlib.error) as e:
+            raise DecompressionError(f"Corrupt {self._encoding} contents: {str(e)}")
+        except Exception as e:
+            if zstandard is not None and isinstance(e, zstandard.ZstdError):
+                raise DecompressionError(f"Corrupt {self._encoding} contents: {str(e)}")
+            raise
+
+    def close(self) -> None:
+        if not self.closed:
+            try:
+                self._reader.close()
+            finally:
+                self._source.close()
+        super().close()
+
+
+class CompressionService:
+    """
+    Transparent compression of blob contents. A new blob is stored compressed
+    when its type is one that usually compresses and a sample of it shrinks by
+    enough; its hash and size stay those of the original, so deduplication,
+    ETags and listings are unaffected. Readers get the original bytes back,
+    and downloads can pass the stored bytes on to clients that accept the
+    encoding.
+    """
+
+    @staticmethod
+    def encoding() -> Optional[str]:
+        """
+        Encoding for new blobs, None when compression is off
+        """
+        encoding = settings.COMPRESSION_ENCODING
+        if encoding == "zstd" and zstandard is None:
+            return "gzip"
+        return encoding
+
+    @staticmethod
+    def _compressor(encoding: str):
+        """
+        A compressobj-style object with compress() and flush()
+        """
+        level = settings.COMPRESSION_LEVEL if settings.COMPRESSION_LEVEL is not None else DEFAULT_LEVELS[encoding]
+        if encoding == "zstd":
+            return zstandard.ZstdCompressor(level=level).compressobj()
+        # wbits 31 writes a gzip header and trailer; gzip.open reads it back
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    @staticmethod
+    def candidate(mime_type: Optional[str]) -> bool:
+        mime_type = (mime_type or "").lower().split(";")[0].strip()
+        return mime_type in COMPRESSIBLE_MIME_TYPES or mime_type.startswith(COMPRESSIBLE_MIME_PREFIXES)
+
+    @staticmethod
+    def _sample_compresses(path: str, size: int, encoding: str) -> bool:
+        """
+        Compress up to COMPRESSION_SAMPLE_SIZE bytes taken from the start, middle
+        and end of a file, and see whether they shrink to COMPRESSION_MAX_RATIO
+        """
+        if size <= settings.COMPRESSION_SAMPLE_SIZE:
+            piece, offsets = size, [0]
+        else:
+            piece = settings.COMPRESSION_SAMPLE_SIZE // 3
+            offsets = [0, size // 2 - piece // 2, size - piece]
+        compressor = CompressionService._compressor(encoding)
+        sampled = 0
+        compressed = 0
+        with open(path, "rb") as source:
+            for offset in offsets:
+                source.seek(offset)
+                data = source.read(piece)
+                sampled += len(data)
+                compressed += len(compressor.compress(data))
+        compressed += len(compressor.flush())
+        return sampled > 0 and compressed <= sampled * settings.COMPRESSION_MAX_RATIO
+
+    @staticmethod
+    def compress(path: str, size: int, mime_type: Optional[str]) -> Optional[str]:
+        """
+        Compress a staged file in place if it is worth it. Returns the encoding, or
+        None if the file was left as it is.
+        """
+        encoding = CompressionService.encoding()
+        if encoding is None or size < settings.COMPRESSION_MIN_SIZE or not CompressionService.candidate(mime_type):
+            return None
+        if not CompressionService._sample_compresses(path, size, encoding):
+            return None
+
+        partial = f"{path}.{encoding}"
+        compressor = CompressionService._compressor(encoding)
+        try:
+            with open(path, "rb") as source, open(partial, "wb") as target:
+                while chunk := source.read(settings.UPLOAD_CHUNK_SIZE):
+                    target.write(compressor.compress(chunk))
+                target.write(compressor.flush())
+            # The sample can flatter a file; keep the original if the whole did not shrink enough
+            if os.path.getsize(partial) > size * settings.COMPRESSION_MAX_RATIO:
+                os.remove(partial)
+                return None
+            os.replace(partial, path)
+        except Exception:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        return encoding
+
+    @staticmethod
+    def open(key: str, encoding: Optional[str]) -> BinaryIO:
+        """
+        Stream a blob's original contents, decompressing if it is stored
+        compressed, or reading its chunks in turn if it is stored in chunks
+        """
+        if encoding == "chunked":
+            from app.services.chunk_service import ChunkService
+            return ChunkService.open(key)
+        source = get_backend().open(key)
+        if not encoding:
+            return source
+        return _Decompressed(source, encoding)
+
+    @staticmethod
+    def iter_range(key: str, encoding: Optional[str], start: int, end: int) -> Iterator[bytes]:
+        """
+        Read an inclusive byte range of a blob's original contents. A compressed
+        blob is decompressed from its start, skipping the bytes before the range.
+        """
+        if not encoding:
+            yield from get_backend().iter_range(key, start, end)
+            return
+        if encoding == "chunked":
+            from app.services.chunk_service import ChunkService
+            yield from ChunkService.iter_range(key, start, end)
+            return
+        with CompressionService.open(key, encoding) as source:
+            position = 0
+            while position <= end:
+                chunk = source.read(settings.UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if position + len(chunk) > start:
+                    yield chunk[max(start - position, 0):end - position + 1]
+                position += len(chunk)
+
+    @staticmethod
+    def accepted(accept_encoding: Optional[str], encoding: str) -> bool:
+        """
+        Whether an Accept-Encoding header allows a response in the encoding
+        """
+        if not accept_encoding:
+            return False
+        accepted = {}
+        for item in accept_encoding.split(","):
+            name, _, parameters = item.strip().partition(";")
+            quality = 1.0
+            for parameter in parameters.split(";"):
+                key, _, value = parameter.strip().partition("=")
+                if key == "q":
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            accepted[name.strip().lower()] = quality
+        aliases = {"gzip": ("gzip", "x-gzip"), "zstd": ("zstd",)}.get(encoding)
+        if aliases is None:
+            return False  # Not an HTTP content coding, e.g. "chunked"
+        quality = next((accepted[alias] for alias in aliases if alias in accepted), accepted.get("*", 0.0))
+        return quality > 0
@@ -0,0 +1,200 @@
+import os
+import uuid
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from app.core.config import settings
+
+# Requests asking for more ranges than this get the whole file instead
+MAX_RANGES = 32
+
+ByteRange = Tuple[int, int]  # Inclusive start and end offsets
+
+
+class RangeNotSatisfiable(Exception):
+    """
+    Raised when none of the requested byte ranges overlap the file
+    """
+
+
+class DownloadService:
+    @staticmethod
+    def make_etag(content_hash: Optional[str], stat: os.stat_result, encoding: Optional[str] = None) -> str:
+        """
+        Strong ETag from the stored content hash, or a weak one from size and mtime
+        for files uploaded before hashes were recorded. A response in a content
+        encoding has bytes of its own, so it gets a tag of its own.
+        """
+        suffix = f"-{encoding}" if encoding else ""
+        if content_hash:
+            return f'"{content_hash}{suffix}"'
+        return f'W/"{stat.st_size:x}-{stat.st_mtime_ns:x}{suffix}"'
+
+    @staticmethod
+    def http_date(timestamp: float) -> str:
+        return formatdate(timestamp, usegmt=True)
+
+    @staticmethod
+    def _etag_matches(header: str, etag: str, weak: bool) -> bool:
+        candidates = [candidate.strip() for candidate in header.split(",")]
+        if "*" in candidates:
+            return True
+        if weak:
+            # Weak comparison ignores the W/ prefix on either side
+            opaque = etag[2:] if etag.startswith("W/") else etag
+            return any((c[2:] if c.startswith("W/") else c) == opaque for c in candidates)
+        return not etag.startswith("W/") and etag in candidates
+
+    @staticmethod
+    def _not_newer(header: str, mtime: float) -> bool:
+        try:
+            since = parsedate_to_datetime(header).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since
+
+    @staticmethod
+    def evaluate_preconditions(headers, etag: str, mtime: Optional[float]) -> Optional[int]:
+        """
+        Evaluate conditional request headers in RFC 9110 order. Returns 412 or 304
+        when the request should be answered without a body, otherwise None.
+        Without an mtime the date validators are ignored and only the ETag counts.
+        """
+        if_match = headers.get("if-match")
+        if if_match and not DownloadService._etag_matches(if_match, etag, weak=False):
+            return 412
+        if not if_match and mtime is not None:
+            if_unmodified_since = headers.get("if-unmodified-since")
+            if if_unmodified_since and not DownloadService._not_newer(if_unmodified_since, mtime):
+                return 412
+
+        if_none_match = headers.get("if-none-match")
+        if if_none_match:
+            if DownloadService._etag_matches(if_none_match, etag, weak=True):
+                return 304
+        elif mtime is not None:
+            if_modified_since = headers.get("if-modified-since")
+            if if_modified_since and DownloadService._not_newer(if_modified_since, mtime):
+                return 304
+
+        return None
+
+    @staticmethod
+    def range_applies(headers, etag: str, mtime: float) -> bool:
+        """
+        Whether a Range header should be honoured given any If-Range validator
+        """
+        if_range = headers.get("if-range")
+        if not if_range:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith("W/"):
+            return not etag.startswith("W/") and if_range == etag
+        try:
+            return int(mtime) == int(parsedate_to_datetime(if_range).timestamp())
+        except (TypeError, ValueError):
+            return False
+
+    @staticmethod
+    def parse_range(header: Optional[str], size: int) -> Optional[List[ByteRange]]:
+        """
+        Parse a bytes Range header into sorted, coalesced inclusive ranges.
+        Returns None when the header is absent, malformed or should be ignored,
+        and raises RangeNotSatisfiable when no range overlaps the file.
+        """
+        if not header:
+            return None
+        unit, _, spec = header.partition("=")
+        if unit.strip().lower() != "bytes" or not spec:
+            return None
+
+        ranges: List[ByteRange] = []
+        for part in spec.split(","):
+            part = part.strip()
+            if not part:
+                continue
+            start_text, dash, end_text = part.partition("-")
+            if not dash:
+                return None
+            try:
+                if start_text:
+                    start = int(start_text)
+                    end = int(end_text) if end_text else size - 1
+                    if end_text and start > end:
+                        return None
+                else:
+                    # Suffix range: the last N bytes
+                    length = int(end_text)
+                    start = max(size - length, 0)
+                    end = size - 1
+                    if length == 0:
+                        continue
+            except ValueError:
+                return None
+            if start >= size:
+                continue
+            ranges.append((start, min(end, size - 1)))
+
+        if not ranges:
+            raise RangeNotSatisfiable()
+        if len(ranges) > MAX_RANGES:
+            return None
+
+        ranges.sort()
+        merged = [ranges[0]]
+        for start, end in ranges[1:]:
+            last_start, last_end = merged[-1]
+            if start <= last_end + 1:
+                merged[-1] = (last_start, max(last_end, end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    @staticmethod
+    def iter_range(path: str, start: int, end: int) -> Iterator[bytes]:
+        """
+        Read an inclusive byte range with positional reads, in chunks
+        """
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            position = start
+            while position <= end:
+                chunk = os.pread(fd, min(settings.UPLOAD_CHUNK_SIZE, end - position + 1), position)
+                if not chunk:
+                    break
+                position += len(chunk)
+                yield chunk
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def multipart_ranges(
+        read_range: Callable[[int, int], Iterator[bytes]],
+        ranges: List[ByteRange],
+        size: int,
+        content_type: str
+    ) -> Tuple[str, int, Iterator[bytes]]:
+        """
+        Build a multipart/byteranges body from a function reading an inclusive
+        byte range. Returns the boundary, the exact body length and an iterator
+        producing the body.
+        """
+        boundary = uuid.uuid4().hex
+        headers = [
+            (
+                f"\r\n--{boundary}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+            ).encode("latin-1")
+            for start, end in ranges
+        ]
+        trailer = f"\r\n--{boundary}--\r\n".encode("latin-1")
+        length = sum(len(h) for h in headers) + sum(end - start + 1 for start, end in ranges) + len(trailer)
+
+        def body() -> Iterator[bytes]:
+            for part_header, (start, end) in zip(headers, ranges):
+                yield part_header
+                yield from read_range(start, end)
+            yield trailer
+
+        return boundary, length, body()
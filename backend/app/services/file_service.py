@@ -1,13 +1,18 @@
 import os
-import shutil
-import uuid
 from fastapi import UploadFile, HTTPException
-from sqlalchemy.orm import Session
-from typing import List, Optional
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session, selectinload
+from typing import Any, Dict, List, Optional
 
 from app.models.file import File
+from app.models.file_version import FileVersion
 from app.models.folder import Folder
-from app.core.config import settings
+from app.services.blob_service import BlobService
+from app.services.change_service import ChangeService
+from app.services.folder_service import NameTaken, name_conflicts
+from app.services.search_service import SearchService
+from app.services.upload_service import UploadService
+from app.services.version_service import VersionService
 
 
 class FileService:
@@ -21,43 +26,132 @@ class FileService:
         if not folder:
             raise ValueError("Folder not found")
         
-        # Generate unique filename to avoid collisions
-        file_ext = os.path.splitext(file.filename)[1] if file.filename and "." in file.filename else ""
-        unique_filename = f"{uuid.uuid4()}{file_ext}"
+        staged_path = BlobService.temp_path()
         
-        # Create storage path
-        folder_storage_path = folder.storage_path if hasattr(folder, 'storage_path') else os.path.join(settings.STORAGE_DIR, str(folder_id))
-        storage_path = os.path.join(folder_storage_path, unique_filename)
-        
-        # Ensure directory exists
-        os.makedirs(os.path.dirname(storage_path), exist_ok=True)
-        
-        # Save file to disk
+        # Save file to disk, hashing and counting bytes as they are written
         try:
-            with open(storage_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
+            file_size, content_hash = UploadService.copy_to_disk(file.file, staged_path)
+        except HTTPException:
+            raise
         except Exception as e:
             raise ValueError(f"Failed to save file: {str(e)}")
         
-        # Get file size
-        file_size = os.path.getsize(storage_path)
-        
-        # Create database record
-        db_file = File(
-            name=file.filename,
-            path=os.path.join(folder.path if hasattr(folder, 'path') else f"/folder/{folder_id}", file.filename),
-            storage_path=storage_path,
-            mime_type=file.content_type,
-            size=file_size,
-            folder_id=folder_id
+        return FileService.add_file(
+            db, folder, file.filename, file.content_type, staged_path, file_size, content_hash
         )
+    
+    @staticmethod
+    def add_file(
+        db: Session,
+        folder: Folder,
+        name: str,
+        mime_type: Optional[str],
+        staged_path: str,
+        size: int,
+        content_hash: str
+    ) -> File:
+        """
+        Create a file from contents already written to a staging path. The contents
+        are moved into the blob store, or dropped if identical bytes are stored already.
+        """
+        try:
+            FileService._check_name_free(db, folder.id, name)
+            content = SearchService.extract_text(staged_path, mime_type)
+            blob = BlobService.store(db, staged_path, size, content_hash, folder.id, mime_type)
+            db_file = File(
+                name=name,
+                mime_type=mime_type,
+                size=size,
+                content_hash=content_hash,
+                folder_id=folder.id,
+                blob_id=blob.id
+            )
+            db.add(db_file)
+            with name_conflicts(db, "files", f"A file named {name} already exists in this folder"):
+                db.flush()
+            SearchService.index_file(db, db_file, content)
+            ChangeService.record(db, "file", [db_file.id])
+            Folder.adjust_totals(db, folder.id, size=size, files=1)
+            db.commit()
+        except Exception:
+            db.rollback()
+            if os.path.exists(staged_path):
+                os.remove(staged_path)
+            raise
         
-        db.add(db_file)
-        db.commit()
         db.refresh(db_file)
-        
         return db_file
     
+    @staticmethod
+    def add_files(db: Session, folder: Folder, staged: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Create many files from staged contents in one transaction. Entries hold name,
+        mime_type, path, size and content_hash. Name conflicts, existing blobs and
+        the new rows each take a single statement rather than one per file.
+        Returns a result per entry, in order, with the new file ID or an error.
+        """
+        results: List[Dict[str, Any]] = [{"name": entry["name"]} for entry in staged]
+        taken = set(db.execute(
+            select(File.name).where(File.folder_id == folder.id, File.name.in_([entry["name"] for entry in staged]))
+        ).scalars())
+        
+        accepted = []
+        for entry, result in zip(staged, results):
+            name = entry["name"]
+            if not name or "/" in name:
+                result["error"] = "File names must be non-empty and cannot contain '/'"
+            elif name in taken:
+                result["error"] = f"A file named {name} already exists in this folder"
+            else:
+                taken.add(name)
+                accepted.append((entry, result))
+                continue
+            os.remove(entry["path"])
+        if not accepted:
+            return results
+        
+        try:
+            contents = [SearchService.extract_text(entry["path"], entry["mime_type"]) for entry, _ in accepted]
+            blobs = BlobService.store_many(
+                db,
+                [(entry["path"], entry["size"], entry["content_hash"], entry["mime_type"]) for entry, _ in accepted],
+                folder.id
+            )
+            with name_conflicts(db, "files", "A file of this batch was added to the folder meanwhile"):
+                file_ids = db.execute(
+                    insert(File).returning(File.id, sort_by_parameter_order=True),
+                    [
+                        {
+                            "name": entry["name"],
+                            "mime_type": entry["mime_type"],
+                            "size": entry["size"],
+                            "content_hash": entry["content_hash"],
+                            "folder_id": folder.id,
+                            "blob_id": blob.id,
+                        }
+                        for (entry, _), blob in zip(accepted, blobs)
+                    ]
+                ).scalars().all()
+            SearchService.index_files(db, [
+                {"rowid": file_id, "name": entry["name"], "content": content}
+                for file_id, (entry, _), content in zip(file_ids, accepted, contents)
+            ])
+            ChangeService.record(db, "file", file_ids)
+            Folder.adjust_totals(
+                db, folder.id, size=sum(entry["size"] for entry, _ in accepted), files=len(accepted)
+            )
+            db.commit()
+        except Exception:
+            db.rollback()
+            for entry, _ in accepted:
+                if os.path.exists(entry["path"]):
+                    os.remove(entry["path"])
+            raise
+        
+        for file_id, (_, result) in zip(file_ids, accepted):
+            result["id"] = file_id
+        return results
+    
     @staticmethod
     def get_file(db: Session, file_id: int) -> Optional[File]:
         """
@@ -65,6 +159,13 @@ class FileService:
         """
         return db.query(File).filter(File.id == file_id).first()
     
+    @staticmethod
+    def get_files(db: Session, file_ids: List[int]) -> List[File]:
+        """
+        Get several files by ID in one query, with their blobs
+        """
+        return db.query(File).options(selectinload(File.blob)).filter(File.id.in_(file_ids)).all()
+    
     @staticmethod
     def get_files_in_folder(db: Session, folder_id: int) -> List[File]:
         """
@@ -81,33 +182,126 @@ class FileService:
         if not file:
             return False
         
+        Folder.adjust_totals(db, file.folder_id, size=-(file.size or 0), files=-1)
+        ChangeService.record(db, "file", [file.id])
+        if file.blob_id is not None:
+            # Shared contents stay on disk until the last file using them is gone
+            released = VersionService.remove_versions(db, select(FileVersion.id).where(FileVersion.file_id == file.id))
+            released += BlobService.release(db, file.blob_id)
+            SearchService.remove_file(db, file.id)
+            db.delete(file)
+            db.commit()
+            BlobService.remove_files(released)
+            return True
+        
         # Delete from storage
         try:
-            if os.path.exists(file.storage_path):
+            if file.storage_path and os.path.exists(file.storage_path):
                 os.remove(file.storage_path)
         except Exception as e:
+            db.rollback()
             raise HTTPException(status_code=500, detail=f"Failed to delete file: {str(e)}")
         
         # Delete from database
+        SearchService.remove_file(db, file.id)
         db.delete(file)
         db.commit()
         
         return True
     
+    @staticmethod
+    def copy_file(db: Session, file_id: int, folder_id: int, new_name: Optional[str] = None) -> Optional[File]:
+        """
+        Copy a file into a folder. The copy shares the original's blob, so no bytes are written.
+        """
+        file = db.query(File).filter(File.id == file_id).first()
+        if not file:
+            return None
+        
+        folder = db.query(Folder).filter(Folder.id == folder_id).first()
+        if not folder:
+            raise ValueError("Folder not found")
+        
+        name = new_name or file.name
+        FileService._check_name_free(db, folder.id, name)
+        
+        blob = BlobService.adopt(db, file)
+        BlobService.acquire(db, blob.id)
+        
+        db_file = File(
+            name=name,
+            mime_type=file.mime_type,
+            size=file.size,
+            content_hash=file.content_hash,
+            folder_id=folder.id,
+            blob_id=blob.id
+        )
+        db.add(db_file)
+        with name_conflicts(db, "files", f"A file named {name} already exists in this folder"):
+            db.flush()
+        SearchService.copy_file(db, file.id, db_file)
+        ChangeService.record(db, "file", [db_file.id])
+        Folder.adjust_totals(db, folder.id, size=db_file.size or 0, files=1)
+        db.commit()
+        db.refresh(db_file)
+        
+        return db_file
+    
     @staticmethod
     def rename_file(db: Session, file_id: int, new_name: str) -> Optional[File]:
         """
         Rename a file
         """
+        return FileService.update_file(db, file_id, name=new_name)
+    
+    @staticmethod
+    def move_file(db: Session, file_id: int, folder_id: int) -> Optional[File]:
+        """
+        Move a file to another folder. Only the folder reference changes.
+        """
+        return FileService.update_file(db, file_id, folder_id=folder_id)
+    
+    @staticmethod
+    def update_file(
+        db: Session, file_id: int, name: Optional[str] = None, folder_id: Optional[int] = None
+    ) -> Optional[File]:
+        """
+        Rename a file, move it to another folder, or both. Both changes are
+        checked before either is made, and they commit together.
+        """
         file = db.query(File).filter(File.id == file_id).first()
         if not file:
             return None
+        new_name = name if name is not None else file.name
+        new_folder_id = folder_id if folder_id is not None else file.folder_id
+        moving = new_folder_id != file.folder_id
+        if not moving and new_name == file.name:
+            return file
         
-        # Update database record
-        file.name = new_name
-        file.path = os.path.join(os.path.dirname(file.path), new_name)
+        if moving and not db.query(Folder.id).filter(Folder.id == new_folder_id).first():
+            raise ValueError("Folder not found")
+        FileService._check_name_free(db, new_folder_id, new_name)
         
-        db.commit()
+        if moving:
+            Folder.adjust_totals(db, file.folder_id, size=-(file.size or 0), files=-1)
+            Folder.adjust_totals(db, new_folder_id, size=file.size or 0, files=1)
+            file.folder_id = new_folder_id
+        if new_name != file.name:
+            file.name = new_name
+            SearchService.rename_file(db, file.id, new_name)
+        ChangeService.record(db, "file", [file.id])
+        with name_conflicts(db, "files", f"A file named {new_name} already exists in this folder"):
+            db.commit()
         db.refresh(file)
         
         return file
+    
+    @staticmethod
+    def _check_name_free(db: Session, folder_id: int, name: Optional[str]) -> None:
+        """
+        Raise if the folder already holds a file with this name
+        """
+        if not name or "/" in name:
+            raise ValueError("File names must be non-empty and cannot contain '/'")
+        if db.query(File.id).filter(File.folder_id == folder_id, File.name == name).first():
+            raise NameTaken(f"A file named {name} already exists in this folder")
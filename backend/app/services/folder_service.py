@@ -1,53 +1,226 @@
-import os
-import shutil
-from sqlalchemy.orm import Session
-from typing import List, Optional, Dict, Any
+from contextlib import contextmanager
+from sqlalchemy import delete, func, insert, literal, select, text, true, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, aliased, join
+from typing import Iterable, List, Optional, Dict, Any, Tuple
 
+from app.models.blob import Blob
+from app.models.file import File
+from app.models.file_version import FileVersion
 from app.models.folder import Folder
-from app.core.config import settings
+from app.models.folder_closure import FolderClosure
+from app.services.blob_service import BlobService
+from app.services.change_service import ChangeService
+from app.services.search_service import SearchService
+from app.services.version_service import VersionService
+
+
+class NameTaken(ValueError):
+    """
+    Raised when a folder already holds a file or subfolder of the name asked for
+    """
+
+
+@contextmanager
+def name_conflicts(db: Session, table: str, message: str):
+    """
+    Turn a violation of a table's unique name index into NameTaken, rolling back.
+    Names are checked before writing, so this catches a concurrent request that
+    took the name in between.
+    """
+    try:
+        yield
+    except IntegrityError as e:
+        if f"{table}.name" not in str(e.orig):
+            raise
+        db.rollback()
+        raise NameTaken(message) from e
 
 
 class FolderService:
     @staticmethod
     def create_folder(db: Session, name: str, parent_id: Optional[int] = None) -> Folder:
         """
-        Create a new folder
+        Create a new folder. Folders only exist in the database; file contents live in
+        the blob store, so nothing is created on disk.
         """
-        # Handle root folder case
-        if parent_id is None:
-            parent_path = ""
-            parent_storage_path = settings.STORAGE_DIR
-        else:
+        if parent_id is not None:
             # Get parent folder
             parent = db.query(Folder).filter(Folder.id == parent_id).first()
             if not parent:
                 raise ValueError("Parent folder not found")
-            parent_path = parent.path
-            parent_storage_path = parent.storage_path
-        
-        # Create virtual path
-        path = os.path.join(parent_path, name)
-        
-        # Create storage path
-        storage_path = os.path.join(parent_storage_path, name)
-        
-        # Create directory on disk
-        os.makedirs(storage_path, exist_ok=True)
+        FolderService._check_name_free(db, parent_id, name)
         
         # Create database record
         db_folder = Folder(
             name=name,
-            path=path,
-            storage_path=storage_path,
             parent_id=parent_id
         )
         
-        db.add(db_folder)
-        db.commit()
+        with name_conflicts(db, "folders", f"A folder named {name} already exists here"):
+            db.add(db_folder)
+            db.flush()
+            FolderService._link_closure(db, db_folder.id, parent_id)
+            if parent_id is not None:
+                SearchService.index_folder(db, db_folder)
+                Folder.adjust_totals(db, parent_id, folders=1)
+            ChangeService.record(db, "folder", [db_folder.id])
+            db.commit()
         db.refresh(db_folder)
         
         return db_folder
     
+    @staticmethod
+    def ensure_paths(db: Session, paths: Iterable[Tuple[str, ...]], known: Dict[Tuple[str, ...], int]) -> int:
+        """
+        Make sure a folder exists for every relative path, given as a tuple of names,
+        creating missing ones in one transaction. known maps paths to folder IDs and
+        must map () to the folder the paths are relative to; it is updated in place.
+        Existing folders are reused. Returns the number of folders created.
+        """
+        wanted = {path[:depth] for path in paths for depth in range(1, len(path) + 1)}
+        created = 0
+        for path in sorted(wanted - known.keys(), key=len):
+            parent_id = known[path[:-1]]
+            existing = db.query(Folder.id).filter(Folder.parent_id == parent_id, Folder.name == path[-1]).first()
+            if existing:
+                known[path] = existing.id
+                continue
+            
+            FolderService._check_name_free(db, parent_id, path[-1])
+            db_folder = Folder(name=path[-1], parent_id=parent_id)
+            db.add(db_folder)
+            with name_conflicts(db, "folders", f"A folder named {path[-1]} already exists here"):
+                db.flush()
+            FolderService._link_closure(db, db_folder.id, parent_id)
+            SearchService.index_folder(db, db_folder)
+            Folder.adjust_totals(db, parent_id, folders=1)
+            ChangeService.record(db, "folder", [db_folder.id])
+            known[path] = db_folder.id
+            created += 1
+        
+        db.commit()
+        return created
+    
+    @staticmethod
+    def _check_name_free(db: Session, parent_id: Optional[int], name: str) -> None:
+        """
+        Raise if the parent already has a subfolder with this name
+        """
+        if not name or "/" in name:
+            raise ValueError("Folder names must be non-empty and cannot contain '/'")
+        exists = db.query(Folder.id).filter(Folder.parent_id == parent_id, Folder.name == name).first()
+        if exists:
+            raise NameTaken(f"A folder named {name} already exists here")
+    
+    @staticmethod
+    def _link_closure(db: Session, folder_id: int, parent_id: Optional[int]) -> None:
+        """
+        Add closure rows for a new leaf folder: itself, plus every ancestor of its parent
+        """
+        db.execute(insert(FolderClosure).values(ancestor_id=folder_id, descendant_id=folder_id, depth=0))
+        if parent_id is not None:
+            db.execute(
+                insert(FolderClosure).from_select(
+                    ["ancestor_id", "descendant_id", "depth"],
+                    select(
+                        FolderClosure.ancestor_id,
+                        literal(folder_id),
+                        FolderClosure.depth + 1
+                    ).where(FolderClosure.descendant_id == parent_id)
+                )
+            )
+    
+    @staticmethod
+    def rebuild_closure(db: Session) -> int:
+        """
+        Recompute the closure table from parent_id links. Returns the number of rows.
+        """
+        db.execute(delete(FolderClosure))
+        db.execute(text("""
+            INSERT INTO folder_closure (ancestor_id, descendant_id, depth)
+            WITH RECURSIVE tree(ancestor_id, descendant_id, depth) AS (
+                SELECT id, id, 0 FROM folders
+                UNION ALL
+                SELECT tree.ancestor_id, folders.id, tree.depth + 1
+                FROM tree JOIN folders ON folders.parent_id = tree.descendant_id
+            )
+            SELECT ancestor_id, descendant_id, depth FROM tree
+        """))
+        db.commit()
+        return db.query(FolderClosure).count()
+    
+    @staticmethod
+    def recompute_totals(db: Session) -> None:
+        """
+        Recompute every folder's rolled-up totals from scratch: each folder's own
+        files are summed once, then added up the closure table
+        """
+        db.execute(text("""
+            CREATE TEMP TABLE folder_own AS
+            SELECT folder_id, COUNT(*) AS files, COALESCE(SUM(size), 0) AS size
+            FROM files GROUP BY folder_id
+        """))
+        db.execute(text("""
+            UPDATE folders SET
+                (file_count, total_size) = (
+                    SELECT COALESCE(SUM(folder_own.files), 0), COALESCE(SUM(folder_own.size), 0)
+                    FROM folder_closure
+                    JOIN folder_own ON folder_own.folder_id = folder_closure.descendant_id
+                    WHERE folder_closure.ancestor_id = folders.id
+                ),
+                folder_count = (
+                    SELECT COUNT(*) - 1 FROM folder_closure WHERE folder_closure.ancestor_id = folders.id
+                )
+        """))
+        db.execute(text("DROP TABLE folder_own"))
+        db.commit()
+    
+    @staticmethod
+    def subtree_ids(folder_id: int):
+        """
+        Subquery selecting the IDs of a folder and all of its descendants
+        """
+        return select(FolderClosure.descendant_id).where(FolderClosure.ancestor_id == folder_id)
+    
+    @staticmethod
+    def get_subtree(db: Session, folder_id: int, max_depth: Optional[int] = None) -> List[Tuple[Folder, int]]:
+        """
+        Get a folder and all of its descendants with their depth below it, in one query
+        """
+        query = (
+            db.query(Folder, FolderClosure.depth)
+            .join(FolderClosure, FolderClosure.descendant_id == Folder.id)
+            .filter(FolderClosure.ancestor_id == folder_id)
+        )
+        if max_depth is not None:
+            query = query.filter(FolderClosure.depth <= max_depth)
+        return query.order_by(FolderClosure.depth, Folder.name).all()
+    
+    @staticmethod
+    def get_ancestors(db: Session, folder_id: int) -> List[Folder]:
+        """
+        Get the chain of folders from the root down to and including a folder
+        """
+        return (
+            db.query(Folder)
+            .join(FolderClosure, FolderClosure.ancestor_id == Folder.id)
+            .filter(FolderClosure.descendant_id == folder_id)
+            .order_by(FolderClosure.depth.desc())
+            .all()
+        )
+    
+    @staticmethod
+    def get_subtree_stats(db: Session, folder_id: int) -> Dict[str, int]:
+        """
+        Count the folders and files below a folder and total their size, read from
+        the folder's rolled-up totals
+        """
+        row = db.execute(
+            select(Folder.folder_count, Folder.file_count, Folder.total_size).where(Folder.id == folder_id)
+        ).one()
+        return {"folder_count": row.folder_count, "file_count": row.file_count, "total_size": row.total_size}
+    
     @staticmethod
     def get_folder(db: Session, folder_id: int) -> Optional[Folder]:
         """
@@ -60,7 +233,19 @@ class FolderService:
         """
         Get folder by path
         """
-        return db.query(Folder).filter(Folder.path == path).first()
+        folder = db.query(Folder).filter(Folder.parent_id == None).order_by(Folder.id).first()
+        for name in [part for part in path.split("/") if part]:
+            if folder is None:
+                break
+            folder = db.query(Folder).filter(Folder.parent_id == folder.id, Folder.name == name).first()
+        return folder
+    
+    @staticmethod
+    def get_path(db: Session, folder_id: int) -> str:
+        """
+        Get the virtual path of a folder
+        """
+        return Folder.path_of(db, folder_id)
     
     @staticmethod
     def get_root_folders(db: Session) -> List[Folder]:
@@ -76,6 +261,57 @@ class FolderService:
         """
         return db.query(Folder).filter(Folder.parent_id == parent_id).all()
     
+    @staticmethod
+    def _remove_files(db: Session, criteria, adjust_totals: bool = True) -> List[Optional[str]]:
+        """
+        Delete the files matching the criteria with their index entries. Returns the
+        contents nobody uses any more, to remove with BlobService.remove_files once
+        the caller commits.
+        """
+        if adjust_totals:
+            Folder.adjust_totals_for_files(db, criteria, -1)
+        
+        # Drop one blob reference per file and per earlier version, then forget blobs nobody uses
+        released = VersionService.remove_versions(
+            db, select(FileVersion.id).where(FileVersion.file_id.in_(select(File.id).where(criteria)))
+        )
+        db.execute(
+            update(Blob)
+            .where(Blob.id.in_(select(File.blob_id).where(criteria)))
+            .values(ref_count=Blob.ref_count - (
+                select(func.count(File.id))
+                .where(File.blob_id == Blob.id, criteria)
+                .scalar_subquery()
+            ))
+        )
+        released.extend(BlobService.forget_unreferenced(db))
+        
+        # Files written before the blob store are removed individually
+        released.extend(
+            path for (path,) in db.query(File.storage_path).filter(criteria, File.blob_id == None)
+        )
+        
+        SearchService.remove_files(db, select(File.id).where(criteria))
+        ChangeService.record(db, "file", select(File.id).where(criteria))
+        db.execute(delete(File).where(criteria))
+        return released
+    
+    @staticmethod
+    def delete_files_below(db: Session, folder_id: int, limit: int) -> int:
+        """
+        Delete up to limit files from a folder's subtree in one transaction, so a
+        large tree can be emptied in steps. Returns the number deleted.
+        """
+        batch = select(File.id).where(File.folder_id.in_(FolderService.subtree_ids(folder_id))).limit(limit)
+        file_ids = db.scalars(batch).all()
+        if not file_ids:
+            return 0
+        
+        released = FolderService._remove_files(db, File.id.in_(file_ids))
+        db.commit()
+        BlobService.remove_files(released)
+        return len(file_ids)
+    
     @staticmethod
     def delete_folder(db: Session, folder_id: int) -> bool:
         """
@@ -85,52 +321,112 @@ class FolderService:
         if not folder:
             return False
         
-        # Delete from storage
-        try:
-            if os.path.exists(folder.storage_path):
-                shutil.rmtree(folder.storage_path)
-        except Exception as e:
-            raise ValueError(f"Failed to delete folder: {str(e)}")
-        
-        # Delete from database (cascade will handle children)
-        db.delete(folder)
+        # The folders below go away with it, so only the ancestors' totals change
+        if folder.parent_id is not None:
+            Folder.adjust_totals(
+                db, folder.parent_id,
+                size=-folder.total_size, files=-folder.file_count, folders=-(folder.folder_count + 1)
+            )
+        subtree = FolderService.subtree_ids(folder_id)
+        released = FolderService._remove_files(db, File.folder_id.in_(subtree), adjust_totals=False)
+        SearchService.remove_folders(db, subtree)
+        ChangeService.record(db, "folder", subtree)
+        db.execute(delete(Folder).where(Folder.id.in_(subtree)))
+        db.execute(delete(FolderClosure).where(FolderClosure.descendant_id.in_(subtree)))
         db.commit()
+        db.expire_all()
+        BlobService.remove_files(released)
         
         return True
     
     @staticmethod
     def rename_folder(db: Session, folder_id: int, new_name: str) -> Optional[Folder]:
         """
-        Rename a folder
+        Rename a folder. Paths are derived, so only this folder's row changes.
+        """
+        return FolderService.update_folder(db, folder_id, name=new_name)
+    
+    @staticmethod
+    def move_folder(db: Session, folder_id: int, new_parent_id: int) -> Optional[Folder]:
+        """
+        Move a folder under a new parent. Only the folder's parent_id and the closure
+        rows linking its subtree to its old ancestors change; nothing moves on disk.
+        """
+        return FolderService.update_folder(db, folder_id, parent_id=new_parent_id)
+    
+    @staticmethod
+    def update_folder(
+        db: Session, folder_id: int, name: Optional[str] = None, parent_id: Optional[int] = None
+    ) -> Optional[Folder]:
+        """
+        Rename a folder, move it under a new parent, or both. Both changes are
+        checked before either is made, and they commit together.
         """
         folder = db.query(Folder).filter(Folder.id == folder_id).first()
         if not folder:
             return None
+        new_name = name if name is not None else folder.name
+        new_parent_id = parent_id if parent_id is not None else folder.parent_id
+        moving = new_parent_id != folder.parent_id
+        if not moving and new_name == folder.name:
+            return folder
         
-        # Get parent path
-        parent_path = os.path.dirname(folder.path)
-        parent_storage_path = os.path.dirname(folder.storage_path)
-        
-        # Create new paths
-        new_path = os.path.join(parent_path, new_name)
-        new_storage_path = os.path.join(parent_storage_path, new_name)
-        
-        # Rename directory on disk
-        try:
-            os.rename(folder.storage_path, new_storage_path)
-        except Exception as e:
-            raise ValueError(f"Failed to rename folder: {str(e)}")
-        
-        # Update database record
-        folder.name = new_name
-        folder.path = new_path
-        folder.storage_path = new_storage_path
+        if moving:
+            if not db.query(Folder.id).filter(Folder.id == new_parent_id).first():
+                raise ValueError("Parent folder not found")
+            if db.query(FolderClosure).filter(
+                FolderClosure.ancestor_id == folder_id, FolderClosure.descendant_id == new_parent_id
+            ).first():
+                raise ValueError("Cannot move a folder into itself or one of its subfolders")
+        FolderService._check_name_free(db, new_parent_id, new_name)
         
-        db.commit()
+        if moving:
+            FolderService._relink(db, folder, new_parent_id)
+            folder.parent_id = new_parent_id
+        if new_name != folder.name:
+            folder.name = new_name
+            SearchService.rename_folder(db, folder.id, new_name)
+        # Paths below it are derived, so only the folder itself changed for sync clients
+        ChangeService.record(db, "folder", [folder.id])
+        with name_conflicts(db, "folders", f"A folder named {new_name} already exists here"):
+            db.commit()
         db.refresh(folder)
         
         return folder
     
+    @staticmethod
+    def _relink(db: Session, folder: Folder, new_parent_id: int) -> None:
+        """
+        Move a folder's subtree totals and closure rows from its old ancestors to
+        those of its new parent. The caller sets parent_id and commits.
+        """
+        subtree = FolderService.subtree_ids(folder.id)
+        
+        # The subtree's totals move from the old ancestors to the new ones
+        size, files, folders = folder.total_size, folder.file_count, folder.folder_count + 1
+        if folder.parent_id is not None:
+            Folder.adjust_totals(db, folder.parent_id, size=-size, files=-files, folders=-folders)
+        Folder.adjust_totals(db, new_parent_id, size=size, files=files, folders=folders)
+        
+        # Unlink the subtree from its old ancestors...
+        db.execute(
+            delete(FolderClosure).where(
+                FolderClosure.descendant_id.in_(subtree),
+                FolderClosure.ancestor_id.notin_(subtree)
+            )
+        )
+        # ...and link it below every ancestor of the new parent
+        above = aliased(FolderClosure)
+        below = aliased(FolderClosure)
+        db.execute(
+            insert(FolderClosure).from_select(
+                ["ancestor_id", "descendant_id", "depth"],
+                select(above.ancestor_id, below.descendant_id, above.depth + below.depth + 1)
+                .select_from(join(above, below, true()))
+                .where(above.descendant_id == new_parent_id, below.ancestor_id == folder.id)
+            )
+        )
+    
     @staticmethod
     def get_folder_contents(db: Session, folder_id: int) -> Dict[str, Any]:
         """
@@ -0,0 +1,353 @@
+import io
+import mimetypes
+import os
+import posixpath
+import struct
+import tarfile
+import zlib
+from collections import defaultdict
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from app.core.config import settings
+from app.services.blob_service import BlobService
+from app.services.file_service import FileService
+from app.services.folder_service import FolderService
+from app.services.thumbnail_service import ThumbnailService
+from app.services.upload_service import UploadService
+
+ZIP_LOCAL_SIGNATURE = b"PK\x03\x04"
+ZIP_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+# Records that follow the last entry: central directory, zip64 end records and end of central directory
+ZIP_END_SIGNATURES = {b"PK\x01\x02", b"PK\x06\x06", b"PK\x06\x07", b"PK\x05\x06"}
+ZIP_LOCAL_HEADER = struct.Struct("<HHHHHIIIHH")  # Local file header after its signature
+ZIP64_EXTRA_ID = 0x0001
+ZIP_STORED, ZIP_DEFLATED = 0, 8
+ZIP_MAX_DESCRIPTOR = 24  # Signature, CRC and two 8-byte sizes
+
+# Archive members that are metadata of the tool that made the archive
+IGNORED_NAMES = {"__MACOSX", ".DS_Store"}
+
+# Per-file failures listed in an import summary; the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+
+class ArchiveError(ValueError):
+    """
+    Raised when an archive is malformed or uses features that cannot be streamed
+    """
+
+
+class _PushbackReader:
+    """
+    Reader over a binary stream that can hand bytes it read too far back to itself
+    """
+
+    def __init__(self, stream: BinaryIO):
+        self._stream = stream
+        self._pending = b""
+
+    def read(self, size: int) -> bytes:
+        if self._pending:
+            data, self._pending = self._pending[:size], self._pending[size:]
+            return data
+        return self._stream.read(size)
+
+    def read_exact(self, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = self.read(size - len(data))
+            if not chunk:
+                raise ArchiveError("Archive ended unexpectedly")
+            data += chunk
+        return data
+
+    def unread(self, data: bytes) -> None:
+        self._pending = data + self._pending
+
+
+class _EntryReader(io.RawIOBase):
+    """
+    File-like view of the chunks of one archive entry
+    """
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = chunks
+        self._buffer = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._buffer:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._buffer = memoryview(chunk)
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def drain(self) -> None:
+        for _ in self._chunks:
+            pass
+
+
+def _inflate(decompressor, data: bytes) -> Iterator[bytes]:
+    # Bounded output per call, so a highly compressed entry cannot balloon in memory
+    while data:
+        output = decompressor.decompress(data, settings.UPLOAD_CHUNK_SIZE)
+        if output:
+            yield output
+        data = decompressor.unconsumed_tail
+
+
+def _zip_entry_chunks(
+    reader: _PushbackReader,
+    name: str,
+    method: int,
+    streamed: bool,
+    compressed_size: int,
+    expected_crc: int,
+    zip64: bool
+) -> Iterator[bytes]:
+    """
+    Yield the uncompressed contents of the zip entry whose data starts at the
+    reader's position, checking its CRC, and leave the reader after the entry
+    """
+    crc = 0
+    sizes = struct.Struct("<QQ" if zip64 else "<II")
+    decompressor = zlib.decompressobj(-15) if method == ZIP_DEFLATED else None
+
+    if not streamed:
+        remaining = compressed_size
+        while remaining:
+            chunk = reader.read(min(remaining, settings.UPLOAD_CHUNK_SIZE))
+            if not chunk:
+                raise ArchiveError("Archive ended unexpectedly")
+            remaining -= len(chunk)
+            for data in (_inflate(decompressor, chunk) if decompressor else (chunk,)):
+                crc = zlib.crc32(data, crc)
+                yield data
+        if decompressor:
+            tail = decompressor.flush()
+            if tail:
+                crc = zlib.crc32(tail, crc)
+                yield tail
+
+    elif decompressor:
+        # Sizes follow the data in a descriptor; deflate marks its own end
+        while not decompressor.eof:
+            chunk = reader.read(settings.UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                raise ArchiveError("Archive ended unexpectedly")
+            for data in _inflate(decompressor, chunk):
+                crc = zlib.crc32(data, crc)
+                yield data
+        reader.unread(decompressor.unused_data)
+        descriptor = reader.read_exact(4)
+        if descriptor == ZIP_DESCRIPTOR_SIGNATURE:
+            descriptor = reader.read_exact(4)
+        expected_crc = struct.unpack("<I", descriptor)[0]
+        reader.read_exact(sizes.size)
+
+    else:
+        # Stored data of unknown size ends at a descriptor whose CRC and size match
+        # everything before it
+        window = b""
+        emitted = 0
+        while True:
+            chunk = reader.read(settings.UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                raise ArchiveError("Archive ended unexpectedly")
+            window += chunk
+            position = window.find(ZIP_DESCRIPTOR_SIGNATURE)
+            while position >= 0 and position + 8 + sizes.size <= len(window):
+                candidate_crc = struct.unpack_from("<I", window, position + 4)[0]
+                _, size = sizes.unpack_from(window, position + 8)
+                if size == emitted + position and zlib.crc32(window[:position], crc) == candidate_crc:
+                    data = window[:position]
+                    if data:
+                        crc = zlib.crc32(data, crc)
+                        yield data
+                    expected_crc = candidate_crc
+                    reader.unread(window[position + 8 + sizes.size:])
+                    break
+                position = window.find(ZIP_DESCRIPTOR_SIGNATURE, position + 1)
+            else:
+                # Hold back enough bytes to recognise a descriptor split across reads
+                keep = max(len(window) - ZIP_MAX_DESCRIPTOR, 0)
+                if keep:
+                    data, window = window[:keep], window[keep:]
+                    crc = zlib.crc32(data, crc)
+                    emitted += len(data)
+                    yield data
+                continue
+            break
+
+    if crc != expected_crc:
+        raise ArchiveError(f"{name} is corrupt (CRC mismatch)")
+
+
+def iter_zip_entries(stream: BinaryIO) -> Iterator[Tuple[str, bool, BinaryIO]]:
+    """
+    Read a zip archive front to back from its local file headers rather than the
+    central directory at its end, so it can be extracted while it streams in.
+    Yields (name, is_directory, reader); each reader must be done with before the
+    next entry is requested.
+    """
+    reader = _PushbackReader(stream)
+    while True:
+        signature = reader.read_exact(4)
+        if signature in ZIP_END_SIGNATURES:
+            return
+        if signature != ZIP_LOCAL_SIGNATURE:
+            raise ArchiveError("Corrupt zip archive: expected a file header")
+
+        (_, flags, method, _, _, crc, compressed_size, size, name_length, extra_length) = ZIP_LOCAL_HEADER.unpack(
+            reader.read_exact(ZIP_LOCAL_HEADER.size)
+        )
+        name = reader.read_exact(name_length).decode("utf-8" if flags & 0x800 else "cp437")
+        extra = reader.read_exact(extra_length)
+
+        zip64 = False
+        offset = 0
+        while offset + 4 <= len(extra):
+            field_id, field_length = struct.unpack_from("<HH", extra, offset)
+            if field_id == ZIP64_EXTRA_ID:
+                zip64 = True
+                values = list(struct.unpack_from(f"<{field_length // 8}Q", extra, offset + 4))
+                if size == 0xFFFFFFFF and values:
+                    size = values.pop(0)
+                if compressed_size == 0xFFFFFFFF and values:
+                    compressed_size = values.pop(0)
+            offset += 4 + field_length
+
+        if flags & 0x1:
+            raise ArchiveError(f"{name} is encrypted")
+        if method not in (ZIP_STORED, ZIP_DEFLATED):
+            raise ArchiveError(f"{name} uses unsupported compression method {method}")
+
+        entry = _EntryReader(_zip_entry_chunks(
+            reader, name, method, bool(flags & 0x8), compressed_size, crc, zip64
+        ))
+        yield name, name.endswith("/"), entry
+        entry.drain()
+
+
+class ImportService:
+    @staticmethod
+    def iter_entries(stream: io.BufferedReader) -> Iterator[Tuple[str, bool, Optional[BinaryIO]]]:
+        """
+        Yield (name, is_directory, reader) for each member of a zip archive or a
+        tar archive, optionally gzip, bzip2 or xz compressed, read as a stream
+        """
+        if stream.peek(4)[:4] == ZIP_LOCAL_SIGNATURE:
+            yield from iter_zip_entries(stream)
+            return
+
+        try:
+            with tarfile.open(fileobj=stream, mode="r|*") as archive:
+                for member in archive:
+                    if member.isdir():
+                        yield member.name, True, None
+                    elif member.isfile():
+                        yield member.name, False, archive.extractfile(member)
+        except tarfile.TarError as e:
+            raise ArchiveError(f"Not a readable tar or zip archive: {str(e)}")
+
+    @staticmethod
+    def split_path(name: str) -> Optional[Tuple[str, ...]]:
+        """
+        Split an archive member name into folder and file names. Returns None for
+        names that would escape the target folder or are tool metadata.
+        """
+        parts = tuple(part for part in name.replace("\\", "/").split("/") if part not in ("", "."))
+        if not parts or ".." in parts or IGNORED_NAMES.intersection(parts):
+            return None
+        return parts
+
+    @staticmethod
+    def import_archive(db: Session, folder_id: int, stream: io.BufferedReader) -> Dict[str, Any]:
+        """
+        Extract an archive into a folder while it streams in, recreating its
+        directory tree. Files are staged as they are read and recorded in batches
+        of IMPORT_BATCH_SIZE, folders and files of a batch each in one transaction.
+        The archive itself is never stored. If it turns out to be corrupt part way,
+        everything before the damage is kept and the summary carries the error.
+        """
+        known: Dict[Tuple[str, ...], int] = {(): folder_id}
+        directories = set()
+        pending: Dict[Tuple[str, ...], List[Dict[str, Any]]] = defaultdict(list)
+        summary: Dict[str, Any] = {
+            "folder_id": folder_id,
+            "folders_created": 0,
+            "files_created": 0,
+            "skipped": 0,
+            "errors": [],
+            "error": None,
+        }
+
+        def skip(path: str, detail: str) -> None:
+            summary["skipped"] += 1
+            if len(summary["errors"]) < MAX_REPORTED_ERRORS:
+                summary["errors"].append({"path": path, "detail": detail})
+
+        def flush() -> None:
+            summary["folders_created"] += FolderService.ensure_paths(db, set(pending) | directories, known)
+            directories.clear()
+            created = []
+            while pending:
+                parent, entries = pending.popitem()
+                folder = FolderService.get_folder(db, known[parent])
+                for entry, result in zip(entries, FileService.add_files(db, folder, entries)):
+                    if "error" in result:
+                        skip("/".join(parent + (entry["name"],)), result["error"])
+                    else:
+                        created.append(result["id"])
+            summary["files_created"] += len(created)
+            for db_file in FileService.get_files(db, created):
+                ThumbnailService.schedule(db_file)
+
+        staged = 0
+        try:
+            try:
+                for name, is_directory, source in ImportService.iter_entries(stream):
+                    parts = ImportService.split_path(name)
+                    if parts is None:
+                        if not IGNORED_NAMES.intersection(name.split("/")):
+                            skip(name, "Unsafe or empty path")
+                        continue
+                    if is_directory:
+                        directories.add(parts)
+                        continue
+
+                    entry = {
+                        "name": parts[-1],
+                        "mime_type": mimetypes.guess_type(parts[-1])[0],
+                        "path": BlobService.temp_path(),
+                    }
+                    try:
+                        entry["size"], entry["content_hash"] = UploadService.copy_to_disk(source, entry["path"])
+                    except HTTPException as e:
+                        skip(posixpath.join(*parts), e.detail)
+                        continue
+                    pending[parts[:-1]].append(entry)
+                    staged += 1
+
+                    if staged >= settings.IMPORT_BATCH_SIZE:
+                        flush()
+                        staged = 0
+            except ArchiveError as e:
+                summary["error"] = str(e)
+            flush()
+        except BaseException:
+            for entries in pending.values():
+                for entry in entries:
+                    if os.path.exists(entry["path"]):
+                        os.remove(entry["path"])
+            raise
+
+        return summary
@@ -0,0 +1,260 @@
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+from typing import Any, Callable, Dict, List, Optional
+
+from app.core.config import settings, data_path
+from app.db.base import SessionLocal
+from app.models.job import Job
+
+# kind -> handler(db, context, params) returning the job's result
+_handlers: Dict[str, Callable[[Session, "JobContext", Dict[str, Any]], Any]] = {}
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+_cancelled = set()  # IDs of running jobs asked to stop
+_stopping = threading.Event()  # Set at shutdown; running jobs stop and are resumed on the next start
+
+
+class JobCancelled(Exception):
+    """
+    Raised inside a job when it has been asked to stop
+    """
+
+
+class JobContext:
+    """
+    Handed to a running job to report progress and notice cancellation. Progress
+    is written through its own session, so only report between transactions.
+    """
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.done = 0
+        self.total: Optional[int] = None
+        self._reported_at = 0.0
+
+    def check(self) -> None:
+        if _stopping.is_set() or self.job_id in _cancelled:
+            raise JobCancelled()
+
+    def progress(self, done: int, total: Optional[int] = None, message: Optional[str] = None, force: bool = False) -> None:
+        """
+        Record progress, at most every JOB_PROGRESS_INTERVAL seconds unless forced,
+        and stop here if the job was cancelled
+        """
+        self.done = done
+        if total is not None:
+            self.total = total
+        self.check()
+        now = time.monotonic()
+        if not force and now - self._reported_at < settings.JOB_PROGRESS_INTERVAL:
+            return
+        self._reported_at = now
+
+        values: Dict[str, Any] = {"progress_done": done}
+        if total is not None:
+            values["progress_total"] = total
+        if message is not None:
+            values["message"] = message
+        JobService._update(self.job_id, **values)
+
+
+class JobService:
+    """
+    Persistent queue for long-running storage operations, run on a pool of
+    JOB_WORKERS threads inside the server process. Jobs survive restarts: any
+    that were queued or running when the server stopped start again on startup,
+    so handlers must be safe to run again from the beginning.
+    """
+
+    @staticmethod
+    def register(kind: str):
+        """
+        Decorator adding a handler for a kind of job
+        """
+        def decorator(handler):
+            _handlers[kind] = handler
+            return handler
+        return decorator
+
+    @staticmethod
+    def kinds() -> List[str]:
+        return sorted(_handlers)
+
+    @staticmethod
+    def result_path(job_id: str) -> str:
+        """
+        Where a job that produces a file, such as an archive, writes it
+        """
+        return data_path("jobs", job_id)
+
+    @staticmethod
+    def _get_pool() -> ThreadPoolExecutor:
+        global _pool
+        with _pool_lock:
+            if _pool is None:
+                _stopping.clear()
+                _pool = ThreadPoolExecutor(max_workers=settings.JOB_WORKERS, thread_name_prefix="job")
+            return _pool
+
+    @staticmethod
+    def start(db: Session) -> int:
+        """
+        Queue again the jobs a previous run left unfinished. Returns how many.
+        """
+        pending = db.query(Job).filter(Job.status.in_(("queued", "running"))).order_by(Job.created_at).all()
+        for job in pending:
+            job.status = "queued"
+        db.commit()
+        for job in pending:
+            JobService._get_pool().submit(JobService._run, job.id)
+        return len(pending)
+
+    @staticmethod
+    def shutdown() -> None:
+        """
+        Stop the workers. Running jobs stop at their next progress report and stay
+        queued for the next start.
+        """
+        global _pool
+        with _pool_lock:
+            if _pool is not None:
+                _stopping.set()
+                _pool.shutdown(wait=True, cancel_futures=True)
+                _pool = None
+
+    @staticmethod
+    def submit(db: Session, kind: str, params: Optional[Dict[str, Any]] = None) -> Job:
+        """
+        Record a job and queue it on the worker pool
+        """
+        if kind not in _handlers:
+            raise ValueError(f"Unknown job kind {kind}; expected one of: {', '.join(JobService.kinds())}")
+
+        job = Job(id=str(uuid.uuid4()), kind=kind, status="queued", params=params or {})
+        db.add(job)
+        db.commit()
+        db.refresh(job)
+        JobService._get_pool().submit(JobService._run, job.id)
+        return job
+
+    @staticmethod
+    def get_job(db: Session, job_id: str) -> Optional[Job]:
+        return db.query(Job).filter(Job.id == job_id).first()
+
+    @staticmethod
+    def list_jobs(db: Session, status: Optional[str] = None, limit: int = 50) -> List[Job]:
+        """
+        Most recent jobs first
+        """
+        query = db.query(Job)
+        if status:
+            query = query.filter(Job.status == status)
+        return query.order_by(Job.created_at.desc()).limit(limit).all()
+
+    @staticmethod
+    def cancel(db: Session, job_id: str) -> Optional[Job]:
+        """
+        Cancel a job. A queued job never starts; a running one stops at its next
+        progress report, keeping whatever it finished so far.
+        """
+        job = JobService.get_job(db, job_id)
+        if not job or job.finished:
+            return job
+
+        # Conditional, since a worker may claim the job at any moment
+        cancelled_queued = db.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == "queued")
+            .values(status="cancelled", finished_at=datetime.utcnow())
+        ).rowcount
+        db.commit()
+        if not cancelled_queued:
+            _cancelled.add(job_id)
+        db.refresh(job)
+        return job
+
+    @staticmethod
+    def delete_job(db: Session, job_id: str) -> bool:
+        """
+        Forget a finished job and remove any file it produced
+        """
+        job = JobService.get_job(db, job_id)
+        if not job:
+            return False
+        if not job.finished:
+            raise ValueError("Only finished jobs can be deleted; cancel it first")
+        db.delete(job)
+        db.commit()
+        if os.path.exists(JobService.result_path(job_id)):
+            os.remove(JobService.result_path(job_id))
+        return True
+
+    @staticmethod
+    def _update(job_id: str, **values) -> None:
+        db = SessionLocal()
+        try:
+            db.execute(update(Job).where(Job.id == job_id).values(updated_at=datetime.utcnow(), **values))
+            db.commit()
+        finally:
+            db.close()
+
+    @staticmethod
+    def _run(job_id: str) -> None:
+        db = SessionLocal()
+        try:
+            if _stopping.is_set():
+                return
+            # Claim the job unless it was cancelled while it waited
+            claimed = db.execute(
+                update(Job)
+                .where(Job.id == job_id, Job.status == "queued")
+                .values(status="running", started_at=datetime.utcnow(), error=None)
+            ).rowcount
+            db.commit()
+            if not claimed:
+                return
+            job = JobService.get_job(db, job_id)
+            kind, params = job.kind, dict(job.params)
+            db.commit()
+
+            context = JobContext(job_id)
+            try:
+                result = _handlers[kind](db, context, params)
+            except JobCancelled:
+                db.rollback()
+                if job_id in _cancelled:
+                    JobService._update(
+                        job_id, status="cancelled", progress_done=context.done, finished_at=datetime.utcnow()
+                    )
+                else:
+                    JobService._update(job_id, status="queued", message="Interrupted by shutdown")
+                return
+            except Exception as e:
+                db.rollback()
+                print(f"Job {job_id} ({kind}) failed: {str(e)}")
+                if not isinstance(e, ValueError):
+                    print(traceback.format_exc())
+                JobService._update(
+                    job_id, status="failed", error=str(e), progress_done=context.done, finished_at=datetime.utcnow()
+                )
+                return
+
+            JobService._update(
+                job_id,
+                status="succeeded",
+                result=result,
+                message=None,
+                progress_done=context.total if context.total is not None else context.done,
+                finished_at=datetime.utcnow()
+            )
+        finally:
+            _cancelled.discard(job_id)
+            db.close()
@@ -0,0 +1,201 @@
+import base64
+import binascii
+import json
+import posixpath
+from datetime import datetime
+from sqlalchemy import Select, select, tuple_
+from sqlalchemy.orm import Session
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from app.core.config import settings
+from app.models.file import File
+from app.models.folder import Folder
+
+SORT_KEYS = ("name", "size", "created_at", "updated_at")
+
+FILE_FIELDS = ("id", "name", "mime_type", "size", "folder_id", "path", "created_at", "updated_at", "download_url")
+FOLDER_FIELDS = (
+    "id", "name", "path", "parent_id", "created_at", "updated_at", "total_size", "file_count", "folder_count"
+)
+
+# Fields computed from other columns rather than selected directly
+DERIVED_FIELDS = {"path": ("name",), "download_url": ("id",)}
+
+
+class ListingService:
+    """
+    Keyset-paginated folder listings. Subfolders come first, then files, each
+    ordered by (sort key, id) so a page is an index range scan that starts where
+    the previous page stopped, however deep into the folder it is.
+    """
+
+    @staticmethod
+    def encode_cursor(phase: str, value: Any = None, row_id: Optional[int] = None) -> str:
+        """
+        Opaque cursor for the row a page ended on; without a row it points at the
+        start of the phase
+        """
+        data: Dict[str, Any] = {"p": phase}
+        if row_id is not None:
+            data["v"] = value.isoformat() if isinstance(value, datetime) else value
+            data["i"] = row_id
+        raw = json.dumps(data).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+    @staticmethod
+    def decode_cursor(cursor: str, sort: str) -> Tuple[str, Optional[Tuple[Any, int]]]:
+        try:
+            raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            data = json.loads(raw)
+            phase = data["p"]
+            if phase not in ("folders", "files"):
+                raise ValueError(phase)
+            if "i" not in data:
+                return phase, None
+            value = data["v"]
+            if sort in ("created_at", "updated_at"):
+                value = datetime.fromisoformat(value)
+            return phase, (value, int(data["i"]))
+        except (binascii.Error, ValueError, KeyError, TypeError) as e:
+            raise ValueError(f"Invalid cursor: {e}")
+
+    @staticmethod
+    def parse_fields(fields: Optional[str]) -> Optional[set]:
+        """
+        Parse a comma-separated sparse field set; None means every field
+        """
+        if not fields:
+            return None
+        requested = {field.strip() for field in fields.split(",") if field.strip()}
+        unknown = requested - set(FILE_FIELDS) - set(FOLDER_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+        return requested
+
+    @staticmethod
+    def _sort_column(model, sort: str):
+        # A folder's size is the rolled-up size of everything in it
+        if model is Folder and sort == "size":
+            sort = "total_size"
+        return getattr(model, sort)
+
+    @staticmethod
+    def page_statement(
+        model,
+        folder_id: int,
+        sort: str,
+        descending: bool,
+        fields: Sequence[str],
+        after: Optional[Tuple[Any, int]],
+        limit: Optional[int]
+    ) -> Select:
+        """
+        Statement selecting one page of subfolders or files, served by the
+        (parent, sort key) composite indexes. SQLite secondary indexes carry the
+        rowid, so they already end in id as the keyset tiebreaker requires.
+        """
+        sort_column = ListingService._sort_column(model, sort)
+        parent_column = Folder.parent_id if model is Folder else File.folder_id
+
+        columns = {"id", sort_column.key}
+        for field in fields:
+            columns.update(DERIVED_FIELDS.get(field, (field,)))
+        stmt = select(*[getattr(model, column) for column in sorted(columns)]).where(parent_column == folder_id)
+
+        if after is not None:
+            key = tuple_(sort_column, model.id)
+            stmt = stmt.where(key < tuple_(*after) if descending else key > tuple_(*after))
+
+        if descending:
+            stmt = stmt.order_by(sort_column.desc(), model.id.desc())
+        else:
+            stmt = stmt.order_by(sort_column, model.id)
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        return stmt
+
+    @staticmethod
+    def shape_row(row, fields: Sequence[str], folder_path: str) -> Dict[str, Any]:
+        item = {}
+        mapping = row._mapping
+        for field in fields:
+            if field == "path":
+                item["path"] = posixpath.join(folder_path, mapping["name"])
+            elif field == "download_url":
+                item["download_url"] = f"{settings.API_V1_STR}/files/{mapping['id']}/content"
+            else:
+                item[field] = mapping[field]
+        return item
+
+    @staticmethod
+    def plan(
+        sort: str,
+        fields: Optional[set],
+        cursor: Optional[str]
+    ) -> Tuple[List[str], List[str], str, Optional[Tuple[Any, int]]]:
+        """
+        Validate listing arguments. Returns the folder and file field lists, the
+        phase to start in and the keyset position within it.
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Sort must be one of: {', '.join(SORT_KEYS)}")
+        folder_fields = [f for f in FOLDER_FIELDS if fields is None or f in fields]
+        file_fields = [f for f in FILE_FIELDS if fields is None or f in fields]
+
+        phase, after = "folders", None
+        if cursor:
+            phase, after = ListingService.decode_cursor(cursor, sort)
+        return folder_fields, file_fields, phase, after
+
+    @staticmethod
+    def list_contents(
+        db: Session,
+        folder_id: int,
+        folder_path: str,
+        sort: str = "name",
+        descending: bool = False,
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
+        fields: Optional[set] = None
+    ) -> Dict[str, Any]:
+        """
+        One page of a folder's subfolders and files plus the cursor for the next
+        page, or every entry when no limit is given
+        """
+        folder_fields, file_fields, phase, after = ListingService.plan(sort, fields, cursor)
+        subfolders: List[Dict[str, Any]] = []
+        files: List[Dict[str, Any]] = []
+        next_cursor = None
+        remaining = limit
+
+        if phase == "folders":
+            fetch = None if remaining is None else remaining + 1
+            rows = db.execute(ListingService.page_statement(
+                Folder, folder_id, sort, descending, folder_fields, after, fetch
+            )).all()
+            if remaining is not None and len(rows) > remaining:
+                rows = rows[:remaining]
+                last = rows[-1]._mapping
+                sort_key = ListingService._sort_column(Folder, sort).key
+                next_cursor = ListingService.encode_cursor("folders", last[sort_key], last["id"])
+            subfolders = [ListingService.shape_row(row, folder_fields, folder_path) for row in rows]
+            if remaining is not None:
+                remaining -= len(rows)
+            after = None
+
+        if next_cursor is None and (remaining is None or remaining > 0):
+            fetch = None if remaining is None else remaining + 1
+            rows = db.execute(ListingService.page_statement(
+                File, folder_id, sort, descending, file_fields, after, fetch
+            )).all()
+            if remaining is not None and len(rows) > remaining:
+                rows = rows[:remaining]
+                last = rows[-1]._mapping
+                next_cursor = ListingService.encode_cursor("files", last[sort], last["id"])
+            files = [ListingService.shape_row(row, file_fields, folder_path) for row in rows]
+        elif next_cursor is None and remaining == 0:
+            # The page filled up exactly at the end of the folders; files may follow
+            if db.execute(select(File.id).where(File.folder_id == folder_id).limit(1)).first():
+                next_cursor = ListingService.encode_cursor("files")
+
+        return {"subfolders": subfolders, "files": files, "next_cursor": next_cursor}
@@ -0,0 +1,544 @@
+import itertools
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from sqlalchemy import delete, func, or_, select, union_all, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from app.core.config import settings, data_path
+from app.db.base import SessionLocal
+from app.models.blob import Blob
+from app.models.blob_chunk import BlobChunk
+from app.models.file import File
+from app.models.file_version import FileVersion
+from app.models.folder import Folder
+from app.models.scan_checkpoint import ScanCheckpoint
+from app.services.blob_service import BlobService
+from app.services.change_service import ChangeService
+from app.services.folder_service import FolderService
+from app.services.job_service import JobContext
+from app.services.storage_backend import get_backend
+
+# Problems listed in a reconciliation result; the rest are only counted
+MAX_REPORTED = 100
+
+# Levels of directories in the blob store, see BlobService.storage_key
+BLOB_DEPTH = 2
+
+# Changed blob store directories beyond which the blobs table is read in one pass
+# rather than a range query per directory
+BLOB_SCAN_THRESHOLD = 1000
+
+# Directories handed to a worker at a time
+LISTING_BATCH = 256
+
+# Directories whose mtime is this recent are rescanned next time, since a
+# change within the same clock tick would not move it
+MTIME_SETTLE_NS = 2 * 10**9
+
+
+class DiskEntry(NamedTuple):
+    size: int
+    mtime_ns: int
+
+
+class Tracked(NamedTuple):
+    id: int  # Blob ID for the blob store, file ID elsewhere
+    size: Optional[int]
+    folder_id: Optional[int]
+
+
+def subdirectories(path: str, exclude: Optional[str] = None) -> List[Tuple[str, int]]:
+    """
+    (path, mtime_ns) of the directories directly inside a directory. Hidden ones,
+    such as the trash and indexes an OS keeps on a drive, are left out.
+    """
+    try:
+        with os.scandir(path) as entries:
+            return [
+                (entry.path, entry.stat(follow_symlinks=False).st_mtime_ns)
+                for entry in entries
+                if entry.is_dir(follow_symlinks=False) and not entry.name.startswith(".") and entry.path != exclude
+            ]
+    except FileNotFoundError:
+        return []
+
+
+def list_files(path: str) -> Dict[str, DiskEntry]:
+    try:
+        with os.scandir(path) as entries:
+            files = {}
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    files[entry.name] = DiskEntry(stat.st_size, stat.st_mtime_ns)
+            return files
+    except FileNotFoundError:
+        return {}
+
+
+def map_batched(pool: ThreadPoolExecutor, function, items: List) -> Iterator:
+    """
+    Like pool.map, but over batches of items, since listing one directory is too
+    little work for a task of its own, and with only a few batches in flight so
+    listings of a large tree do not pile up in memory. Results come back in order.
+    """
+    pending = deque()
+    for start in range(0, len(items), LISTING_BATCH):
+        batch = items[start:start + LISTING_BATCH]
+        pending.append(pool.submit(lambda batch=batch: [function(item) for item in batch]))
+        if len(pending) > 2 * settings.RECONCILE_WORKERS:
+            yield from pending.popleft().result()
+    while pending:
+        yield from pending.popleft().result()
+
+
+class _Scan:
+    """
+    Options and findings of one reconciliation run
+    """
+
+    def __init__(self, repair: bool, grace_ns: int):
+        self.repair = repair
+        self.grace_ns = grace_ns  # Unrecorded files modified after this may still be in flight
+        self.found = Counter()
+        self.repaired = Counter()
+        self.issues: List[Dict[str, Any]] = []
+        self.missing: List[Tuple[str, int]] = []  # ("blob", blob ID) or ("file", file ID)
+
+    def add(self, kind: str, path: str, detail: Optional[str] = None) -> None:
+        self.found[kind] += 1
+        if len(self.issues) < MAX_REPORTED:
+            self.issues.append({"kind": kind, "path": path, "detail": detail})
+
+
+class ReconcileService:
+    """
+    Compares the storage directory with the catalog: blobs in the blob store
+    with the blobs table, and files from before the blob store with their
+    recorded paths. Directories are listed in parallel and each is compared with
+    the entries the catalog places in it through an indexed range query.
+
+    A scan is incremental: a directory whose mtime and expected entry count
+    match its checkpoint from the last clean scan is not listed again, since
+    adding, removing or renaming a file changes its directory's mtime. A full
+    scan lists everything and also catches files whose contents were changed
+    in place.
+
+    Blob files are only compared with the local storage backend; other backends
+    keep them outside STORAGE_DIR, and only reference counts are checked.
+    """
+
+    @staticmethod
+    def blob_root() -> str:
+        return data_path("blobs")
+
+    @staticmethod
+    def walk(
+        pool: ThreadPoolExecutor,
+        root: str,
+        exclude: Optional[str] = None,
+        max_depth: Optional[int] = None
+    ) -> Dict[str, int]:
+        """
+        mtime_ns of every directory below and including root, down to max_depth,
+        listed a level at a time across the pool
+        """
+        try:
+            directories = {root: os.stat(root).st_mtime_ns}
+        except FileNotFoundError:
+            return {}
+        level = [root]
+        depth = 0
+        while level and (max_depth is None or depth < max_depth):
+            found = [
+                directory
+                for subdirectories in map_batched(pool, lambda path: subdirectories(path, exclude), level)
+                for directory in subdirectories
+            ]
+            directories.update(found)
+            level = [path for path, _ in found]
+            depth += 1
+        return directories
+
+    @staticmethod
+    def _expected_counts(db: Session) -> Dict[str, int]:
+        """
+        How many blobs or files the catalog places in each directory
+        """
+        counts = {}
+        if get_backend().name == "local":
+            blob_root = ReconcileService.blob_root()
+            prefix = func.substr(Blob.sha256, 1, 4)
+            counts = {
+                os.path.join(blob_root, key[:2], key[2:]): count
+                for key, count in db.execute(
+                    select(prefix, func.count()).where(ReconcileService._stored()).group_by(prefix)
+                )
+            }
+        for (path,) in db.execute(
+            select(File.storage_path).where(File.blob_id == None, File.storage_path != None)
+        ):
+            directory = os.path.dirname(path)
+            counts[directory] = counts.get(directory, 0) + 1
+        return counts
+
+    @staticmethod
+    def _blob_prefix(directory: str) -> Optional[str]:
+        """
+        The hash prefix whose blobs live in a blob store directory, None for
+        directories outside the blob store or above its leaves
+        """
+        parts = os.path.relpath(directory, ReconcileService.blob_root()).split(os.sep)
+        if len(parts) != BLOB_DEPTH or parts[0] == os.pardir:
+            return None
+        return "".join(parts)
+
+    @staticmethod
+    def _stored():
+        """
+        Blobs with an object in the blob store; chunked blobs are only their chunks
+        """
+        return or_(Blob.encoding == None, Blob.encoding != "chunked")
+
+    @staticmethod
+    def _stored_size():
+        """
+        Bytes a blob takes in the blob store, which are fewer than its size when compressed
+        """
+        return func.coalesce(Blob.stored_size, Blob.size).label("size")
+
+    @staticmethod
+    def _tracked_blobs(prefixes: List[str]) -> Iterator[Dict[str, Tracked]]:
+        """
+        Blobs by hash for each of the sorted prefixes, in order. A few prefixes are
+        looked up one range query each; for many, the sha256 index is read once
+        from end to end on a session of its own, so repairs can commit meanwhile.
+        """
+        db = SessionLocal()
+        try:
+            if len(prefixes) < BLOB_SCAN_THRESHOLD:
+                for prefix in prefixes:
+                    # Hex digits sort below "g", so this is a range over the sha256 index
+                    rows = db.execute(
+                        select(Blob.id, Blob.sha256, ReconcileService._stored_size())
+                        .where(Blob.sha256 >= prefix, Blob.sha256 < prefix + "g", ReconcileService._stored())
+                    )
+                    yield {row.sha256: Tracked(row.id, row.size, None) for row in rows}
+                    db.commit()
+                return
+
+            rows = iter(db.execute(
+                select(Blob.id, Blob.sha256, ReconcileService._stored_size())
+                .where(ReconcileService._stored())
+                .order_by(Blob.sha256)
+                .execution_options(yield_per=settings.JOB_BATCH_SIZE)
+            ))
+            row = next(rows, None)
+            for prefix in prefixes:
+                while row is not None and row.sha256[:len(prefix)] < prefix:
+                    row = next(rows, None)
+                blobs = {}
+                while row is not None and row.sha256.startswith(prefix):
+                    blobs[row.sha256] = Tracked(row.id, row.size, None)
+                    row = next(rows, None)
+                yield blobs
+        finally:
+            db.close()
+
+    @staticmethod
+    def tracked_files(db: Session, directory: str) -> Dict[str, Tracked]:
+        """
+        Files from before the blob store kept in a directory, by file name
+        """
+        # "0" follows "/", so this is a range over the unique storage_path index
+        start = directory.rstrip(os.sep) + os.sep
+        rows = db.execute(
+            select(File.id, File.storage_path, File.size, File.folder_id)
+            .where(File.storage_path >= start, File.storage_path < start[:-1] + chr(ord(os.sep) + 1))
+            .where(File.blob_id == None)
+        )
+        return {
+            os.path.basename(row.storage_path): Tracked(row.id, row.size, row.folder_id)
+            for row in rows
+            if os.path.dirname(row.storage_path) == directory
+        }
+
+    @staticmethod
+    def _compare(
+        db: Session,
+        scan: _Scan,
+        directory: str,
+        files: Dict[str, DiskEntry],
+        tracked: Dict[str, Tracked],
+        in_blob_store: bool,
+        owned: bool
+    ) -> bool:
+        """
+        Report the differences between a directory and the catalog, repairing what
+        can be repaired safely. Returns True if the directory is left consistent.
+        """
+        consistent = True
+        for name, entry in files.items():
+            path = os.path.join(directory, name)
+            if name in tracked:
+                expected = tracked[name].size
+                if expected is None or entry.size == expected:
+                    continue
+                detail = f"{entry.size} bytes on disk, {expected} recorded"
+                if in_blob_store:
+                    scan.add("corrupt_blob", path, detail)
+                    consistent = False
+                elif scan.repair:
+                    ReconcileService._fix_size(db, tracked[name], entry.size)
+                    scan.add("size_mismatch", path, detail)
+                    scan.repaired["size_mismatch"] += 1
+                else:
+                    scan.add("size_mismatch", path, detail)
+                    consistent = False
+            elif owned and entry.mtime_ns < scan.grace_ns:
+                if not in_blob_store:
+                    if name.startswith("."):
+                        continue  # OS metadata such as .DS_Store
+                    # Possibly the user's own file; never removed
+                    scan.add("untracked_file", path)
+                    consistent = False
+                    continue
+                scan.add("orphan_blob", path)
+                # Checked again right before removing, in case it was stored since the listing
+                if scan.repair and not BlobService.get_by_hash(db, name):
+                    os.remove(path)
+                    scan.repaired["orphan_blob"] += 1
+                else:
+                    consistent = False
+                db.commit()
+            elif owned:
+                consistent = False  # Too recent to judge; looked at again next time
+
+        for name, entry in tracked.items():
+            if name not in files:
+                scan.add("missing_blob" if in_blob_store else "missing_file", os.path.join(directory, name))
+                scan.missing.append(("blob" if in_blob_store else "file", entry.id))
+                consistent = False
+        return consistent
+
+    @staticmethod
+    def _fix_size(db: Session, tracked: Tracked, size: int) -> None:
+        """
+        Record the size a file from before the blob store has on disk now. Its
+        hash no longer describes it, so it is cleared until the next rehash.
+        """
+        db.execute(update(File).where(File.id == tracked.id).values(size=size, content_hash=None))
+        Folder.adjust_totals(db, tracked.folder_id, size=size - (tracked.size or 0))
+        ChangeService.record(db, "file", [tracked.id])
+        db.commit()
+
+    @staticmethod
+    def _check_ref_counts(db: Session, scan: _Scan) -> None:
+        """
+        Compare each blob's reference count with the files, versions and chunked
+        blobs that use it, and forget blobs nothing uses any more
+        """
+        users = union_all(
+            select(File.blob_id.label("blob_id")).where(File.blob_id != None),
+            select(FileVersion.blob_id),
+            select(BlobChunk.chunk_id),
+        ).subquery()
+        references = (
+            select(users.c.blob_id, func.count().label("count"))
+            .group_by(users.c.blob_id)
+            .subquery()
+        )
+        actual = func.coalesce(references.c.count, 0)
+        rows = db.execute(
+            select(Blob.id, Blob.sha256, Blob.ref_count, actual.label("actual"))
+            .outerjoin(references, references.c.blob_id == Blob.id)
+            .where(Blob.ref_count != actual)
+        ).all()
+        db.commit()
+
+        for row in rows:
+            scan.add("ref_count", row.sha256, f"{row.ref_count} recorded, {row.actual} in use")
+        if not scan.repair or not rows:
+            return
+
+        released = []
+        for row in rows:
+            # Counted again inside the write, in case files were added since
+            db.execute(
+                update(Blob)
+                .where(Blob.id == row.id)
+                .values(ref_count=(
+                    select(func.count(File.id)).where(File.blob_id == Blob.id).scalar_subquery()
+                    + select(func.count(FileVersion.id)).where(FileVersion.blob_id == Blob.id).scalar_subquery()
+                    + select(func.count()).where(BlobChunk.chunk_id == Blob.id).scalar_subquery()
+                ))
+            )
+            released.extend(BlobService.forget_unreferenced(db))
+            db.commit()
+        BlobService.remove_files(released)
+        scan.repaired["ref_count"] += len(rows)
+
+    @staticmethod
+    def _remove_stale_temp_files(scan: _Scan) -> None:
+        """
+        Staged files left behind by uploads or imports that never finished
+        """
+        directory = data_path("tmp")
+        for name, entry in list_files(directory).items():
+            if entry.mtime_ns >= scan.grace_ns:
+                continue
+            path = os.path.join(directory, name)
+            scan.add("stale_temp_file", path)
+            if scan.repair:
+                os.remove(path)
+                scan.repaired["stale_temp_file"] += 1
+
+    @staticmethod
+    def _prune(db: Session, scan: _Scan) -> None:
+        """
+        Forget the files whose contents are gone, a batch per transaction
+        """
+        blob_ids = [id for kind, id in scan.missing if kind == "blob"]
+        file_ids = [id for kind, id in scan.missing if kind == "file"]
+        for criteria, ids in ((File.blob_id.in_, blob_ids), (File.id.in_, file_ids)):
+            for start in range(0, len(ids), settings.JOB_BATCH_SIZE):
+                batch = ids[start:start + settings.JOB_BATCH_SIZE]
+                pruned = db.scalar(select(func.count()).select_from(File).where(criteria(batch)))
+                released = FolderService._remove_files(db, criteria(batch))
+                db.commit()
+                BlobService.remove_files(released)
+                scan.repaired["files_pruned"] += pruned
+
+    @staticmethod
+    def save_checkpoints(db: Session, clean: List[Tuple[str, int, int]], stale: List[str]) -> None:
+        """
+        Record (path, mtime_ns, entry count) for directories found consistent and
+        forget the checkpoints of directories that are gone
+        """
+        now = datetime.utcnow()
+        for start in range(0, len(clean), settings.JOB_BATCH_SIZE):
+            statement = insert(ScanCheckpoint)
+            db.execute(
+                statement.on_conflict_do_update(
+                    index_elements=[ScanCheckpoint.path],
+                    set_={
+                        "mtime_ns": statement.excluded.mtime_ns,
+                        "entry_count": statement.excluded.entry_count,
+                        "scanned_at": statement.excluded.scanned_at,
+                    }
+                ),
+                [
+                    {"path": path, "mtime_ns": mtime_ns, "entry_count": count, "scanned_at": now}
+                    for path, mtime_ns, count in clean[start:start + settings.JOB_BATCH_SIZE]
+                ]
+            )
+            db.commit()
+        for start in range(0, len(stale), settings.JOB_BATCH_SIZE):
+            db.execute(delete(ScanCheckpoint).where(ScanCheckpoint.path.in_(stale[start:start + settings.JOB_BATCH_SIZE])))
+            db.commit()
+
+    @staticmethod
+    def reconcile(
+        db: Session,
+        context: JobContext,
+        full: bool = False,
+        repair: bool = False,
+        prune_missing: bool = False
+    ) -> Dict[str, Any]:
+        """
+        Scan storage against the catalog. Reports orphaned blobs, files in storage
+        the catalog does not know, missing contents, size mismatches, wrong blob
+        reference counts and leftover staged files. With repair, orphaned blobs and
+        staged files are removed and sizes and reference counts are corrected; files
+        outside the blob store are never removed. With prune_missing, files whose
+        contents are gone are dropped from the catalog.
+        """
+        started = time.time()
+        scan_ns = time.time_ns()
+        scan = _Scan(repair, scan_ns - settings.RECONCILE_GRACE_PERIOD * 10**9)
+
+        expected = ReconcileService._expected_counts(db)
+        checkpoints = {
+            row.path: (row.mtime_ns, row.entry_count)
+            for row in db.execute(select(ScanCheckpoint.path, ScanCheckpoint.mtime_ns, ScanCheckpoint.entry_count))
+        }
+        db.commit()
+        context.progress(0, None, "Listing directories", force=True)
+
+        with ThreadPoolExecutor(max_workers=settings.RECONCILE_WORKERS, thread_name_prefix="reconcile") as pool:
+            owned = ReconcileService.walk(pool, settings.STORAGE_DIR, exclude=data_path())
+            blob_store = {}
+            if get_backend().name == "local":
+                blob_store = ReconcileService.walk(pool, ReconcileService.blob_root(), max_depth=BLOB_DEPTH)
+            owned.update(blob_store)
+            # Files recorded outside STORAGE_DIR are checked, but their directories are not the drive's to judge
+            directories = dict(owned)
+            for directory in expected:
+                if directory not in directories:
+                    try:
+                        directories[directory] = os.stat(directory).st_mtime_ns
+                    except FileNotFoundError:
+                        directories[directory] = None
+
+            changed = sorted(
+                directory
+                for directory, mtime_ns in directories.items()
+                if full or mtime_ns is None or checkpoints.get(directory) != (mtime_ns, expected.get(directory, 0))
+            )
+            prefixes = {directory: ReconcileService._blob_prefix(directory) for directory in changed}
+            blob_leaves = [directory for directory in changed if prefixes[directory]]
+            others = [directory for directory in changed if not prefixes[directory]]
+            total = len(changed)
+            context.progress(0, total, f"Comparing {total} of {len(directories)} directories", force=True)
+
+            clean: List[Tuple[str, int, int]] = []
+            files_checked = 0
+            comparisons = zip(
+                blob_leaves + others,
+                map_batched(pool, list_files, blob_leaves + others),
+                itertools.chain(
+                    ReconcileService._tracked_blobs([prefixes[directory] for directory in blob_leaves]),
+                    (
+                        {} if directory in blob_store else ReconcileService.tracked_files(db, directory)
+                        for directory in others
+                    )
+                )
+            )
+            for done, (directory, files, tracked) in enumerate(comparisons, start=1):
+                files_checked += len(files)
+                consistent = ReconcileService._compare(
+                    db, scan, directory, files, tracked, directory in blob_store, directory in owned
+                )
+                mtime_ns = directories[directory]
+                if consistent and mtime_ns is not None and mtime_ns < scan_ns - MTIME_SETTLE_NS:
+                    clean.append((directory, mtime_ns, expected.get(directory, 0)))
+                if done % LISTING_BATCH == 0:
+                    db.commit()
+                context.progress(done, total)
+            db.commit()
+
+        context.progress(total, total, "Checking blob references", force=True)
+        ReconcileService._check_ref_counts(db, scan)
+        ReconcileService._remove_stale_temp_files(scan)
+        if prune_missing and scan.missing:
+            ReconcileService._prune(db, scan)
+
+        stale = [path for path in checkpoints if path not in directories]
+        ReconcileService.save_checkpoints(db, clean, stale)
+
+        return {
+            "full": full,
+            "repair": repair,
+            "directories": len(directories),
+            "directories_scanned": total,
+            "files_checked": files_checked,
+            "found": dict(scan.found),
+            "repaired": dict(scan.repaired),
+            "issues": scan.issues,
+            "seconds": round(time.time() - started, 2),
+        }
@@ -0,0 +1,300 @@
+import posixpath
+from sqlalchemy import Connection, column, delete, func, insert, literal, literal_column, null, select, table, text, update
+from sqlalchemy.orm import Session
+from typing import Any, Dict, List, Optional
+
+from app.core.config import settings
+from app.models.file import File
+from app.models.folder import Folder
+from app.models.folder_closure import FolderClosure
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # pypdf is optional; PDFs are indexed by name only without it
+    PdfReader = None
+
+# FTS5 tables keyed by rowid = files.id / folders.id. The trigram tokenizer
+# matches any substring of three or more characters, case-insensitively.
+files_fts = table("files_fts", column("rowid"), column("name"), column("content"))
+folders_fts = table("folders_fts", column("rowid"), column("name"))
+
+TEXT_MIME_TYPES = {
+    "application/json", "application/xml", "application/javascript",
+    "application/x-sh", "application/x-yaml", "application/sql",
+}
+
+SEARCH_KINDS = ("all", "file", "folder")
+
+# Weight of a name match relative to a content match in the ranking
+NAME_WEIGHT = 10.0
+
+
+class SearchService:
+    """
+    Name and content search over files and folders. Paths are not indexed:
+    they are derived from folder names, so renaming or moving a folder stays a
+    single-row change. Searches can instead be scoped to a folder's subtree.
+    """
+
+    @staticmethod
+    def create_index(conn: Connection) -> None:
+        conn.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(name, content, tokenize='trigram')"
+        ))
+        conn.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS folders_fts USING fts5(name, tokenize='trigram')"
+        ))
+
+    @staticmethod
+    def backfill(db: Session) -> int:
+        """
+        Index the names of files and folders created before the search index existed.
+        Returns the number of entries added.
+        """
+        added = db.execute(
+            insert(files_fts).from_select(
+                ["rowid", "name", "content"],
+                select(File.id, File.name, literal(""))
+                .where(File.id.notin_(select(files_fts.c.rowid)))
+            )
+        ).rowcount
+        added += db.execute(
+            insert(folders_fts).from_select(
+                ["rowid", "name"],
+                select(Folder.id, Folder.name)
+                .where(Folder.parent_id != None, Folder.id.notin_(select(folders_fts.c.rowid)))
+            )
+        ).rowcount
+        db.commit()
+        return added
+
+    @staticmethod
+    def has_text(mime_type: Optional[str]) -> bool:
+        """
+        Whether contents of a type have text extract_text can read
+        """
+        mime_type = (mime_type or "").lower()
+        return (
+            mime_type.startswith("text/")
+            or mime_type in TEXT_MIME_TYPES
+            or (mime_type == "application/pdf" and PdfReader is not None)
+        )
+
+    @staticmethod
+    def extract_text(path: str, mime_type: Optional[str]) -> str:
+        """
+        Searchable text of a file's contents, capped at SEARCH_MAX_TEXT_BYTES.
+        Returns an empty string for types without extractable text.
+        """
+        mime_type = (mime_type or "").lower()
+        limit = settings.SEARCH_MAX_TEXT_BYTES
+        try:
+            if mime_type.startswith("text/") or mime_type in TEXT_MIME_TYPES:
+                with open(path, "rb") as f:
+                    return f.read(limit).decode("utf-8", errors="ignore")
+            if mime_type == "application/pdf" and PdfReader is not None:
+                parts = []
+                length = 0
+                for page in PdfReader(path).pages[:settings.SEARCH_MAX_PDF_PAGES]:
+                    page_text = page.extract_text() or ""
+                    parts.append(page_text)
+                    length += len(page_text)
+                    if length >= limit:
+                        break
+                return "\n".join(parts)[:limit]
+        except Exception as e:
+            # An unreadable document is still findable by name
+            print(f"Could not extract text from {path}: {str(e)}")
+        return ""
+
+    @staticmethod
+    def index_file(db: Session, file: File, content: Optional[str] = None) -> None:
+        """
+        Add a new file to the index. Content already extracted for another file
+        with the same blob is reused. The caller commits.
+        """
+        if not content and file.blob_id is not None:
+            content = db.execute(
+                select(files_fts.c.content).where(
+                    files_fts.c.rowid == select(File.id).where(
+                        File.blob_id == file.blob_id, File.id != file.id
+                    ).limit(1).scalar_subquery()
+                )
+            ).scalar()
+        db.execute(insert(files_fts).values(rowid=file.id, name=file.name, content=content or ""))
+
+    @staticmethod
+    def index_files(db: Session, entries: List[Dict[str, Any]]) -> None:
+        """
+        Add many new files to the index in one statement. Entries hold rowid, name
+        and content. The caller commits.
+        """
+        if entries:
+            db.execute(insert(files_fts), entries)
+
+    @staticmethod
+    def copy_file(db: Session, source_id: int, file: File) -> None:
+        """
+        Index a copy of a file under its own name, sharing the source's content text
+        """
+        db.execute(
+            insert(files_fts).from_select(
+                ["rowid", "name", "content"],
+                select(literal(file.id), literal(file.name), files_fts.c.content)
+                .where(files_fts.c.rowid == source_id)
+            )
+        )
+
+    @staticmethod
+    def rename_file(db: Session, file_id: int, name: str) -> None:
+        db.execute(update(files_fts).where(files_fts.c.rowid == file_id).values(name=name))
+
+    @staticmethod
+    def remove_file(db: Session, file_id: int) -> None:
+        db.execute(delete(files_fts).where(files_fts.c.rowid == file_id))
+
+    @staticmethod
+    def remove_files(db: Session, file_ids) -> None:
+        """
+        Drop the entries of the files whose IDs the given subquery selects
+        """
+        db.execute(delete(files_fts).where(files_fts.c.rowid.in_(file_ids)))
+
+    @staticmethod
+    def index_folder(db: Session, folder: Folder) -> None:
+        db.execute(insert(folders_fts).values(rowid=folder.id, name=folder.name))
+
+    @staticmethod
+    def rename_folder(db: Session, folder_id: int, name: str) -> None:
+        db.execute(update(folders_fts).where(folders_fts.c.rowid == folder_id).values(name=name))
+
+    @staticmethod
+    def remove_folders(db: Session, folder_ids) -> None:
+        """
+        Drop the entries of the folders whose IDs the given subquery selects
+        """
+        db.execute(delete(folders_fts).where(folders_fts.c.rowid.in_(folder_ids)))
+
+    @staticmethod
+    def _match_expression(terms: List[str]) -> Optional[str]:
+        # Each term is a quoted phrase, so user input cannot inject FTS5 syntax
+        phrases = ['"' + term.replace('"', '""') + '"' for term in terms]
+        return " ".join(phrases) or None
+
+    @staticmethod
+    def _like(term: str) -> str:
+        return "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+    @staticmethod
+    def search(
+        db: Session,
+        query: str,
+        kind: str = "all",
+        folder_id: Optional[int] = None,
+        limit: int = 50,
+        offset: int = 0
+    ) -> Dict[str, Any]:
+        """
+        Ranked search over file names and contents and folder names. Every term
+        must match. Terms shorter than three characters are too short for the
+        trigram index and are applied as a name filter instead.
+        """
+        if kind not in SEARCH_KINDS:
+            raise ValueError(f"Type must be one of: {', '.join(SEARCH_KINDS)}")
+        terms = query.split()
+        if not terms:
+            raise ValueError("Search query must not be empty")
+        match = SearchService._match_expression([term for term in terms if len(term) >= 3])
+        short_terms = [SearchService._like(term) for term in terms if len(term) < 3]
+
+        selects = []
+        if kind in ("all", "folder"):
+            stmt = select(
+                literal("folder").label("kind"),
+                folders_fts.c.rowid.label("id"),
+                (func.bm25(literal_column("folders_fts"), NAME_WEIGHT) if match else literal(0.0)).label("rank"),
+                null().label("snippet")
+            )
+            if match:
+                stmt = stmt.where(literal_column("folders_fts").op("MATCH")(match))
+            for pattern in short_terms:
+                stmt = stmt.where(folders_fts.c.name.like(pattern, escape="\\"))
+            if folder_id is not None:
+                stmt = stmt.where(folders_fts.c.rowid.in_(
+                    select(FolderClosure.descendant_id)
+                    .where(FolderClosure.ancestor_id == folder_id, FolderClosure.depth > 0)
+                ))
+            selects.append(stmt)
+
+        if kind in ("all", "file"):
+            stmt = select(
+                literal("file").label("kind"),
+                files_fts.c.rowid.label("id"),
+                (func.bm25(literal_column("files_fts"), NAME_WEIGHT, 1.0) if match else literal(0.0)).label("rank"),
+                (func.snippet(literal_column("files_fts"), 1, "[", "]", "…", 12) if match else null()).label("snippet")
+            )
+            if match:
+                stmt = stmt.where(literal_column("files_fts").op("MATCH")(match))
+            for pattern in short_terms:
+                stmt = stmt.where(files_fts.c.name.like(pattern, escape="\\"))
+            if folder_id is not None:
+                stmt = stmt.where(files_fts.c.rowid.in_(
+                    select(File.id).where(File.folder_id.in_(
+                        select(FolderClosure.descendant_id).where(FolderClosure.ancestor_id == folder_id)
+                    ))
+                ))
+            selects.append(stmt)
+
+        combined = selects[0] if len(selects) == 1 else selects[0].union_all(*selects[1:])
+        hits = db.execute(
+            select(combined.subquery())
+            .order_by(text("rank"), text("kind"), text("id"))
+            .limit(limit + 1)
+            .offset(offset)
+        ).all()
+
+        next_offset = None
+        if len(hits) > limit:
+            hits = hits[:limit]
+            next_offset = offset + limit
+
+        results = SearchService._load_results(db, hits)
+        return {"results": results, "next_offset": next_offset}
+
+    @staticmethod
+    def _load_results(db: Session, hits) -> List[Dict[str, Any]]:
+        folder_ids = [hit.id for hit in hits if hit.kind == "folder"]
+        file_ids = [hit.id for hit in hits if hit.kind == "file"]
+        folders = {folder.id: folder for folder in db.query(Folder).filter(Folder.id.in_(folder_ids))} if folder_ids else {}
+        files = {file.id: file for file in db.query(File).filter(File.id.in_(file_ids))} if file_ids else {}
+        paths = Folder.paths_of(db, folder_ids + [file.folder_id for file in files.values()])
+
+        results = []
+        for hit in hits:
+            if hit.kind == "folder" and hit.id in folders:
+                folder = folders[hit.id]
+                results.append({
+                    "kind": "folder",
+                    "id": folder.id,
+                    "name": folder.name,
+                    "path": paths[folder.id],
+                    "parent_id": folder.parent_id,
+                    "updated_at": folder.updated_at,
+                    "rank": hit.rank,
+                })
+            elif hit.kind == "file" and hit.id in files:
+                file = files[hit.id]
+                results.append({
+                    "kind": "file",
+                    "id": file.id,
+                    "name": file.name,
+                    "path": posixpath.join(paths[file.folder_id], file.name),
+                    "parent_id": file.folder_id,
+                    "mime_type": file.mime_type,
+                    "size": file.size,
+                    "updated_at": file.updated_at,
+                    "download_url": file.download_url,
+                    "snippet": hit.snippet or None,
+                    "rank": hit.rank,
+                })
+        return results
@@ -0,0 +1,162 @@
+import posixpath
+import shutil
+from sqlalchemy import func, select, text
+from sqlalchemy.orm import Session
+from typing import Any, Dict, List
+
+from app.core.config import settings
+from app.db import base
+from app.db.base import engine, read_engine
+from app.models.blob import Blob
+from app.models.file import File, created_month
+from app.models.folder import Folder
+
+# Copies listed per duplicate cluster
+DUPLICATE_SAMPLE_PATHS = 5
+
+
+class StatsService:
+    @staticmethod
+    def _pool_stats(db_engine) -> Dict[str, Any]:
+        pool = db_engine.pool
+        stats = pool.stats.as_dict()
+        stats.update({
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "overflow": max(pool.overflow(), 0),
+        })
+        return stats
+
+    @staticmethod
+    def database() -> Dict[str, Any]:
+        """
+        Connection pool usage and lock wait times. Writer waits are time spent
+        queued behind other writes; busy errors are lock timeouts from SQLite itself.
+        """
+        with read_engine.connect() as conn:
+            journal_mode = conn.execute(text("PRAGMA journal_mode")).scalar()
+        stats = {
+            "journal_mode": journal_mode,
+            "writer": StatsService._pool_stats(engine),
+            "readers": StatsService._pool_stats(read_engine),
+        }
+        if base.async_engine is not None:
+            stats["async_readers"] = StatsService._pool_stats(base.async_engine.sync_engine)
+        return stats
+
+    @staticmethod
+    def _size_groups(db: Session, key) -> List[Dict[str, Any]]:
+        rows = db.execute(
+            select(key.label("key"), func.count().label("file_count"), func.coalesce(func.sum(File.size), 0).label("total_size"))
+            .group_by(key)
+            .order_by(text("total_size DESC"))
+        ).all()
+        return [row._asdict() for row in rows]
+
+    @staticmethod
+    def _by_folder(db: Session, root: Folder, limit: int) -> List[Dict[str, Any]]:
+        """
+        The largest top-level folders, read from their rolled-up totals, and the
+        files kept directly in the root folder
+        """
+        folders = (
+            db.query(Folder)
+            .filter(Folder.parent_id == root.id)
+            .order_by(Folder.total_size.desc())
+            .limit(limit)
+            .all()
+        )
+        loose_count, loose_size = db.execute(
+            select(func.count(), func.coalesce(func.sum(File.size), 0)).where(File.folder_id == root.id)
+        ).one()
+
+        usage = [
+            {"id": folder.id, "name": folder.name, "path": "/" + folder.name,
+             "file_count": folder.file_count, "total_size": folder.total_size}
+            for folder in folders
+        ]
+        if loose_count:
+            usage.append({"id": None, "name": "(files in root)", "path": "/", "file_count": loose_count, "total_size": loose_size})
+            usage.sort(key=lambda entry: entry["total_size"], reverse=True)
+        return usage
+
+    @staticmethod
+    def _largest_files(db: Session, limit: int) -> List[Dict[str, Any]]:
+        files = db.query(File).filter(File.size != None).order_by(File.size.desc()).limit(limit).all()
+        paths = Folder.paths_of(db, [file.folder_id for file in files])
+        return [
+            {"id": file.id, "name": file.name, "path": posixpath.join(paths[file.folder_id], file.name),
+             "mime_type": file.mime_type, "size": file.size}
+            for file in files
+        ]
+
+    @staticmethod
+    def _duplicates(db: Session, limit: int) -> Dict[str, Any]:
+        """
+        Contents shared by several files. The blob store keeps one copy on disk,
+        so these cost catalog space rather than disk space, but they are usually
+        the copies worth cleaning up.
+        """
+        wasted = Blob.size * (Blob.ref_count - 1)
+        cluster_count, reclaimable = db.execute(
+            select(func.count(), func.coalesce(func.sum(wasted), 0)).where(Blob.ref_count > 1)
+        ).one()
+        blobs = db.query(Blob).filter(Blob.ref_count > 1).order_by(wasted.desc()).limit(limit).all()
+
+        clusters = []
+        for blob in blobs:
+            files = (
+                db.query(File)
+                .filter(File.blob_id == blob.id)
+                .order_by(File.id)
+                .limit(DUPLICATE_SAMPLE_PATHS)
+                .all()
+            )
+            paths = Folder.paths_of(db, [file.folder_id for file in files])
+            clusters.append({
+                "content_hash": blob.sha256,
+                "size": blob.size,
+                "copies": blob.ref_count,
+                "reclaimable_size": blob.size * (blob.ref_count - 1),
+                "paths": [posixpath.join(paths[file.folder_id], file.name) for file in files],
+            })
+        return {"cluster_count": cluster_count, "reclaimable_size": reclaimable, "largest": clusters}
+
+    @staticmethod
+    def storage(db: Session, limit: int = 20) -> Dict[str, Any]:
+        """
+        What is using the storage drive: totals by mime type, top-level folder
+        and month of upload, the largest files and the largest sets of duplicates,
+        with the volume's free space. Every aggregate is read from folder totals
+        or answered from a covering index, without touching file contents.
+        """
+        volume = shutil.disk_usage(settings.STORAGE_DIR)
+        root = db.query(Folder).filter(Folder.parent_id == None).order_by(Folder.id).first()
+        stored_size, compression_saved = db.execute(select(
+            func.coalesce(func.sum(func.coalesce(Blob.stored_size, Blob.size)), 0),
+            func.coalesce(func.sum(Blob.size - Blob.stored_size).filter(Blob.encoding.in_(("gzip", "zstd"))), 0),
+        )).one()
+        stored_size += db.execute(
+            select(func.coalesce(func.sum(File.size), 0)).where(File.blob_id == None, File.storage_path != None)
+        ).scalar()
+
+        return {
+            "volume": {
+                "path": settings.STORAGE_DIR,
+                "total": volume.total,
+                "used": volume.used,
+                "free": volume.free,
+            },
+            "totals": {
+                "file_count": root.file_count if root else 0,
+                "folder_count": root.folder_count if root else 0,
+                "logical_size": root.total_size if root else 0,
+                "stored_size": stored_size,
+                "compression_saved_size": compression_saved,
+            },
+            "by_type": StatsService._size_groups(db, File.mime_type),
+            "by_month": StatsService._size_groups(db, created_month),
+            "by_folder": StatsService._by_folder(db, root, limit) if root else [],
+            "largest_files": StatsService._largest_files(db, limit),
+            "duplicates": StatsService._duplicates(db, limit),
+        }
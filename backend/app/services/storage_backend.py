@@ -0,0 +1,527 @@
+import errno
+import hashlib
+import hmac
+import http.client
+import io
+import itertools
+import os
+import queue
+import random
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from urllib.parse import quote, urlsplit
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+from app.core.config import settings, data_path
+
+# Blob locations remembered by the sharded backend before the memory is reset
+LOCATION_CACHE_SIZE = 1_000_000
+
+
+class ObjectInfo(NamedTuple):
+    """
+    The parts of os.stat_result that callers use, for objects not on a local filesystem
+    """
+    st_size: int
+    st_mtime_ns: int
+
+    @property
+    def st_mtime(self) -> float:
+        return self.st_mtime_ns / 10**9
+
+
+class StorageBackend:
+    """
+    Where blob contents are kept, addressed by storage key. Blobs are immutable:
+    they are put once, read whole or by range, and deleted. The default methods
+    work on local_path, so local backends only say where a key lives.
+    """
+
+    name = "local"
+
+    def local_path(self, key: str) -> Optional[str]:
+        """
+        Path of the object on a local filesystem, or None if it is kept remotely
+        """
+        raise NotImplementedError
+
+    def put(self, key: str, staged_path: str, folder: Optional[str] = None) -> None:
+        """
+        Take ownership of a staged file as the object's contents. Folder names the
+        top-level folder it is stored under, for backends that place by folder.
+        """
+        raise NotImplementedError
+
+    def spread(self, keys: List[str]) -> List[List[str]]:
+        """
+        Group keys by the device holding them, so bulk reads can run one stream
+        per device at once
+        """
+        return [keys] if keys else []
+
+    def open(self, key: str) -> BinaryIO:
+        """
+        Stream the contents. Raises FileNotFoundError if the object is missing.
+        """
+        return open(self.local_path(key), "rb")
+
+    def iter_range(self, key: str, start: int, end: int) -> Iterator[bytes]:
+        """
+        Read an inclusive byte range with positional reads, in chunks
+        """
+        fd = os.open(self.local_path(key), os.O_RDONLY)
+        try:
+            position = start
+            while position <= end:
+                chunk = os.pread(fd, min(settings.UPLOAD_CHUNK_SIZE, end - position + 1), position)
+                if not chunk:
+                    break
+                position += len(chunk)
+                yield chunk
+        finally:
+            os.close(fd)
+
+    def stat(self, key: str):
+        """
+        Size and mtime of the object. Raises FileNotFoundError if it is missing.
+        """
+        return os.stat(self.local_path(key))
+
+    def delete(self, key: str) -> None:
+        """
+        Remove the object, if it is there
+        """
+        try:
+            os.remove(self.local_path(key))
+        except FileNotFoundError:
+            pass
+
+
+def _place(staged_path: str, target: str) -> None:
+    """
+    Move a staged file into place: a rename on the same filesystem, otherwise a
+    copy through a partial file, so the target never exists half written
+    """
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.replace(staged_path, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        partial = f"{target}.part"
+        try:
+            shutil.copyfile(staged_path, partial)
+            os.replace(partial, target)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        os.remove(staged_path)
+
+
+class LocalBackend(StorageBackend):
+    """
+    Blobs under a single directory, by default inside STORAGE_DIR
+    """
+
+    name = "local"
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def local_path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def put(self, key: str, staged_path: str, folder: Optional[str] = None) -> None:
+        _place(staged_path, self.local_path(key))
+
+
+class ShardedBackend(StorageBackend):
+    """
+    Blobs spread over directories on several disks. Where a new blob goes is
+    decided by STORAGE_PLACEMENT among the disks with room for it:
+
+    - "hash": disks are ranked per key by rendezvous hashing and the first is
+      used, so adding a disk draws only new blobs to it and nothing has to move
+    - "free_space": a disk picked at random, weighted by its free space
+    - "round_robin": each disk in turn
+
+    Top-level folders listed in STORAGE_PINNED_FOLDERS keep their blobs on the
+    given disk whatever the policy. Lookups remember where blobs were found and
+    otherwise try the disks in rendezvous order, where "hash" placement finds
+    them first time.
+    """
+
+    name = "sharded"
+
+    def __init__(self, roots: List[str], placement: str = "hash", pinned: Optional[Dict[str, str]] = None):
+        if not roots:
+            raise ValueError("The sharded storage backend needs at least one directory")
+        if placement not in ("hash", "free_space", "round_robin"):
+            raise ValueError(f"Unknown placement {placement}; expected hash, free_space or round_robin")
+        self.pinned = pinned or {}
+        unknown = set(self.pinned.values()) - set(roots)
+        if unknown:
+            raise ValueError(f"Pinned folders name directories that are not storage disks: {', '.join(sorted(unknown))}")
+        self.roots = roots
+        self.placement = placement
+        self._turn = itertools.count()
+        self._located: Dict[str, str] = {}  # Key -> disk it was last seen on
+        self._lock = threading.Lock()
+
+    def _ranked(self, key: str) -> List[str]:
+        return sorted(
+            self.roots,
+            key=lambda root: hashlib.blake2b(f"{root}\0{key}".encode(), digest_size=8).digest(),
+            reverse=True
+        )
+
+    def _remember(self, key: str, root: str) -> None:
+        with self._lock:
+            if len(self._located) >= LOCATION_CACHE_SIZE:
+                self._located.clear()
+            self._located[key] = root
+
+    def locate(self, key: str) -> Optional[str]:
+        """
+        The disk holding a blob, or None if no disk does
+        """
+        remembered = self._located.get(key)
+        if remembered is not None and os.path.exists(os.path.join(remembered, key)):
+            return remembered
+        for root in self._ranked(key):
+            if os.path.exists(os.path.join(root, key)):
+                self._remember(key, root)
+                return root
+        return None
+
+    def local_path(self, key: str) -> str:
+        """
+        Path on the disk that holds the blob, or on its first choice if none does
+        """
+        return os.path.join(self.locate(key) or self._ranked(key)[0], key)
+
+    def free_space(self) -> Dict[str, int]:
+        """
+        Bytes each disk can still take, above STORAGE_SHARD_MIN_FREE
+        """
+        free = {}
+        for root in self.roots:
+            os.makedirs(root, exist_ok=True)
+            free[root] = shutil.disk_usage(root).free - settings.STORAGE_SHARD_MIN_FREE
+        return free
+
+    def _choose(self, key: str, size: int, folder: Optional[str]) -> str:
+        free = self.free_space()
+        candidates = [root for root in self.roots if free[root] >= size]
+        if not candidates:
+            raise OSError(errno.ENOSPC, "No storage disk has room for the file")
+        pinned = self.pinned.get(folder) if folder else None
+        if pinned is not None:
+            if pinned in candidates:
+                return pinned
+            print(f"Disk {pinned} for folder {folder} is full; placing {key} by {self.placement}")
+        if self.placement == "free_space":
+            return random.choices(candidates, weights=[max(free[root], 1) for root in candidates])[0]
+        if self.placement == "round_robin":
+            return candidates[next(self._turn) % len(candidates)]
+        return next(root for root in self._ranked(key) if root in candidates)
+
+    def put(self, key: str, staged_path: str, folder: Optional[str] = None) -> None:
+        root = self._choose(key, os.path.getsize(staged_path), folder)
+        _place(staged_path, os.path.join(root, key))
+        self._remember(key, root)
+
+    def move(self, key: str, source: str, target: str) -> None:
+        """
+        Move a blob to another disk. The copy is complete before the original goes,
+        so readers find one or the other throughout.
+        """
+        partial = os.path.join(target, f"{key}.part")
+        os.makedirs(os.path.dirname(partial), exist_ok=True)
+        try:
+            shutil.copyfile(os.path.join(source, key), partial)
+            os.replace(partial, os.path.join(target, key))
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        self._remember(key, target)
+        try:
+            os.remove(os.path.join(source, key))
+        except FileNotFoundError:
+            pass  # Deleted meanwhile
+
+    def spread(self, keys: List[str]) -> List[List[str]]:
+        by_disk: Dict[Optional[str], List[str]] = {}
+        for key in keys:
+            by_disk.setdefault(self.locate(key), []).append(key)
+        return list(by_disk.values())
+
+    def delete(self, key: str) -> None:
+        root = self.locate(key)
+        if root is not None:
+            try:
+                os.remove(os.path.join(root, key))
+            except FileNotFoundError:
+                pass
+
+
+class _ObjectReader(io.RawIOBase):
+    """
+    Body of an object being downloaded. Closing it returns the connection to the
+    pool, for reuse if the body was read to the end.
+    """
+
+    def __init__(self, backend: "S3Backend", response: http.client.HTTPResponse, connection):
+        self._backend = backend
+        self._response = response
+        self._connection = connection
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        return self._response.readinto(buffer)
+
+    def close(self) -> None:
+        if not self.closed:
+            reusable = self._response.isclosed() and not self._response.will_close
+            self._backend._release(self._connection, reusable)
+        super().close()
+
+
+class S3Backend(StorageBackend):
+    """
+    Blobs in a bucket of an S3-compatible object store, such as MinIO on a NAS
+    or a local test server, with path-style addressing and SigV4 signing.
+    Connections are pooled and kept alive; large blobs are uploaded in parts,
+    several at a time.
+    """
+
+    name = "s3"
+
+    def __init__(self):
+        endpoint = urlsplit(settings.S3_ENDPOINT_URL)
+        self._secure = endpoint.scheme == "https"
+        self._host = endpoint.netloc
+        self._base = f"{endpoint.path.rstrip('/')}/{settings.S3_BUCKET}/{settings.S3_PREFIX}"
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(settings.S3_MAX_CONNECTIONS)
+
+    def local_path(self, key: str) -> None:
+        return None
+
+    def _connection(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            connection_class = http.client.HTTPSConnection if self._secure else http.client.HTTPConnection
+            return connection_class(self._host, timeout=settings.S3_TIMEOUT)
+
+    def _release(self, connection, reusable: bool) -> None:
+        if reusable:
+            self._idle.put(connection)
+        else:
+            connection.close()
+        self._slots.release()
+
+    def _signed_headers(self, method: str, path: str, query: Dict[str, str], headers: Dict[str, str]) -> Dict[str, str]:
+        """
+        Headers with an AWS Signature Version 4 Authorization. Bodies are not
+        hashed into the signature (UNSIGNED-PAYLOAD), so files stream as they are read.
+        """
+        now = datetime.utcnow()
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        scope = f"{amz_date[:8]}/{settings.S3_REGION}/s3/aws4_request"
+        headers = {
+            **{name.lower(): str(value).strip() for name, value in headers.items()},
+            "host": self._host,
+            "x-amz-date": amz_date,
+            "x-amz-content-sha256": "UNSIGNED-PAYLOAD",
+        }
+        signed = ";".join(sorted(headers))
+        canonical = "\n".join([
+            method,
+            path,
+            "&".join(f"{quote(k, safe='-_.~')}={quote(v, safe='-_.~')}" for k, v in sorted(query.items())),
+            "".join(f"{name}:{headers[name]}\n" for name in sorted(headers)),
+            signed,
+            "UNSIGNED-PAYLOAD",
+        ])
+        to_sign = "\n".join([
+            "AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical.encode()).hexdigest()
+        ])
+        signing_key = f"AWS4{settings.S3_SECRET_KEY}".encode()
+        for part in (amz_date[:8], settings.S3_REGION, "s3", "aws4_request"):
+            signing_key = hmac.new(signing_key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(signing_key, to_sign.encode(), hashlib.sha256).hexdigest()
+        headers["authorization"] = (
+            f"AWS4-HMAC-SHA256 Credential={settings.S3_ACCESS_KEY}/{scope}, "
+            f"SignedHeaders={signed}, Signature={signature}"
+        )
+        return headers
+
+    def _send(
+        self,
+        method: str,
+        key: str,
+        query: Optional[Dict[str, str]] = None,
+        headers: Optional[Dict[str, str]] = None,
+        body=None
+    ) -> Tuple[http.client.HTTPResponse, object]:
+        """
+        Send a request on a pooled connection and return the response with its
+        connection, for the caller to release. A kept-alive connection the server
+        closed meanwhile is replaced once.
+        """
+        query = query or {}
+        path = quote(self._base + key, safe="/-_.~")
+        url = path + ("?" + "&".join(f"{quote(k)}={quote(v)}" for k, v in query.items()) if query else "")
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                if hasattr(body, "seek"):
+                    body.seek(0)
+                connection.request(method, url, body=body, headers=self._signed_headers(method, path, query, headers or {}))
+                return connection.getresponse(), connection
+            except (http.client.HTTPException, ConnectionError):
+                self._release(connection, False)
+                if attempt:
+                    raise
+            except BaseException:
+                # Timeouts and other failures are not retried, but must not keep the slot
+                self._release(connection, False)
+                raise
+
+    def _read(self, response: http.client.HTTPResponse, connection) -> bytes:
+        """
+        Read a whole response body and release its connection, also when reading fails
+        """
+        try:
+            data = response.read()
+        except BaseException:
+            self._release(connection, False)
+            raise
+        self._release(connection, not response.will_close)
+        return data
+
+    def _call(self, method: str, key: str, query=None, headers=None, body=None) -> Tuple[Dict[str, str], bytes]:
+        """
+        Make a request and read the whole response. Returns its headers and body.
+        """
+        response, connection = self._send(method, key, query, headers, body)
+        data = self._read(response, connection)
+        if response.status == 404:
+            raise FileNotFoundError(errno.ENOENT, "Object not found in storage", key)
+        if response.status >= 300:
+            raise OSError(f"Storage request {method} {key} failed with {response.status}: {data[:200].decode(errors='replace')}")
+        return {name.lower(): value for name, value in response.getheaders()}, data
+
+    def put(self, key: str, staged_path: str, folder: Optional[str] = None) -> None:
+        size = os.path.getsize(staged_path)
+        if size > settings.S3_MULTIPART_THRESHOLD:
+            self._put_multipart(key, staged_path, size)
+        else:
+            with open(staged_path, "rb") as source:
+                self._call("PUT", key, headers={"Content-Length": size}, body=source)
+        os.remove(staged_path)
+
+    def _put_multipart(self, key: str, staged_path: str, size: int) -> None:
+        _, data = self._call("POST", key, {"uploads": ""})
+        upload_id = ElementTree.fromstring(data).find("{*}UploadId").text
+        parts = [
+            (number, offset, min(settings.S3_PART_SIZE, size - offset))
+            for number, offset in enumerate(range(0, size, settings.S3_PART_SIZE), start=1)
+        ]
+
+        def upload(part: Tuple[int, int, int]) -> str:
+            number, offset, length = part
+            fd = os.open(staged_path, os.O_RDONLY)
+            try:
+                body = os.pread(fd, length, offset)
+            finally:
+                os.close(fd)
+            headers, _ = self._call("PUT", key, {"partNumber": str(number), "uploadId": upload_id}, body=body)
+            return headers["etag"]
+
+        try:
+            with ThreadPoolExecutor(max_workers=settings.S3_UPLOAD_CONCURRENCY, thread_name_prefix="s3-upload") as pool:
+                etags = list(pool.map(upload, parts))
+            manifest = "".join(
+                f"<Part><PartNumber>{number}</PartNumber><ETag>{escape(etag)}</ETag></Part>"
+                for (number, _, _), etag in zip(parts, etags)
+            )
+            _, data = self._call(
+                "POST", key, {"uploadId": upload_id},
+                body=f"<CompleteMultipartUpload>{manifest}</CompleteMultipartUpload>".encode()
+            )
+            # Completion can fail after the status line has gone out as 200
+            if ElementTree.fromstring(data).tag.endswith("Error"):
+                raise OSError(f"Storage upload of {key} failed: {data[:200].decode(errors='replace')}")
+        except BaseException:
+            try:
+                self._call("DELETE", key, {"uploadId": upload_id})
+            except OSError:
+                pass
+            raise
+
+    def open(self, key: str) -> BinaryIO:
+        response, connection = self._send("GET", key)
+        if response.status >= 300:
+            data = self._read(response, connection)
+            if response.status == 404:
+                raise FileNotFoundError(errno.ENOENT, "Object not found in storage", key)
+            raise OSError(f"Storage request GET {key} failed with {response.status}: {data[:200].decode(errors='replace')}")
+        return io.BufferedReader(_ObjectReader(self, response, connection), settings.UPLOAD_CHUNK_SIZE)
+
+    def iter_range(self, key: str, start: int, end: int) -> Iterator[bytes]:
+        response, connection = self._send("GET", key, headers={"Range": f"bytes={start}-{end}"})
+        with _ObjectReader(self, response, connection) as reader:
+            if response.status not in (200, 206):
+                raise OSError(f"Storage request GET {key} failed with {response.status}")
+            while chunk := reader.read(settings.UPLOAD_CHUNK_SIZE):
+                yield chunk
+
+    def stat(self, key: str) -> ObjectInfo:
+        headers, _ = self._call("HEAD", key)
+        modified = parsedate_to_datetime(headers["last-modified"]) if "last-modified" in headers else None
+        return ObjectInfo(int(headers["content-length"]), int(modified.timestamp() * 10**9) if modified else 0)
+
+    def delete(self, key: str) -> None:
+        try:
+            self._call("DELETE", key)
+        except FileNotFoundError:
+            pass
+
+
+_backend: Optional[StorageBackend] = None
+_backend_lock = threading.Lock()
+
+
+def get_backend() -> StorageBackend:
+    """
+    The backend chosen by STORAGE_BACKEND, created on first use
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if settings.STORAGE_BACKEND == "local":
+                _backend = LocalBackend(data_path("blobs"))
+            elif settings.STORAGE_BACKEND == "sharded":
+                _backend = ShardedBackend(
+                    settings.STORAGE_SHARD_DIRS or [data_path("blobs")],
+                    settings.STORAGE_PLACEMENT,
+                    settings.STORAGE_PINNED_FOLDERS
+                )
+            elif settings.STORAGE_BACKEND == "s3":
+                _backend = S3Backend()
+            else:
+                raise ValueError(f"Unknown storage backend {settings.STORAGE_BACKEND}; expected local, sharded or s3")
+        return _backend
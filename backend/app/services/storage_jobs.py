@@ -0,0 +1,459 @@
+import hashlib
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import func, or_, select
+from sqlalchemy.orm import Session
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from app.core.config import settings
+from app.models.blob import Blob
+from app.models.blob_chunk import BlobChunk
+from app.models.file import File
+from app.models.folder import Folder
+from app.services.archive_service import ArchiveService
+from app.services.blob_service import BlobService
+from app.services.compression_service import CompressionService, DecompressionError
+from app.services.folder_service import FolderService
+from app.services.job_service import JobContext, JobService
+from app.services.reconcile_service import ReconcileService
+from app.services.storage_backend import get_backend
+
+# Problem entries listed in a job result; the rest are only counted
+MAX_REPORTED = 100
+
+
+class StorageJobs:
+    """
+    Storage operations that can take longer than a request: each runs as a
+    background job, reports progress and can be cancelled between steps.
+    """
+
+    @staticmethod
+    def _copy(source: str, target: str, context: JobContext, done: int, total: int) -> int:
+        """
+        Copy a file through a partial file, reporting progress per chunk. Returns the new done count.
+        """
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        partial = f"{target}.part"
+        try:
+            with open(source, "rb") as src, open(partial, "wb") as dst:
+                while chunk := src.read(settings.UPLOAD_CHUNK_SIZE):
+                    dst.write(chunk)
+                    done += len(chunk)
+                    context.progress(done, total)
+            os.replace(partial, target)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        return done
+
+    @staticmethod
+    def _blob_batches(db: Session) -> Iterator[List[Blob]]:
+        """
+        All blobs with contents of their own in ID order, detached from the
+        session, a batch per transaction. Chunked blobs are left out; their
+        chunks are blobs of their own.
+        """
+        last_id = 0
+        while True:
+            blobs = (
+                db.query(Blob)
+                .filter(Blob.id > last_id, or_(Blob.encoding == None, Blob.encoding != "chunked"))
+                .order_by(Blob.id)
+                .limit(settings.JOB_BATCH_SIZE)
+                .all()
+            )
+            db.expunge_all()
+            db.commit()
+            if not blobs:
+                return
+            yield blobs
+            last_id = blobs[-1].id
+
+    @staticmethod
+    def _legacy_file_batches(db: Session) -> Iterator[List[File]]:
+        """
+        Files stored outside the blob store, a batch per transaction
+        """
+        last_id = 0
+        while True:
+            files = (
+                db.query(File)
+                .filter(File.blob_id == None, File.storage_path != None, File.id > last_id)
+                .order_by(File.id)
+                .limit(settings.JOB_BATCH_SIZE)
+                .all()
+            )
+            if not files:
+                db.commit()
+                return
+            yield files
+            db.commit()
+            last_id = files[-1].id
+
+    @staticmethod
+    def _per_disk(blobs: List[Blob], function: Callable[[Blob], Any]) -> Iterator[Tuple[Blob, Any]]:
+        """
+        Apply a function to blobs with a thread per disk holding them, one blob at a
+        time on each, so reads from several disks add up instead of taking turns.
+        Yields (blob, result) in no particular order.
+        """
+        by_key = {blob.storage_key: blob for blob in blobs}
+        groups = get_backend().spread(list(by_key))
+        if len(groups) <= 1:
+            for blob in blobs:
+                yield blob, function(blob)
+            return
+        with ThreadPoolExecutor(max_workers=len(groups), thread_name_prefix="disk") as pool:
+            futures = [
+                pool.submit(lambda keys=keys: [(by_key[key], function(by_key[key])) for key in keys])
+                for keys in groups
+            ]
+            for future in futures:
+                yield from future.result()
+
+    @staticmethod
+    def _stored_bytes(db: Session) -> int:
+        blob_bytes = db.query(func.coalesce(func.sum(func.coalesce(Blob.stored_size, Blob.size)), 0)).scalar()
+        legacy_bytes = (
+            db.query(func.coalesce(func.sum(File.size), 0))
+            .filter(File.blob_id == None, File.storage_path != None)
+            .scalar()
+        )
+        db.commit()
+        return blob_bytes + legacy_bytes
+
+    @staticmethod
+    @JobService.register("delete_folder")
+    def delete_folder(db: Session, context: JobContext, params: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Delete a folder tree a batch of files at a time. Cancelling keeps the tree
+        with the files not yet deleted.
+        """
+        folder_id = params["folder_id"]
+        if not FolderService.get_folder(db, folder_id):
+            raise ValueError("Folder not found")
+        total = FolderService.get_subtree_stats(db, folder_id)["file_count"]
+        db.commit()
+
+        done = 0
+        context.progress(done, total, "Deleting files", force=True)
+        while deleted := FolderService.delete_files_below(db, folder_id, settings.JOB_BATCH_SIZE):
+            done += deleted
+            context.progress(done, total)
+
+        context.progress(done, total, "Deleting folders", force=True)
+        FolderService.delete_folder(db, folder_id)
+        return {"folder_id": folder_id, "files_deleted": done}
+
+    @staticmethod
+    @JobService.register("move_folder")
+    def move_folder(db: Session, context: JobContext, params: Dict[str, Any]) -> Dict[str, Any]:
+        folder = FolderService.move_folder(db, params["folder_id"], params["parent_id"])
+        if not folder:
+            raise ValueError("Folder not found")
+        return {"folder_id": folder.id, "parent_id": folder.parent_id}
+
+    @staticmethod
+    @JobService.register("archive_folder")
+    def archive_folder(db: Session, context: JobContext, params: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Write a zip of a folder tree to storage, to be fetched from the job's result.
+        Progress counts archive bytes against the tree's total size.
+        """
+        folder_id = params["folder_id"]
+        folder = FolderService.get_folder(db, folder_id)
+        if not folder:
+            raise ValueError("Folder not found")
+        filename = f"{folder.name}.zip"
+        total = FolderService.get_subtree_stats(db, folder_id)["total_size"]
+        db.commit()
+
+        path = JobService.result_path(context.job_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f"{path}.part"
+        written = 0
+        context.progress(written, total, "Writing archive", force=True)
+        try:
+            with open(partial, "wb") as archive:
+                for chunk in ArchiveService.stream(ArchiveService.folder_entries(folder_id)):
+                    archive.write(chunk)
+                    written += len(chunk)
+                    context.progress(min(written, total), total)
+            os.replace(partial, path)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+
+        return {
+            "filename": filename,
+            "size": written,
+            "download_url": f"{settings.API_V1_STR}/jobs/{context.job_id}/result",
+        }
+
+    @staticmethod
+    @JobService.register("rehash")
+    def rehash(db: Session, context: JobContext, params: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Re-read every stored blob and compare it with its recorded SHA-256, and move
+        files from before the blob store into it, hashing them on the way. Blobs
+        on different disks are read at the same time.
+        """
+        total = StorageJobs._stored_bytes(db)
+        done = 0
+        checked = 0
+        corrupt: List[str] = []
+        missing: List[str] = []
+        context.progress(done, total, "Verifying blobs", force=True)
+
+        lock = threading.Lock()
+
+        def verify(blob: Blob) -> Optional[bool]:
+            """
+            Whether the blob's contents match its hash; None if they are missing.
+            Compressed blobs are decompressed, and count as read once done.
+            """
+            nonlocal done
+            digest = hashlib.sha256()
+            try:
+                with CompressionService.open(blob.storage_key, blob.encoding) as source:
+                    while chunk := source.read(settings.UPLOAD_CHUNK_SIZE):
+                        digest.update(chunk)
+                        if not blob.encoding:
+                            with lock:
+                                done += len(chunk)
+                                context.progress(done, total)
+            except FileNotFoundError:
+                return None
+            except DecompressionError:
+                return False
+            finally:
+                if blob.encoding:
+                    with lock:
+                        done += blob.stored_size
+            return digest.hexdigest() == blob.sha256
+
+        for blobs in StorageJobs._blob_batches(db):
+            for blob, intact in StorageJobs._per_disk(blobs, verify):
+                if intact is None:
+                    missing.append(blob.sha256)
+                    continue
+                checked += 1
+                if not intact:
+                    corrupt.append(blob.sha256)
+
+        adopted = 0
+        context.progress(done, total, "Moving older files into the blob store", force=True)
+        for files in StorageJobs._legacy_file_batches(db):
+            for db_file in files:
+                if not os.path.exists(db_file.storage_path):
+                    missing.append(db_file.storage_path)
+                    continue
+                BlobService.adopt(db, db_file)
+                db.commit()
+                adopted += 1
+                done += db_file.size or 0
+                context.progress(min(done, total), total)
+
+        return {
+            "blobs_checked": checked,
+            "files_adopted": adopted,
+            "corrupt_count": len(corrupt),
+            "missing_count": len(missing),
+            "corrupt": corrupt[:MAX_REPORTED],
+            "missing": missing[:MAX_REPORTED],
+        }
+
+    @staticmethod
+    @JobService.register("reconcile")
+    def reconcile(db: Session, context: JobContext, params: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Compare the storage directory with the catalog. Params: full, repair and
+        prune_missing, all off by default, so a plain run only reports.
+        """
+        return ReconcileService.reconcile(
+            db,
+            context,
+            full=bool(params.get("full", False)),
+            repair=bool(params.get("repair", False)),
+            prune_missing=bool(params.get("prune_missing", False))
+        )
+
+    @staticmethod
+    @JobService.register("rebalance")
+    def rebalance(db: Session, context: JobContext, params: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Move blobs between the disks of the sharded storage backend: blobs of
+        pinned folders onto their disks, then from disks fuller than the others,
+        by share of capacity, to the emptiest, until all are within
+        STORAGE_REBALANCE_TOLERANCE. Every disk moves one blob at a time, all disks
+        at once. Blobs stay readable throughout, and cancelling keeps what moved.
+        """
+        backend = get_backend()
+        if backend.name != "sharded":
+            raise ValueError("Rebalancing needs the sharded storage backend with several disks")
+
+        context.progress(0, None, "Locating blobs", force=True)
+        located: Dict[str, Tuple[str, int]] = {}  # Key -> (disk, size)
+        for blobs in StorageJobs._blob_batches(db):
+            for blob in blobs:
+                root = backend.locate(blob.storage_key)
+                if root is not None:
+                    located[blob.storage_key] = (root, blob.stored_bytes)
+            context.check()
+
+        pinned: Dict[str, str] = {}  # Key -> disk its folder is pinned to
+        for folder in (
+            db.query(Folder)
+            .filter(Folder.parent_id.in_(select(Folder.id).where(Folder.parent_id == None)))
+            .filter(Folder.name.in_(list(backend.pinned)))
+        ):
+            blob_ids = select(File.blob_id).where(File.folder_id.in_(FolderService.subtree_ids(folder.id)))
+            for (key,) in db.execute(
+                select(Blob.storage_key).where(or_(
+                    Blob.id.in_(blob_ids),
+                    Blob.id.in_(select(BlobChunk.chunk_id).where(BlobChunk.blob_id.in_(blob_ids))),
+                ))
+            ):
+                pinned.setdefault(key, backend.pinned[folder.name])
+        db.commit()
+
+        usage = {root: shutil.disk_usage(root) for root in backend.roots}
+        capacity = {root: usage[root].total for root in backend.roots}
+        used = {root: usage[root].used for root in backend.roots}
+        free = backend.free_space()
+        moves: Dict[str, List[Tuple[str, str, int]]] = {root: [] for root in backend.roots}  # Source -> (key, target, size)
+
+        def plan(key: str, source: str, target: str, size: int) -> None:
+            moves[source].append((key, target, size))
+            used[source] -= size
+            used[target] += size
+            free[target] -= size
+
+        for key, target in pinned.items():
+            if key in located and located[key][0] != target and free[target] >= located[key][1]:
+                plan(key, located[key][0], target, located[key][1])
+
+        goal = sum(used.values()) / sum(capacity.values())
+        movable = sorted(
+            ((size, key, root) for key, (root, size) in located.items() if key not in pinned),
+            reverse=True
+        )
+        for size, key, source in movable:
+            excess = used[source] - goal * capacity[source]
+            if excess <= settings.STORAGE_REBALANCE_TOLERANCE * capacity[source] / 2 or size > excess:
+                continue
+            target = min(backend.roots, key=lambda root: used[root] / capacity[root])
+            if target == source or free[target] < size or used[target] + size > goal * capacity[target] + excess:
+                continue
+            plan(key, source, target, size)
+
+        total = sum(size for planned in moves.values() for _, _, size in planned)
+        done = 0
+        moved = 0
+        failed: List[str] = []
+        lock = threading.Lock()
+        stop = threading.Event()
+
+        def drain(source: str) -> None:
+            nonlocal done, moved
+            for key, target, size in moves[source]:
+                if stop.is_set():
+                    return
+                try:
+                    backend.move(key, source, target)
+                except FileNotFoundError:
+                    continue  # Deleted since it was located
+                except OSError as e:
+                    with lock:
+                        failed.append(f"{key}: {str(e)}")
+                    continue
+                with lock:
+                    done += size
+                    moved += 1
+
+        context.progress(0, total, f"Moving {sum(map(len, moves.values()))} blobs", force=True)
+        with ThreadPoolExecutor(max_workers=len(backend.roots), thread_name_prefix="rebalance") as pool:
+            futures = [pool.submit(drain, source) for source in backend.roots if moves[source]]
+            try:
+                while not all(future.done() for future in futures):
+                    time.sleep(settings.JOB_PROGRESS_INTERVAL / 2)
+                    context.progress(done, total)
+            finally:
+                stop.set()
+            for future in futures:
+                future.result()
+
+        return {
+            "blobs_moved": moved,
+            "bytes_moved": done,
+            "failed_count": len(failed),
+            "failed": failed[:MAX_REPORTED],
+            "disks": [
+                {"path": root, "used_fraction": round(shutil.disk_usage(root).used / capacity[root], 4)}
+                for root in backend.roots
+            ],
+        }
+
+    @staticmethod
+    @JobService.register("migrate_storage")
+    def migrate_storage(db: Session, context: JobContext, params: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Copy all stored contents to a new storage directory, e.g. on an external
+        drive, skipping what an earlier, interrupted run already copied. Files from
+        before the blob store are switched to their copies right away; blobs follow
+        once STORAGE_DIR points at the new directory. Originals are left in place.
+        Blobs are only copied with the local storage backend, the one that keeps
+        them inside STORAGE_DIR.
+        """
+        target = os.path.abspath(params["target_dir"])
+        if not os.path.isdir(target):
+            raise ValueError(f"Target directory {target} does not exist")
+        if os.path.realpath(target) == os.path.realpath(settings.STORAGE_DIR):
+            raise ValueError("Target directory is the current storage directory")
+
+        total = StorageJobs._stored_bytes(db)
+        done = 0
+        copied = 0
+        context.progress(done, total, "Copying blobs", force=True)
+        for blobs in StorageJobs._blob_batches(db) if get_backend().name == "local" else ():
+            for blob in blobs:
+                destination = os.path.join(target, settings.DATA_DIR_NAME, "blobs", blob.storage_key)
+                if os.path.exists(destination) and os.path.getsize(destination) == blob.stored_bytes:
+                    done += blob.stored_bytes
+                    continue
+                done = StorageJobs._copy(blob.storage_path, destination, context, done, total)
+                copied += 1
+
+        moved = 0
+        context.progress(done, total, "Copying older files", force=True)
+        for files in StorageJobs._legacy_file_batches(db):
+            for db_file in files:
+                if os.path.commonpath([db_file.storage_path, target]) == target:
+                    continue  # Switched over by an earlier run
+                relative = os.path.relpath(db_file.storage_path, settings.STORAGE_DIR)
+                if relative.startswith(".."):
+                    relative = os.path.join("imported", f"{db_file.id}_{os.path.basename(db_file.storage_path)}")
+                destination = os.path.join(target, relative)
+                done = StorageJobs._copy(db_file.storage_path, destination, context, done, total)
+                db_file.storage_path = destination
+                moved += 1
+            db.commit()
+
+        root = db.query(Folder).filter(Folder.parent_id == None).order_by(Folder.id).first()
+        if root:
+            root.storage_path = target
+        db.commit()
+
+        return {
+            "target_dir": target,
+            "blobs_copied": copied,
+            "files_copied": moved,
+            "bytes": done,
+            "message": f"Set STORAGE_DIR to {target} and restart the server to serve from the new location",
+        }
@@ -0,0 +1,215 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, Iterable, Optional
+
+from app.core.config import settings, data_path
+from app.models.file import File
+from app.services.cache_service import CacheService
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; thumbnails are disabled without it
+    Image = None
+
+# Longest edge in pixels for each thumbnail size
+SIZES = {"small": 128, "medium": 256, "large": 512}
+
+THUMBNAIL_MIME_TYPES = {
+    "image/jpeg", "image/png", "image/gif", "image/webp", "image/bmp", "image/tiff",
+}
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+_cache_bytes: Optional[int] = None
+_cache_lock = threading.Lock()
+
+
+def render_thumbnails(source_path: str, targets: Dict[int, str]) -> int:
+    """
+    Decode an image once and write a WebP thumbnail for each requested edge length.
+    Runs in a worker process. Returns the number of bytes written.
+    """
+    written = 0
+    with Image.open(source_path) as image:
+        # Let JPEG decoding downscale on the fly instead of decoding full resolution
+        image.draft("RGB", (max(targets), max(targets)))
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+
+        for edge in sorted(targets, reverse=True):
+            image.thumbnail((edge, edge))
+            target = targets[edge]
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            partial = f"{target}.{os.getpid()}.tmp"
+            image.save(partial, "WEBP", quality=80, method=4)
+            os.replace(partial, target)
+            written += os.path.getsize(target)
+    return written
+
+
+class ThumbnailService:
+    @staticmethod
+    def available() -> bool:
+        return Image is not None
+
+    @staticmethod
+    def supports(file: File) -> bool:
+        return Image is not None and (file.mime_type or "").lower() in THUMBNAIL_MIME_TYPES
+
+    @staticmethod
+    def cache_key(file: File) -> str:
+        """
+        Thumbnails are keyed by content hash, so copies and re-uploads share them.
+        Files from before hashes were recorded fall back to their id and mtime.
+        """
+        if file.content_hash:
+            return file.content_hash
+        return f"file{file.id}-{os.stat(file.content_path).st_mtime_ns:x}"
+
+    @staticmethod
+    def root() -> str:
+        """
+        Thumbnails live on the local cache disk when there is one, as they are read far more than written
+        """
+        if settings.CACHE_DIR:
+            return os.path.join(settings.CACHE_DIR, "thumbnails")
+        return data_path("thumbnails")
+
+    @staticmethod
+    def cache_path(file: File, size: str) -> str:
+        key = ThumbnailService.cache_key(file)
+        return os.path.join(ThumbnailService.root(), key[:2], f"{key}_{size}.webp")
+
+    @staticmethod
+    def _get_pool() -> ProcessPoolExecutor:
+        global _pool
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=settings.THUMBNAIL_WORKERS)
+            return _pool
+
+    @staticmethod
+    def shutdown() -> None:
+        global _pool
+        with _pool_lock:
+            if _pool is not None:
+                _pool.shutdown(wait=False, cancel_futures=True)
+                _pool = None
+
+    @staticmethod
+    def schedule(file: File) -> Optional[Future]:
+        """
+        Queue every thumbnail size for a newly stored file on the worker pool
+        """
+        if not ThumbnailService.supports(file):
+            return None
+        targets = {
+            SIZES[size]: ThumbnailService.cache_path(file, size)
+            for size in SIZES
+            if not os.path.exists(ThumbnailService.cache_path(file, size))
+        }
+        if not targets:
+            return None
+        source = CacheService.local_path(file)
+        if source is None:
+            return None  # In remote storage, and no local cache to fetch it into
+
+        future = ThumbnailService._get_pool().submit(render_thumbnails, source, targets)
+        future.add_done_callback(ThumbnailService._account)
+        return future
+
+    @staticmethod
+    def schedule_all(files: Iterable[File]) -> None:
+        """
+        Queue thumbnails for several new files. Checking the cache and fetching
+        remote contents block, so batches call this once from the threadpool.
+        """
+        for file in files:
+            ThumbnailService.schedule(file)
+
+    @staticmethod
+    def _account(future: Future) -> None:
+        if future.cancelled() or future.exception() is not None:
+            return
+        ThumbnailService._add_to_cache(future.result())
+
+    @staticmethod
+    async def get(file: File, size: str) -> Optional[str]:
+        """
+        Path of a cached thumbnail, rendering it on the worker pool if needed.
+        Returns None when the file cannot be thumbnailed.
+        """
+        if size not in SIZES or not ThumbnailService.supports(file):
+            return None
+
+        # Checking the cache touches the disk, so it runs off the event loop
+        path = await asyncio.to_thread(ThumbnailService._cached, file, size)
+        if path is None:
+            # Scheduling may fetch the image from remote storage first
+            future = await asyncio.to_thread(ThumbnailService.schedule, file)
+            if future is not None:
+                try:
+                    await asyncio.wrap_future(future)
+                except Exception:
+                    return None
+            path = await asyncio.to_thread(ThumbnailService._cached, file, size)
+        return path
+
+    @staticmethod
+    def _cached(file: File, size: str) -> Optional[str]:
+        """
+        Path of a thumbnail if it is cached, touching it to mark it recently used
+        for LRU eviction
+        """
+        path = ThumbnailService.cache_path(file, size)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    @staticmethod
+    def _add_to_cache(written: int) -> None:
+        global _cache_bytes
+        with _cache_lock:
+            if _cache_bytes is None:
+                _cache_bytes = ThumbnailService._scan()[0]
+            else:
+                _cache_bytes += written
+            if _cache_bytes > settings.THUMBNAIL_CACHE_MAX_BYTES:
+                _cache_bytes = ThumbnailService._evict()
+
+    @staticmethod
+    def _scan():
+        entries = []
+        total = 0
+        root = ThumbnailService.root()
+        if os.path.isdir(root):
+            for shard in os.scandir(root):
+                if not shard.is_dir():
+                    continue
+                for entry in os.scandir(shard.path):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+        return total, entries
+
+    @staticmethod
+    def _evict() -> int:
+        """
+        Delete least recently used thumbnails until the cache is back under 90% of its budget
+        """
+        total, entries = ThumbnailService._scan()
+        target = settings.THUMBNAIL_CACHE_MAX_BYTES * 0.9
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        return total
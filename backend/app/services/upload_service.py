@@ -0,0 +1,352 @@
+import asyncio
+import hashlib
+import io
+import os
+import shutil
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import AsyncIterator, BinaryIO, Dict, Optional, Tuple
+
+import aiofiles
+from anyio import from_thread
+from fastapi import HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+
+from app.core.config import settings, data_path
+from app.models.file import File
+from app.models.folder import Folder
+from app.models.upload_session import UploadSession
+
+# Serialises concurrent PUTs against the same upload session
+_session_locks: Dict[str, asyncio.Lock] = {}
+
+
+class BlockingStreamReader(io.RawIOBase):
+    """
+    Blocking file-like view of an async byte stream, such as a request body, for
+    synchronous parsers running in the threadpool. Each read waits on the event
+    loop for the next chunk, so nothing is buffered beyond the chunk in hand.
+    Must only be read from a worker thread started by run_in_threadpool.
+    """
+
+    def __init__(self, chunks: AsyncIterator[bytes]):
+        self._chunks = chunks.__aiter__()
+        self._buffer = memoryview(b"")
+        self._finished = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._buffer and not self._finished:
+            try:
+                self._buffer = memoryview(from_thread.run(self._chunks.__anext__))
+            except StopAsyncIteration:
+                self._finished = True
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+class UploadService:
+    @staticmethod
+    async def iter_upload_file(file: UploadFile) -> AsyncIterator[bytes]:
+        """
+        Yield the contents of an UploadFile in UPLOAD_CHUNK_SIZE pieces
+        """
+        while True:
+            chunk = await file.read(settings.UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    @staticmethod
+    async def stream_to_disk(
+        chunks: AsyncIterator[bytes],
+        storage_path: str,
+        max_size: Optional[int] = None
+    ) -> Tuple[int, str]:
+        """
+        Write an async stream of chunks to storage_path without blocking the event loop.
+        Returns the number of bytes written and their SHA-256 hex digest. The partial
+        file is removed if the stream fails or grows past max_size.
+        """
+        if max_size is None:
+            max_size = settings.MAX_UPLOAD_SIZE
+
+        os.makedirs(os.path.dirname(storage_path), exist_ok=True)
+
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            async with aiofiles.open(storage_path, "wb") as buffer:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if size > max_size:
+                        raise HTTPException(
+                            status_code=413,
+                            detail=f"File exceeds maximum upload size of {max_size} bytes"
+                        )
+                    digest.update(chunk)
+                    await buffer.write(chunk)
+        except BaseException:
+            if os.path.exists(storage_path):
+                os.remove(storage_path)
+            raise
+
+        return size, digest.hexdigest()
+
+    @staticmethod
+    def copy_to_disk(
+        source: BinaryIO,
+        storage_path: str,
+        max_size: Optional[int] = None
+    ) -> Tuple[int, str]:
+        """
+        Blocking counterpart of stream_to_disk for callers already off the event loop
+        """
+        if max_size is None:
+            max_size = settings.MAX_UPLOAD_SIZE
+
+        os.makedirs(os.path.dirname(storage_path), exist_ok=True)
+
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(storage_path, "wb") as buffer:
+                while True:
+                    chunk = source.read(settings.UPLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > max_size:
+                        raise HTTPException(
+                            status_code=413,
+                            detail=f"File exceeds maximum upload size of {max_size} bytes"
+                        )
+                    digest.update(chunk)
+                    buffer.write(chunk)
+        except BaseException:
+            if os.path.exists(storage_path):
+                os.remove(storage_path)
+            raise
+
+        return size, digest.hexdigest()
+
+    @staticmethod
+    def hash_file(path: str) -> Tuple[int, str]:
+        """
+        Size and SHA-256 hex digest of a file on disk
+        """
+        digest = hashlib.sha256()
+        size = 0
+        with open(path, "rb") as source:
+            while True:
+                chunk = source.read(settings.UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                digest.update(chunk)
+        return size, digest.hexdigest()
+
+    # Resumable upload sessions
+
+    @staticmethod
+    def create_session(
+        db: Session,
+        folder_id: int,
+        filename: str,
+        mime_type: Optional[str] = None,
+        total_size: Optional[int] = None
+    ) -> UploadSession:
+        """
+        Start a resumable upload into a folder
+        """
+        if total_size is not None and total_size > settings.MAX_UPLOAD_SIZE:
+            raise HTTPException(
+                status_code=413,
+                detail=f"File exceeds maximum upload size of {settings.MAX_UPLOAD_SIZE} bytes"
+            )
+
+        folder = db.query(Folder).filter(Folder.id == folder_id).first()
+        if not folder:
+            raise ValueError("Folder not found")
+
+        # Opportunistically drop abandoned sessions whenever a new one starts
+        UploadService.cleanup_stale_sessions(db)
+
+        session_id = str(uuid.uuid4())
+        staging_path = data_path("uploads", f"{session_id}.part")
+        os.makedirs(os.path.dirname(staging_path), exist_ok=True)
+        open(staging_path, "wb").close()
+
+        upload = UploadSession(
+            id=session_id,
+            folder_id=folder_id,
+            filename=filename,
+            mime_type=mime_type,
+            total_size=total_size,
+            offset=0,
+            staging_path=staging_path
+        )
+        db.add(upload)
+        db.commit()
+        db.refresh(upload)
+
+        return upload
+
+    @staticmethod
+    def get_session(db: Session, session_id: str) -> Optional[UploadSession]:
+        """
+        Get an upload session by ID
+        """
+        return db.query(UploadSession).filter(UploadSession.id == session_id).first()
+
+    @staticmethod
+    async def write_chunk(
+        db: Session,
+        session_id: str,
+        offset: int,
+        chunks: AsyncIterator[bytes]
+    ) -> UploadSession:
+        """
+        Append a byte range to an upload session. The range must start at the committed
+        offset; whatever part of it reaches disk before a disconnect stays committed so
+        the client can resume from there.
+        """
+        lock = _session_locks.setdefault(session_id, asyncio.Lock())
+        async with lock:
+            upload = await run_in_threadpool(UploadService.get_session, db, session_id)
+            if not upload:
+                raise ValueError("Upload session not found")
+            if offset != upload.offset:
+                raise HTTPException(
+                    status_code=409,
+                    detail=f"Offset mismatch: upload session is at byte {upload.offset}",
+                    headers={"Upload-Offset": str(upload.offset)}
+                )
+
+            limit = upload.total_size if upload.total_size is not None else settings.MAX_UPLOAD_SIZE
+            written = 0
+            try:
+                async with aiofiles.open(upload.staging_path, "r+b") as buffer:
+                    await buffer.seek(offset)
+                    await buffer.truncate()
+                    async for chunk in chunks:
+                        if offset + written + len(chunk) > limit:
+                            raise HTTPException(
+                                status_code=413,
+                                detail=f"Upload exceeds its size limit of {limit} bytes"
+                            )
+                        await buffer.write(chunk)
+                        written += len(chunk)
+            finally:
+                upload.offset = offset + written
+                await run_in_threadpool(db.commit)
+
+            await run_in_threadpool(db.refresh, upload)
+            return upload
+
+    @staticmethod
+    async def complete_session(db: Session, session_id: str) -> File:
+        """
+        Finalize an upload session under its lock, so a PUT still streaming into the
+        session cannot race the hashing and hand-off of its staged bytes
+        """
+        lock = _session_locks.setdefault(session_id, asyncio.Lock())
+        async with lock:
+            return await run_in_threadpool(UploadService.finalize_session, db, session_id)
+
+    @staticmethod
+    def finalize_session(db: Session, session_id: str) -> File:
+        """
+        Turn a fully uploaded session into a file in its target folder. Raises
+        LookupError for an unknown session or folder and NameTaken when the folder
+        already holds a file of that name. A session that fails to finalize keeps
+        its staged bytes and can be completed again, e.g. after a rename.
+        """
+        # Imported here to avoid circular imports with FileService and BlobService
+        from app.services.blob_service import BlobService
+        from app.services.file_service import FileService
+
+        upload = UploadService.get_session(db, session_id)
+        if not upload:
+            raise LookupError("Upload session not found")
+        if upload.total_size is not None and upload.offset != upload.total_size:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Upload incomplete: {upload.offset} of {upload.total_size} bytes received",
+                headers={"Upload-Offset": str(upload.offset)}
+            )
+
+        folder = db.query(Folder).filter(Folder.id == upload.folder_id).first()
+        if not folder:
+            raise LookupError("Folder not found")
+        # Checked before hashing, which reads the whole file
+        FileService._check_name_free(db, folder.id, upload.filename)
+
+        staging_path = upload.staging_path
+        size, content_hash = UploadService.hash_file(staging_path)
+        # add_file takes over the path it is given and discards it on failure, so it
+        # gets a second link to the staged bytes rather than the session's own
+        linked_path = BlobService.temp_path()
+        try:
+            os.link(staging_path, linked_path)
+        except OSError:
+            # Volumes without hard links, such as FAT and exFAT, get a copy instead
+            shutil.copyfile(staging_path, linked_path)
+        db.delete(upload)
+        db_file = FileService.add_file(
+            db, folder, upload.filename, upload.mime_type, linked_path, size, content_hash
+        )
+        os.remove(staging_path)
+
+        _session_locks.pop(session_id, None)
+        return db_file
+
+    @staticmethod
+    def abort_session(db: Session, session_id: str) -> bool:
+        """
+        Cancel an upload session and discard its staged bytes
+        """
+        upload = UploadService.get_session(db, session_id)
+        if not upload:
+            return False
+
+        if os.path.exists(upload.staging_path):
+            os.remove(upload.staging_path)
+        db.delete(upload)
+        db.commit()
+
+        _session_locks.pop(session_id, None)
+        return True
+
+    @staticmethod
+    def cleanup_stale_sessions(db: Session) -> int:
+        """
+        Garbage-collect upload sessions idle for longer than UPLOAD_SESSION_TTL, along
+        with staging files no session refers to. Returns the number of sessions removed.
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=settings.UPLOAD_SESSION_TTL)
+        stale = db.query(UploadSession).filter(UploadSession.updated_at < cutoff).all()
+        for upload in stale:
+            if os.path.exists(upload.staging_path):
+                os.remove(upload.staging_path)
+            db.delete(upload)
+            _session_locks.pop(upload.id, None)
+        if stale:
+            db.commit()
+
+        staging_dir = data_path("uploads")
+        if os.path.isdir(staging_dir):
+            # File times are epoch seconds; the naive UTC cutoff above would read as local time
+            mtime_cutoff = time.time() - settings.UPLOAD_SESSION_TTL
+            live = {path for (path,) in db.query(UploadSession.staging_path).all()}
+            for entry in os.scandir(staging_dir):
+                if entry.is_file() and entry.path not in live and entry.stat().st_mtime < mtime_cutoff:
+                    os.remove(entry.path)
+
+        return len(stale)
@@ -0,0 +1,278 @@
+import hashlib
+import os
+import tempfile
+from datetime import datetime
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.orm import Session
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+from app.models.blob import Blob
+from app.models.file import File
+from app.models.file_version import FileVersion
+from app.models.folder import Folder
+from app.services.blob_service import BlobService
+from app.services.change_service import ChangeService
+from app.services.chunk_service import ChunkPart, ChunkService
+from app.services.compression_service import CompressionService
+from app.services.search_service import SearchService
+
+
+class VersionService:
+    """
+    File history. Uploading new contents for a file keeps what it held before
+    as a numbered version, which can be listed, read and restored. Versions
+    hold blob references like files do; large files are stored as chunks, so
+    versions share what did not change.
+    """
+
+    @staticmethod
+    def list_versions(db: Session, file: File) -> List[Dict[str, Any]]:
+        """
+        All versions of a file, newest (the current contents) first
+        """
+        versions = [{
+            "number": file.version,
+            "size": file.size or 0,
+            "content_hash": file.content_hash,
+            "created_at": file.updated_at,
+            "current": True,
+        }]
+        for version in (
+            db.query(FileVersion).filter(FileVersion.file_id == file.id).order_by(FileVersion.number.desc())
+        ):
+            versions.append({
+                "number": version.number,
+                "size": version.size,
+                "content_hash": version.content_hash,
+                "created_at": version.created_at,
+                "current": False,
+            })
+        return versions
+
+    @staticmethod
+    def get_blob(db: Session, file: File, number: int) -> Optional[Blob]:
+        """
+        The blob holding a version of a file, the current one included
+        """
+        if number == file.version:
+            return BlobService.adopt(db, file)
+        return (
+            db.query(Blob)
+            .join(FileVersion, FileVersion.blob_id == Blob.id)
+            .filter(FileVersion.file_id == file.id, FileVersion.number == number)
+            .first()
+        )
+
+    @staticmethod
+    def _keep_current(db: Session, file: File) -> None:
+        """
+        Record the current contents as a version before they are replaced. The
+        file's blob reference passes to the version. The caller commits.
+        """
+        db.add(FileVersion(
+            file_id=file.id,
+            number=file.version,
+            blob_id=file.blob_id,
+            size=file.size or 0,
+            content_hash=file.content_hash,
+            created_at=file.updated_at or file.created_at,
+        ))
+
+    @staticmethod
+    def _replace(db: Session, file: File, blob: Blob, content: Optional[str]) -> List[str]:
+        """
+        Point a file at new contents as its next version, dropping versions past
+        VERSION_MAX_KEPT. Returns the storage keys to remove after the caller commits.
+        """
+        Folder.adjust_totals(db, file.folder_id, size=blob.size - (file.size or 0))
+        file.blob_id = blob.id
+        file.size = blob.size
+        file.content_hash = blob.sha256
+        file.version += 1
+        file.updated_at = datetime.utcnow()
+        db.flush()
+
+        SearchService.remove_file(db, file.id)
+        SearchService.index_file(db, file, content)
+        ChangeService.record(db, "file", [file.id])
+
+        expired = (
+            select(FileVersion.id)
+            .where(FileVersion.file_id == file.id)
+            .order_by(FileVersion.number.desc())
+            .offset(settings.VERSION_MAX_KEPT)
+        )
+        return VersionService.remove_versions(db, select(expired.subquery().c.id))
+
+    @staticmethod
+    def add_version(db: Session, file: File, staged_path: str, size: int, sha256: str) -> File:
+        """
+        Make staged contents the current version of a file, keeping the previous
+        ones. Large contents are stored as chunks, the previous version too, so
+        the new one only adds the chunks that changed. Uploading the current
+        contents again changes nothing.
+        """
+        released = []
+        try:
+            if sha256 == file.content_hash:
+                os.remove(staged_path)
+                return file
+
+            content = SearchService.extract_text(staged_path, file.mime_type)
+            previous = BlobService.adopt(db, file)
+            VersionService._keep_current(db, file)
+            if ChunkService.chunkable(size):
+                # Chunk the previous version first, so the new one can share its chunks
+                released += ChunkService.convert(db, previous, file.folder_id, file.mime_type)
+                blob = ChunkService.store(db, staged_path, size, sha256, file.folder_id, file.mime_type)
+            else:
+                blob = BlobService.store(db, staged_path, size, sha256, file.folder_id, file.mime_type)
+            released += VersionService._replace(db, file, blob, content)
+            db.commit()
+        except Exception:
+            db.rollback()
+            if os.path.exists(staged_path):
+                os.remove(staged_path)
+            raise
+
+        BlobService.remove_files(released)
+        db.refresh(file)
+        return file
+
+    @staticmethod
+    def restore(db: Session, file: File, number: int) -> Optional[File]:
+        """
+        Make an earlier version the current one again, as a new version, so the
+        history is kept. Returns None if the file has no such version.
+        """
+        version = (
+            db.query(FileVersion).filter(FileVersion.file_id == file.id, FileVersion.number == number).first()
+        )
+        if version is None:
+            return None
+        if version.content_hash == file.content_hash:
+            return file
+
+        blob = db.query(Blob).filter(Blob.id == version.blob_id).first()
+        content = VersionService._extract_text(blob, file.mime_type)
+        try:
+            BlobService.adopt(db, file)
+            VersionService._keep_current(db, file)
+            BlobService.acquire(db, blob.id)
+            released = VersionService._replace(db, file, blob, content)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+        BlobService.remove_files(released)
+        db.refresh(file)
+        return file
+
+    @staticmethod
+    def _extract_text(blob: Blob, mime_type: Optional[str]) -> Optional[str]:
+        """
+        Searchable text of stored contents, copied out to a staging path for types that have any
+        """
+        if not SearchService.has_text(mime_type):
+            return None
+        staged_path = BlobService.temp_path()
+        try:
+            with CompressionService.open(blob.storage_key, blob.encoding) as source, open(staged_path, "wb") as target:
+                while chunk := source.read(settings.UPLOAD_CHUNK_SIZE):
+                    target.write(chunk)
+            return SearchService.extract_text(staged_path, mime_type)
+        finally:
+            if os.path.exists(staged_path):
+                os.remove(staged_path)
+
+    @staticmethod
+    def stage_delta(
+        db: Session,
+        file: File,
+        base: int,
+        chunks: List[Tuple[str, int]],
+        data: BinaryIO,
+        staged_path: str
+    ) -> Tuple[int, str]:
+        """
+        Assemble new contents at a staging path from (SHA-256, size) chunks in
+        order: chunks of the base version are copied from storage, the others are
+        read from the data stream in turn. Returns the size and SHA-256 of the
+        result. Raises LookupError for an unknown base version and ValueError for
+        data that does not match the chunk list.
+        """
+        blob = VersionService.get_blob(db, file, base)
+        if blob is None:
+            raise LookupError(f"File {file.id} has no version {base}")
+        # Reused chunks are read from the base by offset. A compressed base can only
+        # be read from its start, so it is decompressed to scratch once, while being
+        # cut, rather than again for every chunk; the chunks of a chunked base are
+        # read from their own blobs, looked up once.
+        base_copy: Optional[BinaryIO] = None
+        parts: Dict[int, ChunkPart] = {}
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            if blob.encoding and blob.encoding != "chunked":
+                base_copy = tempfile.TemporaryFile(dir=os.path.dirname(staged_path))
+                with CompressionService.open(blob.storage_key, blob.encoding) as source:
+                    known = {chunk["sha256"]: chunk for chunk in ChunkService.cut(source, base_copy)}
+            else:
+                known = {chunk["sha256"]: chunk for chunk in ChunkService.manifest(db, blob)}
+            db.commit()
+            if blob.encoding == "chunked":
+                parts = {part.offset: part for part in ChunkService.parts(blob.storage_key)}
+
+            with open(staged_path, "wb") as target:
+                for sha256, length in chunks:
+                    if sha256 in known and known[sha256]["size"] == length:
+                        start = known[sha256]["offset"]
+                        if base_copy is not None:
+                            base_copy.seek(start)
+                            pieces = [base_copy.read(length)]
+                        elif start in parts:
+                            part = parts[start]
+                            pieces = CompressionService.iter_range(part.storage_key, part.encoding, 0, length - 1)
+                        else:
+                            pieces = CompressionService.iter_range(blob.storage_key, blob.encoding, start, start + length - 1)
+                    else:
+                        piece = data.read(length)
+                        if len(piece) != length or hashlib.sha256(piece).hexdigest() != sha256:
+                            raise ValueError(f"Data for chunk {sha256} is missing or does not match its hash")
+                        pieces = [piece]
+                    for piece in pieces:
+                        digest.update(piece)
+                        target.write(piece)
+                        size += len(piece)
+                    if size > settings.MAX_UPLOAD_SIZE:
+                        raise ValueError(f"File exceeds maximum upload size of {settings.MAX_UPLOAD_SIZE} bytes")
+                if data.read(1):
+                    raise ValueError("More data sent than the chunk list uses")
+        except BaseException:
+            if os.path.exists(staged_path):
+                os.remove(staged_path)
+            raise
+        finally:
+            if base_copy is not None:
+                base_copy.close()
+        return size, digest.hexdigest()
+
+    @staticmethod
+    def remove_versions(db: Session, version_ids) -> List[str]:
+        """
+        Delete the versions whose IDs the given subquery selects, dropping their
+        blob references. Returns the storage keys to remove after the caller commits.
+        """
+        db.execute(
+            update(Blob)
+            .where(Blob.id.in_(select(FileVersion.blob_id).where(FileVersion.id.in_(version_ids))))
+            .values(ref_count=Blob.ref_count - (
+                select(func.count(FileVersion.id))
+                .where(FileVersion.blob_id == Blob.id, FileVersion.id.in_(version_ids))
+                .scalar_subquery()
+            ))
+        )
+        db.execute(delete(FileVersion).where(FileVersion.id.in_(version_ids)))
+        return BlobService.forget_unreferenced(db)
@@ -0,0 +1,509 @@
+import mimetypes
+import os
+import threading
+import time
+import traceback
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import insert, literal, select, update, func
+from sqlalchemy.orm import Session
+from typing import Dict, List, Optional, Tuple
+
+from app.core.config import settings, data_path
+from app.db.base import SessionLocal, engine
+from app.models.file import File
+from app.models.folder import Folder
+from app.models.scan_checkpoint import ScanCheckpoint
+from app.services.change_service import ChangeService
+from app.services.file_service import FileService
+from app.services.folder_service import FolderService
+from app.services.reconcile_service import DiskEntry, ReconcileService, Tracked, list_files, map_batched
+from app.services.search_service import SearchService
+from app.services.thumbnail_service import ThumbnailService
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # watchdog is optional; without it STORAGE_DIR is polled
+    FileSystemEventHandler = object
+    Observer = None
+
+# Names of files still being written by browsers and copy tools, renamed when done
+PARTIAL_SUFFIXES = (".part", ".partial", ".crdownload", ".download", ".tmp")
+
+# Seconds between checks for changes that are ready to apply
+TICK = 0.5
+
+
+class _Changes:
+    """
+    Directories touched by events, and moves seen, collected until events stop
+    for WATCH_DEBOUNCE seconds or have kept coming for WATCH_MAX_DELAY
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._directories: Dict[str, bool] = {}  # Path -> whether its whole subtree needs a look
+        self._moves: List[Tuple[str, str, bool]] = []  # (source, destination, is_directory)
+        self._first = 0.0
+        self._last = 0.0
+
+    def _touch(self) -> None:
+        now = time.monotonic()
+        if not self._first:
+            self._first = now
+        self._last = now
+
+    def mark(self, directory: str, subtree: bool = False) -> None:
+        with self._lock:
+            self._directories[directory] = self._directories.get(directory, False) or subtree
+            self._touch()
+
+    def move(self, source: str, destination: str, is_directory: bool) -> None:
+        with self._lock:
+            self._moves.append((source, destination, is_directory))
+            self._touch()
+
+    def take(self) -> Optional[Tuple[Dict[str, bool], List[Tuple[str, str, bool]]]]:
+        with self._lock:
+            if not self._directories and not self._moves:
+                return None
+            now = time.monotonic()
+            if now - self._last < settings.WATCH_DEBOUNCE and now - self._first < settings.WATCH_MAX_DELAY:
+                return None
+            taken = (self._directories, self._moves)
+            self._directories, self._moves = {}, []
+            self._first = self._last = 0.0
+            return taken
+
+
+_changes = _Changes()
+_seen: Dict[str, int] = {}  # Directory -> mtime_ns at the last poll
+_stopping = threading.Event()
+_thread: Optional[threading.Thread] = None
+_observer = None
+
+
+def _ignored_name(name: str) -> bool:
+    return name.startswith(".") or name.endswith(PARTIAL_SUFFIXES)
+
+
+def _watched(path: str) -> bool:
+    """
+    Whether a path is one the catalog mirrors: inside STORAGE_DIR, outside the
+    app's own data and database files, and not hidden
+    """
+    root = settings.STORAGE_DIR
+    if path == root:
+        return True
+    if os.path.commonpath([path, root]) != root or os.path.commonpath([path, data_path()]) == data_path():
+        return False
+    if engine.url.database and path.startswith(os.path.abspath(engine.url.database)):
+        return False  # The database and its -wal and -shm files, if kept on the drive
+    return not any(_ignored_name(part) for part in os.path.relpath(path, root).split(os.sep))
+
+
+class _EventHandler(FileSystemEventHandler):
+    """
+    Turns watchdog events into directories to look at and moves to follow
+    """
+
+    def on_any_event(self, event) -> None:
+        if event.event_type in ("opened", "closed_no_write"):
+            return
+        source = os.fsdecode(event.src_path)
+
+        if event.event_type == "moved":
+            destination = os.fsdecode(event.dest_path)
+            if _watched(source) and _watched(destination):
+                _changes.move(source, destination, event.is_directory)
+            elif _watched(source):
+                _changes.mark(source if event.is_directory else os.path.dirname(source))
+            elif _watched(destination):
+                _changes.mark(destination if event.is_directory else os.path.dirname(destination), event.is_directory)
+            return
+
+        if not _watched(source):
+            return
+        if not event.is_directory:
+            _changes.mark(os.path.dirname(source))
+        elif event.event_type == "created":
+            # Files copied in with the directory may predate its watch
+            _changes.mark(source, subtree=True)
+        elif event.event_type == "deleted":
+            _changes.mark(source)
+
+
+class WatchService:
+    """
+    Keeps the catalog in step with files copied onto the drive directly. Files
+    that appear under STORAGE_DIR are added in place, like files from before the
+    blob store, to a folder mirroring their directory; changes to their size,
+    moves and deletions are followed. Events come from watchdog (inotify on
+    Linux, FSEvents on macOS) when it is installed, and from polling directory
+    mtimes otherwise. They are debounced and applied in batches, a transaction
+    per WATCH_BATCH_SIZE changes. Files the app itself stores in the blob store
+    are never touched.
+    """
+
+    @staticmethod
+    def start() -> None:
+        global _thread, _observer
+        if _thread is not None:
+            return
+        _stopping.clear()
+        if Observer is not None:
+            try:
+                _observer = Observer()
+                _observer.schedule(_EventHandler(), settings.STORAGE_DIR, recursive=True)
+                _observer.start()
+            except OSError as e:  # e.g. out of inotify watches on a large drive
+                print(f"Cannot watch {settings.STORAGE_DIR} for events, polling instead: {str(e)}")
+                _observer = None
+        _thread = threading.Thread(target=WatchService._run, name="watcher", daemon=True)
+        _thread.start()
+
+    @staticmethod
+    def shutdown() -> None:
+        global _thread, _observer
+        _stopping.set()
+        if _observer is not None:
+            _observer.stop()
+            _observer.join()
+            _observer = None
+        if _thread is not None:
+            _thread.join()
+            _thread = None
+
+    @staticmethod
+    def _run() -> None:
+        db = SessionLocal()
+        try:
+            # Directories unchanged since a scan found them consistent need no catch-up
+            _seen.clear()
+            _seen.update(
+                (path, mtime_ns)
+                for path, mtime_ns in db.execute(select(ScanCheckpoint.path, ScanCheckpoint.mtime_ns))
+                if _watched(path)
+            )
+            db.commit()
+
+            polled_at = None
+            while not _stopping.wait(TICK):
+                # Catch up once on what changed while the server was down, then poll only without events
+                if polled_at is None or (
+                    _observer is None and time.monotonic() - polled_at >= settings.WATCH_POLL_INTERVAL
+                ):
+                    WatchService.poll()
+                    polled_at = time.monotonic()
+
+                taken = _changes.take()
+                if taken:
+                    try:
+                        summary = WatchService.apply(db, *taken)
+                        if summary:
+                            print(f"Applied changes on the drive: {dict(summary)}")
+                    except Exception as e:
+                        db.rollback()
+                        print(f"Failed to apply changes on the drive: {str(e)}")
+                        print(traceback.format_exc())
+        finally:
+            db.close()
+
+    @staticmethod
+    def poll() -> None:
+        """
+        Mark the directories whose mtime changed since the last poll, or that
+        appeared or disappeared. Adding, removing or renaming a file changes its
+        directory's mtime; a file rewritten in place is only noticed by events.
+        """
+        with ThreadPoolExecutor(max_workers=settings.RECONCILE_WORKERS, thread_name_prefix="watcher") as pool:
+            current = ReconcileService.walk(pool, settings.STORAGE_DIR, exclude=data_path())
+        for directory, mtime_ns in current.items():
+            if _seen.get(directory) != mtime_ns and _watched(directory):
+                _changes.mark(directory)
+        for directory in _seen.keys() - current.keys():
+            _changes.mark(directory)
+        _seen.clear()
+        _seen.update(current)
+
+    @staticmethod
+    def _folder_for(db: Session, directory: str, folders: Dict[str, int]) -> int:
+        """
+        ID of the folder mirroring a directory, creating it and its parents as
+        needed. Folders remember their directory, so renaming one in the app keeps
+        the link.
+        """
+        if directory in folders:
+            return folders[directory]
+        if directory == settings.STORAGE_DIR:
+            folder = db.query(Folder).filter(Folder.parent_id == None).order_by(Folder.id).first()
+        else:
+            folder = db.query(Folder).filter(Folder.storage_path == directory).first()
+            if folder is None:
+                parent_id = WatchService._folder_for(db, os.path.dirname(directory), folders)
+                name = os.path.basename(directory)
+                folder = db.query(Folder).filter(Folder.parent_id == parent_id, Folder.name == name).first()
+                if folder is None:
+                    folder = FolderService.create_folder(db, name, parent_id)
+                if folder.storage_path is None:
+                    folder.storage_path = directory
+                    db.commit()
+        folders[directory] = folder.id
+        return folder.id
+
+    @staticmethod
+    def _free_name(db: Session, folder_id: int, name: str, taken: Optional[set] = None) -> str:
+        """
+        The name, or "name (2)", "name (3)"... if the folder already holds a file
+        called that, e.g. one uploaded through the app
+        """
+        stem, extension = os.path.splitext(name)
+        candidate, number = name, 1
+        while (taken is not None and candidate in taken) or db.query(File.id).filter(
+            File.folder_id == folder_id, File.name == candidate
+        ).first():
+            number += 1
+            candidate = f"{stem} ({number}){extension}"
+        return candidate
+
+    @staticmethod
+    def _move_file(db: Session, file_id: int, source: str, destination: str, folders: Dict[str, int]) -> None:
+        """
+        Point a file at its new location. Files that mirror the drive follow it
+        into the folder and name it now has; older files stored under generated
+        names keep their place in the catalog.
+        """
+        db_file = db.query(File).filter(File.id == file_id).first()
+        db_file.storage_path = destination
+        if db_file.name == os.path.basename(source):
+            folder_id = WatchService._folder_for(db, os.path.dirname(destination), folders)
+            name = os.path.basename(destination)
+            if folder_id != db_file.folder_id or name != db_file.name:
+                name = WatchService._free_name(db, folder_id, name)
+                ChangeService.record(db, "file", [db_file.id])
+            if folder_id != db_file.folder_id:
+                Folder.adjust_totals(db, db_file.folder_id, size=-(db_file.size or 0), files=-1)
+                Folder.adjust_totals(db, folder_id, size=db_file.size or 0, files=1)
+                db_file.folder_id = folder_id
+            if name != db_file.name:
+                db_file.name = name
+                SearchService.rename_file(db, db_file.id, name)
+
+    @staticmethod
+    def _move_directory(db: Session, source: str, destination: str, folders: Dict[str, int]) -> None:
+        """
+        Follow a directory moved or renamed on the drive: paths below it are
+        rewritten in two statements, and its folder is moved and renamed to match
+        """
+        below = (source + os.sep, source + chr(ord(os.sep) + 1))
+        new_path = lambda column: literal(destination).op("||")(func.substr(column, len(source) + 1))
+        db.execute(
+            update(File)
+            .where(File.storage_path >= below[0], File.storage_path < below[1])
+            .values(storage_path=new_path(File.storage_path))
+        )
+        db.execute(
+            update(Folder)
+            .where((Folder.storage_path == source) | ((Folder.storage_path >= below[0]) & (Folder.storage_path < below[1])))
+            .values(storage_path=new_path(Folder.storage_path))
+        )
+        db.commit()
+        folders.clear()
+
+        folder = db.query(Folder).filter(Folder.storage_path == destination).first()
+        if folder is None:
+            return
+        try:
+            parent_id = WatchService._folder_for(db, os.path.dirname(destination), folders)
+            FolderService.update_folder(db, folder.id, name=os.path.basename(destination), parent_id=parent_id)
+        except ValueError as e:
+            db.rollback()
+            print(f"Folder {folder.id} keeps its place after {source} moved to {destination}: {str(e)}")
+
+    @staticmethod
+    def _add_files(db: Session, directory: str, entries: List[Tuple[str, DiskEntry]], folders: Dict[str, int]) -> List[int]:
+        """
+        Record new files of one directory, kept where they are, in one insert
+        """
+        folder_id = WatchService._folder_for(db, directory, folders)
+        taken = set()
+        rows = []
+        for name, entry in entries:
+            path = os.path.join(directory, name)
+            file_name = WatchService._free_name(db, folder_id, name, taken)
+            taken.add(file_name)
+            rows.append({
+                "name": file_name,
+                "storage_path": path,
+                "mime_type": mimetypes.guess_type(name)[0],
+                "size": entry.size,
+                "folder_id": folder_id,
+            })
+
+        file_ids = db.execute(insert(File).returning(File.id, sort_by_parameter_order=True), rows).scalars().all()
+        SearchService.index_files(db, [
+            {"rowid": file_id, "name": row["name"], "content": SearchService.extract_text(row["storage_path"], row["mime_type"])}
+            for file_id, row in zip(file_ids, rows)
+        ])
+        Folder.adjust_totals(db, folder_id, size=sum(row["size"] for row in rows), files=len(rows))
+        ChangeService.record(db, "file", file_ids)
+        return file_ids
+
+    @staticmethod
+    def _remove_directory_folders(db: Session, directory: str) -> None:
+        """
+        Delete the folders that mirrored a directory tree now gone from the drive,
+        unless they still hold files stored by the app, which only lose the link
+        """
+        below = (directory + os.sep, directory + chr(ord(os.sep) + 1))
+        folders = (
+            db.query(Folder)
+            .filter((Folder.storage_path == directory) | ((Folder.storage_path >= below[0]) & (Folder.storage_path < below[1])))
+            .order_by(Folder.storage_path.desc())
+            .all()
+        )
+        for folder in folders:
+            db.refresh(folder)
+            if folder.parent_id is not None and folder.file_count == 0:
+                FolderService.delete_folder(db, folder.id)
+            else:
+                folder.storage_path = None
+                db.commit()
+
+    @staticmethod
+    def apply(
+        db: Session,
+        directories: Dict[str, bool],
+        moves: List[Tuple[str, str, bool]]
+    ) -> Counter:
+        """
+        Bring the catalog in line with the given directories, after following the
+        moves reported by events. Files modified within WATCH_DEBOUNCE are left for
+        the next round, so copies in progress are not recorded half written.
+        Returns counts of what changed.
+        """
+        summary = Counter()
+        folders: Dict[str, int] = {}
+
+        for source, destination, is_directory in moves:
+            if is_directory:
+                WatchService._move_directory(db, source, destination, folders)
+                directories[destination] = True
+                summary["directories_moved"] += 1
+                continue
+            file_id = db.scalar(select(File.id).where(File.storage_path == source, File.blob_id == None))
+            if file_id is not None and not db.scalar(select(File.id).where(File.storage_path == destination)):
+                WatchService._move_file(db, file_id, source, destination, folders)
+                db.commit()
+                summary["files_moved"] += 1
+            directories.setdefault(os.path.dirname(source), False)
+            directories.setdefault(os.path.dirname(destination), False)
+
+        with ThreadPoolExecutor(max_workers=settings.RECONCILE_WORKERS, thread_name_prefix="watcher") as pool:
+            targets = set(directories)
+            for directory, subtree in directories.items():
+                if subtree:
+                    targets.update(
+                        path for path in ReconcileService.walk(pool, directory, exclude=data_path()) if _watched(path)
+                    )
+            targets = sorted(targets)
+            listings = dict(zip(targets, map_batched(pool, list_files, targets)))
+
+        settled_ns = time.time_ns() - int(settings.WATCH_DEBOUNCE * 10**9)
+        created: Dict[str, List[Tuple[str, DiskEntry]]] = defaultdict(list)
+        gone: Dict[str, Tracked] = {}  # By path, as vanished directories can be nested
+        resized: List[Tuple[Tracked, int]] = []
+        vanished: List[str] = []
+        synced: List[Tuple[str, int, int]] = []
+        for directory in targets:
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+            except FileNotFoundError:
+                vanished.append(directory)
+                continue
+            files = listings[directory]
+            tracked = ReconcileService.tracked_files(db, directory)
+            pending = False
+            for name, entry in files.items():
+                if name in tracked:
+                    if tracked[name].size != entry.size:
+                        if entry.mtime_ns > settled_ns:
+                            pending = True
+                        else:
+                            resized.append((tracked[name], entry.size))
+                elif _ignored_name(name):
+                    continue
+                elif entry.mtime_ns > settled_ns:
+                    pending = True
+                else:
+                    created[directory].append((name, entry))
+            gone.update((os.path.join(directory, name), entry) for name, entry in tracked.items() if name not in files)
+            if pending:
+                _changes.mark(directory)
+            else:
+                synced.append((directory, mtime_ns, len(tracked) + len(created[directory])))
+
+        for directory in vanished:
+            below = (directory + os.sep, directory + chr(ord(os.sep) + 1))
+            gone.update(
+                (row.storage_path, Tracked(row.id, row.size, row.folder_id))
+                for row in db.execute(
+                    select(File.id, File.storage_path, File.size, File.folder_id).where(
+                        File.blob_id == None,
+                        (File.storage_path >= below[0]) & (File.storage_path < below[1])
+                    )
+                )
+            )
+        db.commit()
+
+        # A file that disappeared and one with the same name and size that appeared
+        # are taken to be the same file moved, as polling cannot see moves
+        arrivals = defaultdict(list)
+        for directory, entries in created.items():
+            for name, entry in entries:
+                arrivals[(name, entry.size)].append((directory, name, entry))
+        removed = []
+        for path, entry in gone.items():
+            candidates = arrivals.get((os.path.basename(path), entry.size))
+            if not candidates:
+                removed.append(entry.id)
+                continue
+            directory, name, arrival = candidates.pop()
+            created[directory].remove((name, arrival))
+            WatchService._move_file(db, entry.id, path, os.path.join(directory, name), folders)
+            db.commit()
+            summary["files_moved"] += 1
+
+        for start in range(0, len(removed), settings.WATCH_BATCH_SIZE):
+            # The files are gone already; nothing is removed from disk
+            FolderService._remove_files(db, File.id.in_(removed[start:start + settings.WATCH_BATCH_SIZE]))
+            db.commit()
+        summary["files_removed"] += len(removed)
+
+        for start in range(0, len(resized), settings.WATCH_BATCH_SIZE):
+            for entry, size in resized[start:start + settings.WATCH_BATCH_SIZE]:
+                db.execute(update(File).where(File.id == entry.id).values(size=size, content_hash=None))
+                Folder.adjust_totals(db, entry.folder_id, size=size - (entry.size or 0))
+            ChangeService.record(db, "file", [entry.id for entry, _ in resized[start:start + settings.WATCH_BATCH_SIZE]])
+            db.commit()
+        summary["files_changed"] += len(resized)
+
+        added = []
+        for directory, entries in created.items():
+            for start in range(0, len(entries), settings.WATCH_BATCH_SIZE):
+                added.extend(WatchService._add_files(db, directory, entries[start:start + settings.WATCH_BATCH_SIZE], folders))
+                db.commit()
+        summary["files_added"] += len(added)
+        for start in range(0, len(added), settings.WATCH_BATCH_SIZE):
+            for db_file in FileService.get_files(db, added[start:start + settings.WATCH_BATCH_SIZE]):
+                ThumbnailService.schedule(db_file)
+            db.commit()
+
+        for directory in sorted(vanished, reverse=True):
+            WatchService._remove_directory_folders(db, directory)
+
+        # What is in step now needs no catch-up after a restart, nor a reconciliation scan
+        settled = [(path, mtime_ns, count) for path, mtime_ns, count in synced if mtime_ns < settled_ns]
+        ReconcileService.save_checkpoints(db, settled, vanished)
+        return +summary
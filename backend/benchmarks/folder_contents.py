@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Benchmark concurrent folder listings.
+
+Compares requests/sec for GET /api/folders/{id}/contents served two ways:
+  threadpool - the default: the listing runs on the sync reader pool in the
+               threadpool, as the other endpoints do
+  async      - with DB_ASYNC_READS, on an aiosqlite session
+
+Runs against a throwaway database and storage directory, removed afterwards:
+    cd backend && python -m benchmarks.folder_contents --files 20000 --concurrency 32
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+WORK_DIR = tempfile.mkdtemp(prefix="personal_drive_bench_")
+os.environ["STORAGE_DIR"] = os.path.join(WORK_DIR, "storage")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(WORK_DIR, 'bench.db')}"
+os.environ["DB_ASYNC_READS"] = "false"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+from sqlalchemy import insert  # noqa: E402
+
+from app.core.config import settings  # noqa: E402
+from app.db import base  # noqa: E402
+from app.db.base import SessionLocal  # noqa: E402
+from app.db.init_db import init_db  # noqa: E402
+from app.main import app  # noqa: E402
+from app.models.file import File  # noqa: E402
+from app.services.folder_service import FolderService  # noqa: E402
+
+
+def print_header(text):
+    print("\n" + "=" * 60)
+    print(text)
+    print("=" * 60)
+
+
+def populate(files: int, folders: int) -> int:
+    """
+    Create a folder holding the given number of subfolders and files. Returns its ID.
+    """
+    db = SessionLocal()
+    try:
+        init_db(db)
+        target = FolderService.create_folder(db, "bench", 1)
+        for i in range(folders):
+            FolderService.create_folder(db, f"folder {i:05d}", target.id)
+        now = datetime.utcnow()
+        db.execute(insert(File), [
+            {
+                "name": f"file {i:07d}.bin",
+                "mime_type": "application/octet-stream",
+                "size": i,
+                "folder_id": target.id,
+                "created_at": now,
+                "updated_at": now,
+            }
+            for i in range(files)
+        ])
+        db.commit()
+        return target.id
+    finally:
+        db.close()
+
+
+async def measure(asgi_app, folder_id: int, requests: int, concurrency: int, limit: int, sort: str) -> float:
+    """
+    Fire requests with the given concurrency and return requests per second
+    """
+    transport = httpx.ASGITransport(app=asgi_app)
+    semaphore = asyncio.Semaphore(concurrency)
+    url = f"/api/folders/{folder_id}/contents"
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def one():
+            async with semaphore:
+                response = await client.get(url, params={"limit": limit, "sort": sort})
+                response.raise_for_status()
+
+        await one()  # Warm up connections and caches
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(requests)))
+        rate = requests / (time.perf_counter() - start)
+
+    # aiosqlite connections belong to this event loop, so they are closed before it ends
+    if base.async_engine is not None:
+        await base.async_engine.dispose()
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=20000, help="Files in the listed folder")
+    parser.add_argument("--folders", type=int, default=200, help="Subfolders in the listed folder")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--limit", type=int, default=100, help="Page size of each listing")
+    parser.add_argument("--sort", default="size", help="Sort key; name, size, created_at or updated_at")
+    args = parser.parse_args()
+
+    print_header("SETUP")
+    print(f"Working directory: {WORK_DIR}")
+    try:
+        folder_id = populate(args.files, args.folders)
+        print(f"Folder {folder_id}: {args.folders} subfolders, {args.files} files")
+
+        print_header(f"{args.requests} REQUESTS, CONCURRENCY {args.concurrency}, PAGE SIZE {args.limit}")
+        results = {}
+        for name, async_reads in (("threadpool", False), ("async", True)):
+            settings.DB_ASYNC_READS = async_reads
+            results[name] = asyncio.run(
+                measure(app, folder_id, args.requests, args.concurrency, args.limit, args.sort)
+            )
+            print(f"{name:>10}: {results[name]:8.1f} requests/sec")
+        print(f"   speedup: {results['async'] / results['threadpool']:8.2f}x")
+    finally:
+        base.engine.dispose()
+        base.read_engine.dispose()
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
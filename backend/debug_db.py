@@ -29,15 +29,15 @@ def show_folders():
     conn = connect_db()
     cursor = conn.cursor()
     
-    cursor.execute("SELECT id, name, path, storage_path, parent_id FROM folders")
+    cursor.execute("SELECT id, name, storage_path, parent_id FROM folders")
     folders = cursor.fetchall()
     
-    print(f"{'ID':<5} {'Name':<20} {'Path':<30} {'Storage Path':<50} {'Parent ID'}")
-    print("-" * 110)
+    print(f"{'ID':<5} {'Name':<20} {'Storage Path':<50} {'Parent ID'}")
+    print("-" * 80)
     
     for folder in folders:
-        folder_id, name, path, storage_path, parent_id = folder
-        print(f"{folder_id:<5} {name:<20} {path:<30} {storage_path:<50} {parent_id}")
+        folder_id, name, storage_path, parent_id = folder
+        print(f"{folder_id:<5} {name:<20} {str(storage_path or '-'):<50} {parent_id}")
     
     conn.close()
 
@@ -46,15 +46,15 @@ def show_files():
     conn = connect_db()
     cursor = conn.cursor()
     
-    cursor.execute("SELECT id, name, path, storage_path, folder_id FROM files LIMIT 10")
+    cursor.execute("SELECT id, name, storage_path, blob_id, folder_id FROM files LIMIT 10")
     files = cursor.fetchall()
     
-    print(f"{'ID':<5} {'Name':<30} {'Path':<40} {'Storage Path':<50} {'Folder ID'}")
-    print("-" * 130)
+    print(f"{'ID':<5} {'Name':<30} {'Storage Path':<50} {'Blob ID':<8} {'Folder ID'}")
+    print("-" * 105)
     
     for file in files:
-        file_id, name, path, storage_path, folder_id = file
-        print(f"{file_id:<5} {name:<30} {path:<40} {storage_path:<50} {folder_id}")
+        file_id, name, storage_path, blob_id, folder_id = file
+        print(f"{file_id:<5} {name:<30} {str(storage_path or '-'):<50} {str(blob_id or '-'):<8} {folder_id}")
     
     if len(files) == 10:
         print("\n(Showing first 10 files only)")
@@ -97,7 +97,7 @@ def update_storage_paths():
     )
     
     # Update file paths
-    cursor.execute("SELECT id, storage_path FROM files")
+    cursor.execute("SELECT id, storage_path FROM files WHERE storage_path IS NOT NULL")
     files = cursor.fetchall()
     
     updated_count = 0
@@ -124,7 +124,8 @@ def check_file_existence():
     conn = connect_db()
     cursor = conn.cursor()
     
-    cursor.execute("SELECT id, name, storage_path FROM files")
+    # Files in the blob store are addressed by hash and have no storage_path
+    cursor.execute("SELECT id, name, storage_path FROM files WHERE storage_path IS NOT NULL")
     files = cursor.fetchall()
     
     missing_files = []